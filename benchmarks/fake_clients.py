@@ -0,0 +1,225 @@
+"""Client-side stand-ins wired into the bot by the benchmark harness
+
+Imports the bot's own modules, so it must only be imported after the harness
+has set the environment the bot's config is read from.
+"""
+import math
+import random
+import asyncio
+import itertools
+import mimetypes
+import aiohttp
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from pyrogram.errors import FloodWait
+from telegram_uploader import MediaSessionPool, StreamingTelegramUploader
+from google_drive import GoogleDriveUploader
+
+_message_ids = itertools.count(1)
+
+
+class FakeMessage:
+    """Telegram message the bot edits and replies to, counting what it sends"""
+
+    def __init__(self, chat_id, log):
+        self.chat_id = chat_id
+        self.message_id = next(_message_ids)
+        self.log = log
+        self.text = ''
+
+    async def edit_text(self, text, **kwargs):
+        self.log['edits'] += 1
+        self.text = text
+        return self
+
+    async def reply_text(self, text, **kwargs):
+        self.log['replies'] += 1
+        message = FakeMessage(self.chat_id, self.log)
+        message.text = text
+        return message
+
+
+class FakeSession:
+    """Media session that sends upload parts to the FakeTelegram backend over HTTP"""
+
+    def __init__(self, backend, key):
+        self.backend = backend
+        self.key = key
+
+    async def invoke(self, query, sleep_threshold=None):
+        total = getattr(query, 'file_total_parts', 0)
+        return await self.backend.save_part(self.key, query.file_id, query.file_part, total, query.bytes)
+
+
+class TelegramBackend:
+    """HTTP client for the FakeTelegram service
+
+    Uses its own connection pool: real uploads go over MTProto connections
+    that don't compete with downloads for the bot's HTTP pool.
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self.http = None
+        self.sessions = itertools.count(1)
+
+    async def get_session(self):
+        if self.http is None:
+            self.http = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0))
+        return self.http
+
+    async def close(self):
+        if self.http is not None:
+            await self.http.close()
+            self.http = None
+
+    def new_session(self, prefix):
+        return FakeSession(self, f'{prefix}-{next(self.sessions)}')
+
+    async def save_part(self, session_key, file_id, part, total_parts, data):
+        session = await self.get_session()
+        async with session.post(
+            f'{self.url}/parts/{file_id}/{part}', data=data, headers={'X-Session': session_key}
+        ) as response:
+            body = await response.json()
+            if response.status == 420:
+                raise FloodWait(value=body['flood_wait'])
+            if response.status != 200:
+                raise Exception(f"Fake Telegram rejected part {part} (HTTP {response.status})")
+            return body
+
+    async def send(self, file_id, parts, name, size):
+        session = await self.get_session()
+        payload = {'file_id': file_id, 'parts': parts, 'name': name, 'size': size}
+        async with session.post(f'{self.url}/send', json=payload) as response:
+            body = await response.json()
+            if response.status != 200:
+                raise Exception(f"Fake Telegram could not send {name}: {body.get('error')}")
+            document = SimpleNamespace(file_id=body['file_id'], file_name=name, file_size=size)
+            return SimpleNamespace(document=document, id=next(_message_ids))
+
+
+class FakePyrogramClient:
+    """Pyrogram Client replacement for the bot's non-streaming Telegram path
+
+    send_document follows Pyrogram 2.0's save_file: one new media session per
+    file, the file read synchronously on the event loop in 512 KB parts, and
+    four part workers for files over 10 MB (one below) behind a queue of one.
+    """
+
+    PART_SIZE = 512 * 1024
+
+    def __init__(self, backend, session_setup=0.0):
+        self.backend = backend
+        self.session_setup = session_setup
+        self.is_connected = True
+
+    async def start(self):
+        self.is_connected = True
+
+    async def stop(self):
+        self.is_connected = False
+
+    def rnd_id(self):
+        return random.getrandbits(63)
+
+    def guess_mime_type(self, file_name):
+        return mimetypes.guess_type(file_name)[0]
+
+    async def send_document(self, chat_id, document, caption='', progress=None, file_name=None, **kwargs):
+        with open(document, 'rb') as f:
+            f.seek(0, 2)
+            size = f.tell()
+            f.seek(0)
+
+            total_parts = math.ceil(size / self.PART_SIZE)
+            is_big = size > 10 * 1024 * 1024
+            file_id = self.rnd_id()
+            session = self.backend.new_session('document')
+            if self.session_setup:
+                await asyncio.sleep(self.session_setup)
+
+            queue = asyncio.Queue(1)
+
+            async def worker():
+                while True:
+                    item = await queue.get()
+                    if item is None:
+                        return
+                    part, data = item
+                    await session.invoke(SimpleNamespace(
+                        file_id=file_id, file_part=part, file_total_parts=total_parts, bytes=data
+                    ))
+
+            workers = [asyncio.ensure_future(worker()) for _ in range(4 if is_big else 1)]
+            try:
+                part = 0
+                while True:
+                    data = f.read(self.PART_SIZE)
+                    if not data:
+                        break
+                    await queue.put((part, data))
+                    part += 1
+                    if progress:
+                        await progress(min(part * self.PART_SIZE, size), size)
+            finally:
+                for _ in workers:
+                    await queue.put(None)
+                await asyncio.gather(*workers)
+
+        return await self.backend.send(file_id, total_parts, file_name or 'document', size)
+
+
+class FakeMediaSessionPool(MediaSessionPool):
+    """The bot's MediaSessionPool with its sessions opened on the fake backend"""
+
+    async def start(self):
+        if self.sessions:
+            return
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+            self.condition = asyncio.Condition()
+        self.load = [0] * self.size
+        self.paused_until = [0] * self.size
+        self.sessions = [self.client.backend.new_session('pool') for _ in range(self.size)]
+
+    async def stop(self):
+        self.sessions = []
+
+
+class FakeStreamingUploader(StreamingTelegramUploader):
+    """The bot's streaming uploader, sending the finished document to the fake backend"""
+
+    async def send_stream(self, chat_id, chunks, total_size, file_name, caption='', progress=None):
+        file = await self.upload(chunks, total_size, file_name, progress)
+        return await self.client.backend.send(file.id, file.parts, file_name, total_size)
+
+
+class BenchDriveUploader(GoogleDriveUploader):
+    """The bot's Drive uploader with the Drive API pointed at the fake service"""
+
+    def __init__(self, drive_url, **kwargs):
+        super().__init__(**kwargs)
+        self.drive_url = drive_url.rstrip('/') + '/'
+
+    @property
+    def discovery_doc(self):
+        if self._discovery_doc is None:
+            doc = dict(super().discovery_doc)
+            doc['rootUrl'] = doc['mtlsRootUrl'] = self.drive_url
+            doc['baseUrl'] = self.drive_url + doc['servicePath']
+            self._discovery_doc = doc
+        return self._discovery_doc
+
+
+def drive_token(drive_url):
+    """Token dict for a bench user, valid for a day against the fake token endpoint"""
+    return {
+        'token': 'bench-token',
+        'refresh_token': 'bench-refresh',
+        'token_uri': drive_url.rstrip('/') + '/token',
+        'client_id': 'bench',
+        'client_secret': 'bench',
+        'scopes': ['https://www.googleapis.com/auth/drive.file'],
+        'expiry': (datetime.utcnow() + timedelta(days=1)).isoformat()
+    }
@@ -0,0 +1,419 @@
+import sys
+import json
+import time
+import random
+import asyncio
+import itertools
+from aiohttp import web
+
+# Every served file has the same content: PATTERN repeated from offset 0, so a
+# receiver can check any byte range without knowing which file it belongs to.
+# The odd length keeps parts and chunks from lining up with the repeat.
+PATTERN = random.Random(0).randbytes(1024 * 1024 + 7)
+SEND_CHUNK = 64 * 1024
+
+
+def pattern_slice(offset, length):
+    """length bytes of the served content starting at offset"""
+    out = bytearray()
+    while len(out) < length:
+        start = (offset + len(out)) % len(PATTERN)
+        out += PATTERN[start:start + length - len(out)]
+    return bytes(out)
+
+
+class Throttle:
+    """Pace bytes to a rate in bytes per second, 0 means unlimited"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.next = 0.0
+
+    async def consume(self, size):
+        if not self.rate:
+            return
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        self.next = max(self.next, now) + size / self.rate
+        if self.next > now:
+            await asyncio.sleep(self.next - now)
+
+
+async def read_body(request, throttle=None):
+    """Read a request body, pacing it through throttle"""
+    body = bytearray()
+    while True:
+        data = await request.content.read(SEND_CHUNK)
+        if not data:
+            return bytes(body)
+        body += data
+        if throttle:
+            await throttle.consume(len(data))
+
+
+class FileSource:
+    """HTTP file server: GET/HEAD /files/<size>/<name>
+
+    bandwidth caps each response, total_bandwidth all responses together (both
+    in bytes per second, 0 for unlimited). latency is added before every
+    response; with ranges off, Range headers are ignored like on many
+    simple hosts.
+    """
+
+    def __init__(self, bandwidth=0, total_bandwidth=0, latency=0.0, ranges=True):
+        self.bandwidth = bandwidth
+        self.total = Throttle(total_bandwidth)
+        self.latency = latency
+        self.ranges = ranges
+        self.stats = {'requests': 0, 'range_requests': 0, 'aborted': 0, 'bytes_sent': 0}
+
+    def routes(self, app):
+        app.router.add_route('*', '/files/{size}/{name}', self.handle)
+
+    @staticmethod
+    def parse_range(header, size):
+        """(start, end) of a single bytes=a-b range, or None"""
+        if not header or not header.startswith('bytes=') or ',' in header:
+            return None
+        first, _, last = header[6:].partition('-')
+        if not first:
+            return None
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+        return (start, end) if start <= end else None
+
+    async def handle(self, request):
+        if request.method not in ('GET', 'HEAD'):
+            return web.Response(status=405)
+        size = int(request.match_info['size'])
+        name = request.match_info['name']
+        etag = f'"bench-{size}"'
+        self.stats['requests'] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        headers = {
+            'ETag': etag,
+            'Last-Modified': 'Mon, 01 Jan 2024 00:00:00 GMT',
+            'Content-Disposition': f'attachment; filename="{name}"',
+            'Content-Type': 'application/octet-stream'
+        }
+        start, end, status = 0, size - 1, 200
+        byte_range = self.parse_range(request.headers.get('Range'), size) if self.ranges else None
+        if_range = request.headers.get('If-Range')
+        if byte_range and (not if_range or if_range in (etag, headers['Last-Modified'])):
+            start, end = byte_range
+            status = 206
+            headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+            self.stats['range_requests'] += 1
+        if self.ranges:
+            headers['Accept-Ranges'] = 'bytes'
+        headers['Content-Length'] = str(end - start + 1)
+
+        response = web.StreamResponse(status=status, headers=headers)
+        await response.prepare(request)
+        if request.method == 'HEAD':
+            return response
+
+        throttle = Throttle(self.bandwidth)
+        offset = start
+        try:
+            while offset <= end:
+                length = min(SEND_CHUNK, end - offset + 1)
+                await throttle.consume(length)
+                await self.total.consume(length)
+                await response.write(pattern_slice(offset, length))
+                self.stats['bytes_sent'] += length
+                offset += length
+            await response.write_eof()
+        except ConnectionResetError:
+            # The client gave up on the rest, e.g. a probe or a cancelled job
+            self.stats['aborted'] += 1
+        return response
+
+
+class FakeDrive:
+    """Google Drive v3 stand-in: resumable uploads, permissions, copies and tokens
+
+    Upload chunks are read at bandwidth bytes per second per upload session,
+    every request waits latency seconds, and every error_every-th chunk PUT is
+    answered with a 503 before its body is read (0 never fails). Received
+    bytes are checked against the served content.
+    """
+
+    def __init__(self, bandwidth=0, latency=0.0, error_every=0):
+        self.bandwidth = bandwidth
+        self.latency = latency
+        self.error_every = error_every
+        self.sessions = {}              # upload id -> session dict
+        self.ids = itertools.count(1)
+        self.puts = 0
+        self.stats = {
+            'sessions': 0, 'chunks': 0, 'status_queries': 0, 'errors_injected': 0,
+            'bytes_received': 0, 'files': 0, 'corrupt_files': 0, 'permissions': 0, 'copies': 0
+        }
+
+    def routes(self, app):
+        app.router.add_post('/upload/drive/v3/files', self.start_upload)
+        app.router.add_put('/upload/drive/v3/files', self.put_chunk)
+        app.router.add_delete('/upload/drive/v3/files', self.cancel_upload)
+        app.router.add_post('/drive/v3/files/{file_id}/permissions', self.create_permission)
+        app.router.add_post('/drive/v3/files/{file_id}/copy', self.copy_file)
+        app.router.add_post('/token', self.token)
+
+    def file_resource(self, file_id, name):
+        return {
+            'id': file_id,
+            'name': name,
+            'webViewLink': f'https://drive.example/file/d/{file_id}/view',
+            'webContentLink': f'https://drive.example/uc?id={file_id}'
+        }
+
+    async def start_upload(self, request):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        metadata = json.loads(await request.text() or '{}')
+        upload_id = str(next(self.ids))
+        total = request.headers.get('X-Upload-Content-Length')
+        self.sessions[upload_id] = {
+            'name': metadata.get('name', 'untitled'),
+            'total': int(total) if total else None,
+            'offset': 0,
+            'corrupt': False,
+            'result': None,
+            'throttle': Throttle(self.bandwidth)
+        }
+        self.stats['sessions'] += 1
+        location = f'{request.url.origin()}/upload/drive/v3/files?uploadType=resumable&upload_id={upload_id}'
+        return web.Response(headers={'Location': location})
+
+    def progress_response(self, session):
+        headers = {}
+        if session['offset']:
+            headers['Range'] = f"bytes=0-{session['offset'] - 1}"
+        return web.Response(status=308, headers=headers)
+
+    async def put_chunk(self, request):
+        session = self.sessions.get(request.query.get('upload_id'))
+        if session is None:
+            return web.Response(status=404)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        # Content-Range: bytes a-b/total, bytes a-b/*, or bytes */total for a status query
+        spec, _, total = request.headers.get('Content-Range', '').replace('bytes ', '').partition('/')
+        if total != '*':
+            session['total'] = int(total)
+        if spec == '*':
+            self.stats['status_queries'] += 1
+            return self.finish(session) if session['result'] else self.progress_response(session)
+
+        self.puts += 1
+        if self.error_every and self.puts % self.error_every == 0:
+            self.stats['errors_injected'] += 1
+            return web.Response(status=503)
+
+        start = int(spec.split('-')[0])
+        body = await read_body(request, session['throttle'])
+        self.stats['chunks'] += 1
+        if start > session['offset']:
+            # A gap, Drive answers with what it has
+            return self.progress_response(session)
+
+        new = body[session['offset'] - start:]
+        if new != pattern_slice(session['offset'], len(new)):
+            session['corrupt'] = True
+        session['offset'] += len(new)
+        self.stats['bytes_received'] += len(new)
+
+        if session['total'] is not None and session['offset'] >= session['total']:
+            if session['result'] is None:
+                session['result'] = self.file_resource(f"bench{request.query['upload_id']}", session['name'])
+                self.stats['files'] += 1
+                if session['corrupt'] or session['offset'] != session['total']:
+                    self.stats['corrupt_files'] += 1
+            return self.finish(session)
+        return self.progress_response(session)
+
+    def finish(self, session):
+        return web.json_response(session['result'])
+
+    async def cancel_upload(self, request):
+        self.sessions.pop(request.query.get('upload_id'), None)
+        return web.Response(status=499)
+
+    async def create_permission(self, request):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.stats['permissions'] += 1
+        return web.json_response({'kind': 'drive#permission', 'id': 'anyoneWithLink', 'type': 'anyone', 'role': 'reader'})
+
+    async def copy_file(self, request):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.stats['copies'] += 1
+        body = json.loads(await request.text() or '{}')
+        return web.json_response(self.file_resource(f'copy{next(self.ids)}', body.get('name', 'copy')))
+
+    async def token(self, request):
+        return web.json_response({'access_token': 'bench-token', 'expires_in': 3600, 'token_type': 'Bearer'})
+
+
+class FakeTelegram:
+    """Telegram upload backend reached by the fake Pyrogram client
+
+    Parts are POSTed to /parts/<file_id>/<part> with an X-Session header; each
+    session gets bandwidth bytes per second and every call waits latency
+    seconds. Every flood_every-th part is refused with a FloodWait of
+    flood_wait seconds (0 never). /send turns a complete set of parts into a
+    message and checks the bytes.
+    """
+
+    def __init__(self, bandwidth=0, latency=0.0, flood_every=0, flood_wait=1):
+        self.bandwidth = bandwidth
+        self.latency = latency
+        self.flood_every = flood_every
+        self.flood_wait = flood_wait
+        self.throttles = {}             # session -> Throttle
+        self.files = {}                 # file_id -> {part: size}
+        self.corrupt = set()
+        self.part_size = 512 * 1024
+        self.calls = 0
+        self.stats = {
+            'parts': 0, 'bytes_received': 0, 'flood_waits': 0, 'sessions': 0, 'aborted_parts': 0,
+            'messages': 0, 'corrupt_files': 0, 'incomplete_files': 0
+        }
+
+    def routes(self, app):
+        app.router.add_post('/parts/{file_id}/{part}', self.save_part)
+        app.router.add_post('/send', self.send)
+
+    async def save_part(self, request):
+        key = request.headers.get('X-Session', 'default')
+        throttle = self.throttles.get(key)
+        if throttle is None:
+            throttle = self.throttles[key] = Throttle(self.bandwidth)
+            self.stats['sessions'] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        self.calls += 1
+        if self.flood_every and self.calls % self.flood_every == 0:
+            self.stats['flood_waits'] += 1
+            await request.read()
+            return web.json_response({'flood_wait': self.flood_wait}, status=420)
+
+        file_id = request.match_info['file_id']
+        part = int(request.match_info['part'])
+        try:
+            data = await read_body(request, throttle)
+        except ConnectionResetError:
+            # The uploader gave up on the file, e.g. its source broke off
+            self.stats['aborted_parts'] += 1
+            return web.Response(status=499)
+        if data != pattern_slice(part * self.part_size, len(data)):
+            self.corrupt.add(file_id)
+        self.files.setdefault(file_id, {})[part] = len(data)
+        self.stats['parts'] += 1
+        self.stats['bytes_received'] += len(data)
+        return web.json_response(True)
+
+    async def send(self, request):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        body = await request.json()
+        file_id = str(body['file_id'])
+        parts = self.files.pop(file_id, {})
+        self.stats['messages'] += 1
+        if file_id in self.corrupt:
+            self.stats['corrupt_files'] += 1
+        if len(parts) != body['parts'] or sum(parts.values()) != body['size']:
+            self.stats['incomplete_files'] += 1
+            return web.json_response({'error': 'FILE_PARTS_INVALID'}, status=400)
+        return web.json_response({'file_id': f"bench-doc-{body['file_id']}", 'name': body['name']})
+
+
+class FakeBotAPI:
+    """Telegram Bot API server for python-telegram-bot: POST /bot<token>/<method>
+
+    Answers the calls the bot makes with minimal valid objects after latency
+    seconds, and counts them by method.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.message_ids = itertools.count(1)
+        self.stats = {'calls': {}}
+
+    def routes(self, app):
+        app.router.add_post('/bot{token}/{method}', self.call)
+
+    @staticmethod
+    async def parameters(request):
+        """Call parameters, sent as JSON or form fields holding JSON values"""
+        if request.content_type == 'application/json':
+            return await request.json()
+        parameters = {}
+        for name, value in (await request.post()).items():
+            try:
+                parameters[name] = json.loads(value)
+            except (TypeError, ValueError):
+                parameters[name] = value
+        return parameters
+
+    async def call(self, request):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        method = request.match_info['method']
+        parameters = await self.parameters(request)
+        calls = self.stats['calls']
+        calls[method] = calls.get(method, 0) + 1
+
+        bot = {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+        if method == 'getMe':
+            result = dict(bot, can_join_groups=False, can_read_all_group_messages=False, supports_inline_queries=False)
+        elif method in ('sendMessage', 'editMessageText'):
+            result = {
+                'message_id': parameters.get('message_id') or next(self.message_ids),
+                'date': int(time.time()),
+                'chat': {'id': int(parameters.get('chat_id', 0)), 'type': 'private'},
+                'from': bot,
+                'text': str(parameters.get('text', ''))
+            }
+        else:
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+
+async def serve(config):
+    """Start the services on free local ports and report their URLs on stdout"""
+    services = {
+        'source': FileSource(**config.get('source', {})),
+        'drive': FakeDrive(**config.get('drive', {})),
+        'telegram': FakeTelegram(**config.get('telegram', {})),
+        'botapi': FakeBotAPI(**config.get('botapi', {}))
+    }
+    urls = {}
+    runners = []
+    for name, service in services.items():
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        service.routes(app)
+        app.router.add_get('/_stats', lambda request, service=service: web.json_response(service.stats))
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        runners.append(runner)
+        urls[name] = f"http://127.0.0.1:{runner.addresses[0][1]}"
+
+    print(json.dumps(urls), flush=True)
+
+    # Run until the parent closes our stdin
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, sys.stdin.read)
+    for runner in runners:
+        await runner.cleanup()
+
+
+if __name__ == '__main__':
+    asyncio.run(serve(json.loads(sys.argv[1]) if len(sys.argv) > 1 else {}))
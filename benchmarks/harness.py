@@ -0,0 +1,314 @@
+"""Run the bot's transfer pipeline against local fakes and collect measurements
+
+The fake services run in a child process so their pacing doesn't share the
+event loop being measured. The bot itself is imported from this checkout,
+inside a scratch directory that holds its database, downloads and sessions.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import asyncio
+import platform
+import tempfile
+import subprocess
+import aiohttp
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MB = 1024 * 1024
+
+
+def percentile(values, q):
+    """q quantile of values by nearest rank, None when empty"""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, round(q * len(values)) - 1))]
+
+
+def rounded(value, digits=3):
+    return None if value is None else round(value, digits)
+
+
+def free_port():
+    """A local TCP port nothing listens on right now"""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def check(condition, message):
+    """Fail the run when a correctness check doesn't hold"""
+    if not condition:
+        raise Exception(f"Check failed: {message}")
+
+
+def git_revision():
+    """Commit of this checkout, marked -dirty with uncommitted changes"""
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=REPO_ROOT, text=True).strip()
+        dirty = subprocess.call(['git', 'diff', '--quiet', 'HEAD'], cwd=REPO_ROOT)
+        return commit + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Services:
+    """The fake source, Drive and Telegram services in a child process"""
+
+    def __init__(self, config):
+        self.config = config
+        self.process = None
+        self.urls = None
+
+    def start(self):
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'benchmarks.fake_services', json.dumps(self.config)],
+            cwd=REPO_ROOT, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True
+        )
+        line = self.process.stdout.readline()
+        if not line:
+            raise Exception("Fake services failed to start")
+        self.urls = json.loads(line)
+        return self.urls
+
+    async def stats(self):
+        stats = {}
+        async with aiohttp.ClientSession() as session:
+            for name, url in self.urls.items():
+                async with session.get(f'{url}/_stats') as response:
+                    stats[name] = await response.json()
+        return stats
+
+    def stop(self):
+        if self.process:
+            self.process.stdin.close()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+            self.process = None
+
+
+class Bench:
+    """A FileUploadBot wired to the fakes, with helpers to push jobs through it
+
+    env overrides the bot's configuration (e.g. DOWNLOAD_CONNECTIONS=1) and is
+    applied before the bot is imported. Call load() once per process.
+    """
+
+    DEFAULT_ENV = {
+        'BOT_TOKEN': '0:bench',
+        'API_ID': '1',
+        'API_HASH': 'bench',
+        'METRICS_PORT': '0',
+        'DEDUP_ENABLED': 'False',
+        'WEB_HOST': '127.0.0.1',
+        'WEBHOOK_SECRET': 'bench-secret'
+    }
+
+    def __init__(self, services, env=None, telegram_session_setup=0.05):
+        self.services = services
+        self.env = dict(self.DEFAULT_ENV, **(env or {}))
+        self.telegram_session_setup = telegram_session_setup
+        self.workdir = None
+        self.bot = None
+        self.messages = {'edits': 0, 'replies': 0}
+        self.jobs = []
+        self.url_ids = 0
+        self.application = None
+
+    def load(self):
+        """Import the bot with the bench environment inside a scratch directory"""
+        urls = self.services.urls if self.services else {}
+        if 'drive' in urls:
+            self.env.setdefault('GDRIVE_UPLOAD_URL', urls['drive'] + '/upload/drive/v3/files')
+        self.env.setdefault('PORT', str(free_port()))
+        os.environ.update(self.env)
+
+        self.workdir = tempfile.mkdtemp(prefix='bot-bench-')
+        os.chdir(self.workdir)
+        sys.path.insert(0, REPO_ROOT)
+
+        import bot
+        import metrics
+        self.module = bot
+        self.db = bot.db
+        self.metrics = metrics
+
+    async def start(self, application=False):
+        """Create the bot, swap in the fake clients and start its background services
+
+        With application the bot also runs its Telegram application against
+        the fake Bot API, taking updates on its webhook like in production.
+        """
+        from benchmarks.fake_clients import (
+            TelegramBackend, FakePyrogramClient, FakeMediaSessionPool, FakeStreamingUploader, BenchDriveUploader
+        )
+
+        bot = self.bot = self.module.FileUploadBot()
+        urls = self.services.urls if self.services else {}
+        if urls:
+            self.telegram = TelegramBackend(urls['telegram'])
+            client = FakePyrogramClient(self.telegram, self.telegram_session_setup)
+            bot.pyrogram_client = client
+            bot.telegram_uploader = FakeStreamingUploader(client, pool=FakeMediaSessionPool(client))
+            bot.gdrive_uploader = BenchDriveUploader(
+                urls['drive'], on_token_refresh=self.db.sync.update_gdrive_token, http_client=bot.drive_http
+            )
+
+        if application:
+            # The same steps as FileUploadBot.serve(), without setting a webhook
+            self.application = bot.build_application(polling=False, base_url=urls['botapi'])
+            await self.application.initialize()
+            await bot.startup(self.application)
+            await self.application.start()
+            self.webhook_url = f"http://127.0.0.1:{self.env['PORT']}{self.module.WEBHOOK_PATH}"
+        else:
+            bot.scheduler.start()
+            bot.progress.start()
+            bot.lag_monitor.start()
+
+    async def stop(self):
+        if self.application:
+            await self.bot.web.stop()
+            await self.application.stop()
+            await self.bot.shutdown(self.application)
+            await self.application.shutdown()
+        else:
+            await self.bot.scheduler.stop()
+            await self.bot.progress.stop()
+            await self.bot.lag_monitor.stop()
+            await self.bot.http.close()
+            await self.bot.drive_http.close()
+            self.db.close()
+        if self.services:
+            await self.telegram.close()
+        self.bot.gdrive_uploader.executor.shutdown(wait=False)
+        os.chdir(REPO_ROOT)
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    async def add_user(self, user_id, package='premium'):
+        """Create a user with a connected Drive account"""
+        from benchmarks.fake_clients import drive_token
+        await self.db.add_user(user_id, f'bench{user_id}', package)
+        if self.services:
+            await self.db.update_gdrive_token(user_id, drive_token(self.services.urls['drive']))
+
+    def file_url(self, size, name):
+        # A unique query string per job keeps the probe cache and dedup out of the numbers
+        self.url_ids += 1
+        return f"{self.services.urls['source']}/files/{size}/{name}?bench={self.url_ids}"
+
+    async def submit(self, user_id, destination, size, name):
+        """Queue a transfer the way the upload buttons do, returns its tracking dict"""
+        from benchmarks.fake_clients import FakeMessage
+        bot = self.bot
+        tracked = {'user_id': user_id, 'destination': destination, 'size': size, 'submitted': time.time()}
+        done = tracked['done'] = asyncio.Event()
+
+        url = self.file_url(size, name)
+        info = await bot.get_file_info(url)
+        job_id = await self.db.add_job(user_id, user_id, url, info['name'], info['size'], info['etag'])
+        if not await bot.reserve_quota(await self.db.get_job(job_id)):
+            raise Exception(f"Bench user {user_id} is out of quota")
+        await self.db.queue_job(job_id, destination, self.module.WORKER_ID, self.module.JOB_LEASE_SECONDS)
+
+        job, _ = bot.create_transfer_job(await self.db.get_job(job_id), FakeMessage(user_id, self.messages))
+        run = job.run
+
+        async def tracked_run(job):
+            try:
+                await run(job)
+            finally:
+                tracked['finished'] = time.time()
+                done.set()
+
+        job.run = tracked_run
+        tracked['job'] = job
+        self.jobs.append(tracked)
+        await bot.scheduler.submit(job)
+        return tracked
+
+    async def wait(self):
+        """Wait for every submitted job to finish"""
+        await asyncio.gather(*(tracked['done'].wait() for tracked in self.jobs))
+
+    async def results(self, started, finished):
+        """Summarize the jobs submitted so far and the process metrics"""
+        metrics = self.metrics
+        states = {}
+        durations = []
+        waits = []
+        moved = 0
+        for tracked in self.jobs:
+            record = await self.db.get_job(tracked['job'].id)
+            states[record['state']] = states.get(record['state'], 0) + 1
+            if record['state'] == 'done':
+                moved += tracked['size']
+            durations.append(tracked['finished'] - tracked['submitted'])
+            if tracked['job'].started_at:
+                waits.append(tracked['job'].started_at - tracked['submitted'])
+
+        wall = finished - started
+        result = {
+            'wall_seconds': round(wall, 3),
+            'jobs': dict(states, total=len(self.jobs)),
+            'bytes_done': moved,
+            'throughput_mb_s': round(moved / MB / wall, 2) if wall > 0 else None,
+            'job_seconds': {
+                'p50': rounded(percentile(durations, 0.5)),
+                'p95': rounded(percentile(durations, 0.95)),
+                'max': rounded(max(durations) if durations else None)
+            },
+            'queue_wait_seconds': {'p50': rounded(percentile(waits, 0.5)), 'p95': rounded(percentile(waits, 0.95))},
+            'stage_speed_mb_s': {},
+            'latency_ms': {},
+            'loop_lag_ms': {},
+            'messages': dict(self.messages)
+        }
+
+        for stage in ('download', 'upload', 'stream'):
+            for destination in ('telegram', 'gdrive'):
+                median = metrics.transfer_speed.quantile(0.5, stage=stage, destination=destination)
+                if median is not None:
+                    result['stage_speed_mb_s'][f'{stage}/{destination}'] = {
+                        'p50': round(median / MB, 2),
+                        'p5': round(metrics.transfer_speed.quantile(0.05, stage=stage, destination=destination) / MB, 2),
+                        'count': metrics.transfer_speed.count(stage=stage, destination=destination)
+                    }
+
+        for name, histogram in (('probe', metrics.probe_latency), ('db', metrics.db_latency),
+                                ('drive', metrics.gdrive_latency)):
+            p95 = histogram.quantile(0.95)
+            if p95 is not None:
+                result['latency_ms'][name] = {
+                    'p50': round(histogram.quantile(0.5) * 1000, 2),
+                    'p95': round(p95 * 1000, 2),
+                    'count': histogram.count()
+                }
+
+        lag = self.bot.lag_monitor.get_stats()
+        p95 = metrics.loop_lag.quantile(0.95)
+        result['loop_lag_ms'] = {
+            'avg': round(lag['avg'] * 1000, 2),
+            'p95': round(p95 * 1000, 2) if p95 is not None else None,
+            'max': round(lag['max'] * 1000, 2)
+        }
+
+        if self.services:
+            result['services'] = await self.services.stats()
+        return result
+
+
+def environment():
+    """Where the numbers came from"""
+    return {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z')
+    }
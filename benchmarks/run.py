@@ -0,0 +1,545 @@
+"""Benchmark scenarios for the transfer pipeline and the database
+
+    python -m benchmarks.run single_big --destination gdrive --size 512
+    python -m benchmarks.run many_small --count 100 --output before.json
+    python -m benchmarks.run concurrent_users --users 16 --set DOWNLOAD_CONNECTIONS=4
+    python -m benchmarks.run database --users 32
+    python -m benchmarks.run claim_contention --users 8 --count 300
+    python -m benchmarks.run webhook --users 8 --ops 50
+    python -m benchmarks.run quota_stress --users 8 --ops 200
+    python -m benchmarks.run telegram_stream --count 4 --size 32
+    python -m benchmarks.run compare before.json after.json
+
+Each run prints (or writes with --output) one JSON document with the
+parameters, the revision and the measurements, so runs before and after a
+change can be compared with the compare command. Scenarios that check
+correctness as well exit with an error when a check fails.
+"""
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import itertools
+import threading
+import aiohttp
+from benchmarks.harness import Services, Bench, MB, percentile, environment, check
+from benchmarks.fake_services import pattern_slice
+
+
+async def single_big(bench, args):
+    """One user transfers one large file"""
+    await bench.add_user(1)
+    await bench.submit(1, args.destination or 'telegram', args.size * MB, 'big.bin')
+    await bench.wait()
+
+
+async def many_small(bench, args):
+    """One user transfers a batch of small files"""
+    await bench.add_user(1)
+    for index in range(args.count):
+        destination = args.destination or ('telegram', 'gdrive')[index % 2]
+        await bench.submit(1, destination, args.size * MB, f'small{index}.bin')
+    await bench.wait()
+
+
+async def concurrent_users(bench, args):
+    """Several users submit files at the same time, destinations mixed"""
+    for user_id in range(1, args.users + 1):
+        await bench.add_user(user_id)
+
+    async def user(user_id):
+        for index in range(args.files):
+            destination = args.destination or ('telegram', 'gdrive')[(user_id + index) % 2]
+            await bench.submit(user_id, destination, args.size * MB, f'user{user_id}_{index}.bin')
+
+    await asyncio.gather(*(user(user_id) for user_id in range(1, args.users + 1)))
+    await bench.wait()
+
+
+async def database(bench, args):
+    """Concurrent quota reservations, uploads and reads through the async database"""
+    db = bench.db
+    for user_id in range(1, args.users + 1):
+        await bench.add_user(user_id)
+
+    latencies = {}
+
+    async def timed(name, call):
+        start = time.perf_counter()
+        result = await call
+        latencies.setdefault(name, []).append(time.perf_counter() - start)
+        return result
+
+    async def user(user_id):
+        rng = random.Random(user_id)
+        for index in range(args.ops):
+            size = rng.randint(1, 100) * MB
+            job_id = await timed('add_job', db.add_job(user_id, user_id, f'https://bench/{user_id}/{index}', 'f.bin', size))
+            await timed('reserve_quota', db.reserve_quota(user_id, job_id, size, 50 * 1024 * MB))
+            await timed('update_job', db.update_job(job_id, state='downloading'))
+            await timed('record_upload', db.record_upload(user_id, 'f.bin', size, 'telegram', job_id))
+            await timed('get_user', db.get_user(user_id))
+            if index % 10 == 0:
+                await timed('get_statistics', db.get_statistics())
+
+    await asyncio.gather(*(user(user_id) for user_id in range(1, args.users + 1)))
+    bench.operations = summarize(latencies)
+
+
+def summarize(latencies):
+    return {
+        name: {
+            'count': len(values),
+            'p50_ms': round(percentile(values, 0.5) * 1000, 3),
+            'p95_ms': round(percentile(values, 0.95) * 1000, 3),
+            'max_ms': round(max(values) * 1000, 3)
+        }
+        for name, values in latencies.items()
+    }
+
+
+async def claim_contention(bench, args):
+    """Worker processes, one database connection each, claim the same queued jobs
+
+    Checks every job is claimed exactly once and none is reported as resumed.
+    """
+    db = bench.db.sync
+    await bench.add_user(1)
+    for index in range(args.count):
+        job_id = await bench.db.add_job(1, 1, f'https://bench/{index}', 'f.bin', MB)
+        await bench.db.queue_job(job_id, 'telegram')
+
+    claims = {}
+    latencies = {'claim_jobs': []}
+    lock = threading.Lock()
+    start = threading.Barrier(args.users)
+
+    def worker(worker_id):
+        start.wait()
+        while True:
+            started = time.perf_counter()
+            records = db.claim_jobs(worker_id, 60, limit=1)
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies['claim_jobs'].append(elapsed)
+                for record in records:
+                    claims.setdefault(record['id'], []).append((worker_id, record['resumed']))
+            if not records:
+                return
+            for record in records:
+                db.update_job(record['id'], state='done')
+
+    threads = [threading.Thread(target=worker, args=(f'worker-{index}',)) for index in range(args.users)]
+    loop = asyncio.get_running_loop()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        await loop.run_in_executor(None, thread.join)
+
+    twice = [job_id for job_id, owners in claims.items() if len(owners) > 1]
+    check(not twice, f"jobs claimed more than once: {twice[:10]}")
+    check(len(claims) == args.count, f"{args.count - len(claims)} queued jobs were never claimed")
+    check(not any(resumed for owners in claims.values() for _, resumed in owners), "fresh jobs reported as resumed")
+
+    per_worker = {}
+    for owners in claims.values():
+        per_worker[owners[0][0]] = per_worker.get(owners[0][0], 0) + 1
+    bench.operations = summarize(latencies)
+    bench.extra = {'claimed': len(claims), 'jobs_per_worker': per_worker}
+
+
+async def quota_stress(bench, args):
+    """Worker threads, one database connection each, reserve, release and use the quota of two users
+
+    Some jobs are released from two connections at once, like a failed
+    transfer cleaning up while another process sweeps reservations. Checks,
+    while running and at the end, that
+    reservations never push a user past the limit and that monthly_reserved
+    always equals the sum of the user's quota_reservations.
+    """
+    db = bench.db.sync
+    users = (1, 2)
+    for user_id in users:
+        await bench.add_user(user_id)
+    # Half of the reserved bytes end up used, and that's about twice the limits, so they are hit midway
+    limit = args.users * args.ops * 50 * MB // (4 * len(users))
+    job_ids = itertools.count(1)
+    latencies = {'reserve_quota': [], 'release_quota': [], 'record_upload': []}
+    outcomes = {'reserved': 0, 'refused': 0}
+    violations = []
+    lock = threading.Lock()
+    running = threading.Event()
+    running.set()
+
+    def timed(name, call, *call_args):
+        started = time.perf_counter()
+        result = call(*call_args)
+        with lock:
+            latencies[name].append(time.perf_counter() - started)
+        return result
+
+    def ledger_errors():
+        """Read both users' ledgers in one snapshot, return what's wrong with them"""
+        conn = db.get_connection()
+        period = db.current_period()
+        errors = []
+        with conn:
+            conn.execute('BEGIN')
+            for user_id in users:
+                user = conn.execute(
+                    'SELECT monthly_used, monthly_reserved, usage_period FROM users WHERE user_id = ?', (user_id,)
+                ).fetchone()
+                held = conn.execute(
+                    'SELECT COALESCE(SUM(bytes), 0) FROM quota_reservations WHERE user_id = ?', (user_id,)
+                ).fetchone()[0]
+                used = user['monthly_used'] if user['usage_period'] == period else 0
+                if used + user['monthly_reserved'] > limit:
+                    errors.append(f"user {user_id}: used {used} + reserved {user['monthly_reserved']} > limit {limit}")
+                if user['monthly_reserved'] != held:
+                    errors.append(f"user {user_id}: monthly_reserved {user['monthly_reserved']} != reservations {held}")
+        return errors
+
+    def worker(index):
+        rng = random.Random(index)
+        for _ in range(args.ops):
+            user_id = rng.choice(users)
+            job_id = next(job_ids)
+            size = rng.randint(1, 100) * MB
+            if not timed('reserve_quota', db.reserve_quota, user_id, job_id, size, limit):
+                with lock:
+                    outcomes['refused'] += 1
+                continue
+            with lock:
+                outcomes['reserved'] += 1
+
+            roll = rng.random()
+            if roll < 0.5:
+                timed('record_upload', db.record_upload, user_id, 'f.bin', size, 'telegram', job_id)
+            elif roll < 0.8:
+                timed('release_quota', db.release_quota, job_id)
+            else:
+                # Release the same job at once from two connections
+                other = threading.Thread(target=timed, args=('release_quota', db.release_quota, job_id))
+                other.start()
+                timed('release_quota', db.release_quota, job_id)
+                other.join()
+
+    def checker():
+        while running.is_set():
+            errors = ledger_errors()
+            if errors:
+                violations.extend(errors)
+                return
+            time.sleep(0.005)
+
+    threads = [threading.Thread(target=worker, args=(index,)) for index in range(args.users)]
+    watcher = threading.Thread(target=checker)
+    loop = asyncio.get_running_loop()
+    watcher.start()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        await loop.run_in_executor(None, thread.join)
+    running.clear()
+    await loop.run_in_executor(None, watcher.join)
+
+    check(not violations, f"ledger broken while running: {violations[:3]}")
+    errors = ledger_errors()
+    check(not errors, f"ledger broken at the end: {errors}")
+    check(db.get_connection().execute('SELECT COUNT(*) FROM quota_reservations').fetchone()[0] == 0,
+          "reservations left after every job finished")
+
+    bench.operations = summarize(latencies)
+    bench.extra = {'reservations': outcomes, 'limit': limit}
+
+
+async def telegram_stream(bench, args):
+    """Stream files to Telegram through the bot's uploader on the fake media sessions
+
+    The files go through the whole pipeline like single_big. Then the
+    uploader gets a stream that ends early and one that runs past its size.
+    Checks that every file arrives intact, that both broken streams raise
+    without sending a message, and that no session slot is left taken.
+    """
+    await bench.add_user(1)
+    for index in range(args.count):
+        await bench.submit(1, 'telegram', args.size * MB, f'stream{index}.bin')
+    await bench.wait()
+
+    states = [(await bench.db.get_job(tracked['job'].id))['state'] for tracked in bench.jobs]
+    check(states.count('done') == args.count, f"job states {states}")
+    streamed = bench.metrics.transfer_speed.count(stage='stream', destination='telegram')
+    check(streamed == args.count, f"{streamed} of {args.count} files took the streaming path")
+
+    uploader = bench.bot.telegram_uploader
+    size = args.size * MB
+
+    async def chunks(length):
+        # Uneven chunks, so parts are cut across chunk boundaries
+        rng = random.Random(length)
+        offset = 0
+        while offset < length:
+            piece = min(length - offset, rng.randint(1, 300) * 1024 + rng.randint(0, 1023))
+            yield pattern_slice(offset, piece)
+            offset += piece
+
+    broken = {
+        'short': (size - uploader.PART_SIZE - 1, 'Source ended after'),
+        'over_length': (size + 1, 'Source sent more than')
+    }
+    for name, (length, error) in broken.items():
+        try:
+            await uploader.send_stream(1, chunks(length), size, f'{name}.bin')
+        except Exception as e:
+            check(error in str(e), f"{name} stream raised {e!r}")
+        else:
+            check(False, f"{name} stream was sent")
+
+    check(not any(uploader.pool.load), f"session slots still taken: {uploader.pool.load}")
+    telegram = (await bench.services.stats())['telegram']
+    check(telegram['messages'] == args.count, f"{telegram['messages']} messages for {args.count} files")
+    check(not telegram['corrupt_files'] and not telegram['incomplete_files'], f"Telegram received {telegram}")
+    bench.extra = {'broken_streams_refused': len(broken)}
+
+
+def command_update(update_id, user_id, text):
+    """Bot API update carrying a command message from user_id"""
+    user = {'id': user_id, 'is_bot': False, 'first_name': f'bench{user_id}'}
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': user,
+            'text': text,
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text)}]
+        }
+    }
+
+
+async def webhook(bench, args):
+    """Users send /start through the webhook at once, replies go to the fake Bot API
+
+    Checks every update is accepted and answered, and that requests with a
+    wrong secret or a broken body are refused.
+    """
+    secret = {'X-Telegram-Bot-Api-Secret-Token': bench.env['WEBHOOK_SECRET']}
+    latencies = {'webhook': []}
+    update_ids = iter(range(1, args.users * args.ops + 1))
+
+    async with aiohttp.ClientSession() as session:
+        async with session.post(bench.webhook_url, json=command_update(0, 1, '/start'),
+                                headers={'X-Telegram-Bot-Api-Secret-Token': 'wrong'}) as response:
+            check(response.status == 403, f"wrong secret answered with HTTP {response.status}")
+        async with session.post(bench.webhook_url, data=b'{', headers=secret) as response:
+            check(response.status == 400, f"broken update answered with HTTP {response.status}")
+
+        async def user(user_id):
+            for _ in range(args.ops):
+                started = time.perf_counter()
+                async with session.post(bench.webhook_url, json=command_update(next(update_ids), user_id, '/start'),
+                                        headers=secret) as response:
+                    check(response.status == 200, f"update refused with HTTP {response.status}")
+                latencies['webhook'].append(time.perf_counter() - started)
+
+        await asyncio.gather(*(user(user_id) for user_id in range(1, args.users + 1)))
+
+    # Handlers run after the webhook answered; wait for their replies
+    expected = args.users * args.ops
+    deadline = time.monotonic() + 60
+    while True:
+        sent = (await bench.services.stats())['botapi']['calls'].get('sendMessage', 0)
+        if sent >= expected or time.monotonic() > deadline:
+            break
+        await asyncio.sleep(0.1)
+    check(sent == expected, f"{sent} replies for {expected} updates")
+    check(await bench.db.count_users() == args.users, "not every user was registered")
+
+    bench.operations = summarize(latencies)
+    bench.extra = {'updates': expected, 'replies': sent}
+
+
+SCENARIOS = {
+    'single_big': single_big,
+    'many_small': many_small,
+    'concurrent_users': concurrent_users,
+    'database': database,
+    'claim_contention': claim_contention,
+    'webhook': webhook,
+    'quota_stress': quota_stress,
+    'telegram_stream': telegram_stream
+}
+
+# Scenarios that only use the database, without the fake services
+DATABASE_SCENARIOS = {'database', 'claim_contention', 'quota_stress'}
+
+# Scenarios that run the bot's Telegram application and web server
+APPLICATION_SCENARIOS = {'webhook'}
+
+# Default file size (MB) per scenario
+SIZES = {'single_big': 256, 'many_small': 2, 'concurrent_users': 32, 'telegram_stream': 32}
+# Default --count per scenario
+COUNTS = {'claim_contention': 300, 'telegram_stream': 4}
+
+
+def service_config(args):
+    return {
+        'source': {
+            'bandwidth': args.source_bandwidth * MB,
+            'total_bandwidth': args.source_total_bandwidth * MB,
+            'latency': args.source_latency / 1000,
+            'ranges': not args.no_ranges
+        },
+        'drive': {
+            'bandwidth': args.drive_bandwidth * MB,
+            'latency': args.drive_latency / 1000,
+            'error_every': args.drive_error_every
+        },
+        'telegram': {
+            'bandwidth': args.telegram_bandwidth * MB,
+            'latency': args.telegram_latency / 1000,
+            'flood_every': args.telegram_flood_every
+        },
+        'botapi': {'latency': args.botapi_latency / 1000}
+    }
+
+
+async def run_scenario(args):
+    env = dict(item.split('=', 1) for item in args.set)
+    services = None
+    if args.scenario not in DATABASE_SCENARIOS:
+        services = Services(service_config(args))
+        services.start()
+
+    bench = Bench(services, env, telegram_session_setup=args.telegram_session_setup / 1000)
+    try:
+        bench.load()
+        await bench.start(application=args.scenario in APPLICATION_SCENARIOS)
+        started = time.time()
+        await SCENARIOS[args.scenario](bench, args)
+        finished = time.time()
+
+        results = await bench.results(started, finished)
+        if hasattr(bench, 'operations'):
+            results['operations'] = bench.operations
+            total = sum(operation['count'] for operation in bench.operations.values())
+            results['operations_per_second'] = round(total / (finished - started), 1)
+        if hasattr(bench, 'extra'):
+            results.update(bench.extra)
+        await bench.stop()
+    finally:
+        if services:
+            services.stop()
+
+    parameters = {
+        name: value for name, value in vars(args).items()
+        if name not in ('scenario', 'output', 'set', 'label')
+    }
+    return {
+        'scenario': args.scenario,
+        'label': args.label,
+        'parameters': parameters,
+        'config_overrides': env,
+        'environment': environment(),
+        'results': results
+    }
+
+
+def flatten(data, prefix=''):
+    """{'a': {'b': 1}} -> {'a.b': 1}, numbers only"""
+    flat = {}
+    for key, value in data.items():
+        name = f'{prefix}{key}'
+        if isinstance(value, dict):
+            flat.update(flatten(value, name + '.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+
+def compare(before_path, after_path):
+    """Print every numeric result of two runs side by side with the change"""
+    with open(before_path) as f:
+        before = json.load(f)
+    with open(after_path) as f:
+        after = json.load(f)
+
+    if before['scenario'] != after['scenario'] or before['parameters'] != after['parameters']:
+        print("warning: the runs used different scenarios or parameters", file=sys.stderr)
+
+    old, new = flatten(before['results']), flatten(after['results'])
+    width = max((len(name) for name in old.keys() | new.keys()), default=10)
+    print(f"{'metric':<{width}}  {before.get('label') or 'before':>12}  {after.get('label') or 'after':>12}  change")
+    for name in sorted(old.keys() | new.keys()):
+        a, b = old.get(name), new.get(name)
+        change = f'{(b - a) / a * 100:+.1f}%' if a and b is not None else ''
+        print(f"{name:<{width}}  {'' if a is None else a:>12}  {'' if b is None else b:>12}  {change}")
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.run', description=__doc__.split('\n')[0])
+    parser.add_argument('scenario', choices=sorted(SCENARIOS) + ['compare'])
+    parser.add_argument('files_to_compare', nargs='*', help='before.json after.json for compare')
+    parser.add_argument('--output', help='write the JSON result here instead of stdout')
+    parser.add_argument('--label', default='', help='free text stored with the result, e.g. before/after')
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE',
+                        help='bot configuration override (environment variable), repeatable')
+
+    scenario = parser.add_argument_group('scenario')
+    scenario.add_argument('--destination', choices=['telegram', 'gdrive'],
+                          help='send every file here (default: telegram for single_big, mixed otherwise)')
+    scenario.add_argument('--size', type=int, help='file size in MB')
+    scenario.add_argument('--count', type=int,
+                          help='files in many_small (default 50) and telegram_stream (4), queued jobs in claim_contention (300)')
+    scenario.add_argument('--users', type=int, default=8,
+                          help='users in concurrent_users, database and webhook, workers in claim_contention and quota_stress')
+    scenario.add_argument('--files', type=int, default=2, help='files per user in concurrent_users')
+    scenario.add_argument('--ops', type=int, default=50,
+                          help='upload cycles per user in database and per worker in quota_stress, updates per user in webhook')
+
+    services = parser.add_argument_group('fake services (bandwidth in MB/s, 0 = unlimited; latency in ms)')
+    services.add_argument('--source-bandwidth', type=float, default=20, help='per source connection')
+    services.add_argument('--source-total-bandwidth', type=float, default=0, help='all source connections together')
+    services.add_argument('--source-latency', type=float, default=20)
+    services.add_argument('--no-ranges', action='store_true', help='source ignores Range requests')
+    services.add_argument('--drive-bandwidth', type=float, default=40, help='per Drive upload session')
+    services.add_argument('--drive-latency', type=float, default=30)
+    services.add_argument('--drive-error-every', type=int, default=0, help='answer every Nth chunk with a 503')
+    services.add_argument('--telegram-bandwidth', type=float, default=8, help='per Telegram media session')
+    services.add_argument('--telegram-latency', type=float, default=30)
+    services.add_argument('--telegram-flood-every', type=int, default=0, help='FloodWait every Nth part')
+    services.add_argument('--telegram-session-setup', type=float, default=50,
+                          help='time to open a media session for a document upload')
+    services.add_argument('--botapi-latency', type=float, default=30, help='Bot API calls (sendMessage etc.)')
+
+    args = parser.parse_args(argv)
+    if args.scenario == 'compare' and len(args.files_to_compare) != 2:
+        parser.error('compare needs two result files')
+    if args.size is None:
+        args.size = SIZES.get(args.scenario, 0)
+    if args.count is None:
+        args.count = COUNTS.get(args.scenario, 50)
+    return args
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    if args.scenario == 'compare':
+        compare(*args.files_to_compare)
+        return
+
+    del args.files_to_compare
+    report = asyncio.run(run_scenario(args))
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,39 @@
 import os
+import re
+import hmac
+import secrets
+import signal
 import logging
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters
 from telegram.request import HTTPXRequest
 from pyrogram import Client
 from dotenv import load_dotenv
-import aiohttp
+from aiohttp import web
 import asyncio
-from urllib.parse import urlparse, parse_qs
+from urllib.parse import urlparse, parse_qs, parse_qsl, urlencode, urlunparse
 import time
-from database import Database
+import json
+from database import Database, AsyncDatabase
 from google_drive import GoogleDriveUploader
-from config import ADMIN_IDS, PACKAGES
+from downloader import SegmentedDownloader, buffered
+from http_client import HTTPClient
+from scheduler import TransferScheduler, TransferJob
+from telegram_uploader import StreamingTelegramUploader
+from progress import ProgressService, BatchProgress
+from storage import StorageManager
+from lag_monitor import LoopLagMonitor
+from probe import LinkProber
+from web_server import WebServer
+import metrics
+from config import (
+    ADMIN_IDS, PACKAGES, DOWNLOAD_CHUNK_SIZE,
+    GDRIVE_STREAM_UPLOAD, GDRIVE_STREAM_BUFFER, TELEGRAM_STREAM_UPLOAD, DEDUP_ENABLED, DEDUP_TTL_DAYS, DEDUP_MAX_ENTRIES,
+    TELEGRAM_FILE_LIMIT, BATCH_MAX_LINKS, BATCH_PROBE_CONCURRENCY, BATCH_FILE_LIMIT, BATCH_PROBE_BUDGET,
+    QUOTA_RESERVATION_TTL, USE_WEBHOOK, WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_MAX_CONNECTIONS,
+    UPDATE_CONCURRENCY, BOT_ROLE, WORKER_ID, JOB_LEASE_SECONDS, JOB_LEASE_RENEW, JOB_POLL_INTERVAL,
+    REDIRECT_URI, OAUTH_CALLBACK, OAUTH_STATE_TTL, METRICS_HOST, METRICS_PORT, SOURCE_VERIFY_SSL
+)
 
 # Load environment variables
 load_dotenv()
@@ -21,23 +43,47 @@ logging.basicConfig(
     level=logging.INFO
 )
 logger = logging.getLogger(__name__)
-# Initialize Database
-db = Database()
+# Initialize Database (awaitable wrapper, SQLite runs on its own threads)
+db = AsyncDatabase(Database())
 
 class FileUploadBot:
     def __init__(self):
         self.bot_token = os.getenv('BOT_TOKEN')
         self.api_id = int(os.getenv('API_ID'))
         self.api_hash = os.getenv('API_HASH')
-        self.gdrive_uploader = GoogleDriveUploader()
         
-        # Initialize Pyrogram client for file uploads
+        # Shared HTTP connection pool for link probing and downloads
+        self.http = HTTPClient(verify_ssl=SOURCE_VERIFY_SSL)
+        self.prober = LinkProber(self.http)
+        # Drive uploads carry OAuth tokens, so they get their own pool that always verifies certificates
+        self.drive_http = HTTPClient()
+        self.gdrive_uploader = GoogleDriveUploader(on_token_refresh=db.sync.update_gdrive_token, http_client=self.drive_http)
+        self.downloader = SegmentedDownloader()
+        self.scheduler = TransferScheduler()
+        self.storage = StorageManager()
+        
+        # 'all', or 'ingress'/'worker' when updates and transfers run in separate processes
+        self.role = BOT_ROLE
+        self.web = WebServer()
+        self.lease_task = None
+        
+        # Initialize Pyrogram client for file uploads (one session file per worker process)
         self.pyrogram_client = Client(
-            "bot_session",
+            "bot_session" if self.role == 'all' else f"bot_session_{WORKER_ID}",
             api_id=self.api_id,
             api_hash=self.api_hash,
             bot_token=self.bot_token
         )
+        self.telegram_uploader = StreamingTelegramUploader(self.pyrogram_client)
+        self.progress = ProgressService()
+        self.lag_monitor = LoopLagMonitor()
+        self.batches = {}               # batch_id -> BatchProgress of batches being transferred
+        
+        # Local Prometheus endpoint, separate from the public web server
+        self.metrics_web = WebServer(METRICS_HOST, METRICS_PORT)
+        self.metrics_web.add_route('GET', '/metrics', self.handle_metrics)
+        metrics.jobs_queued.func = lambda: sum(len(queue) for queue in self.scheduler.queues.values())
+        metrics.jobs_running.func = lambda: len(self.scheduler.running)
         
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Start command handler"""
@@ -45,8 +91,8 @@ class FileUploadBot:
         user_name = update.effective_user.first_name
         
         # Add user to database if not exists
-        if not db.get_user(user_id):
-            db.add_user(user_id, user_name)
+        if not await db.get_user(user_id):
+            await db.add_user(user_id, user_name)
         
         welcome_message = f"""
 🎉 স্বাগতম {user_name}!
@@ -97,7 +143,7 @@ Google Drive এ আপলোড করতে /login দিয়ে লগই
     async def status_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Show user status and limits"""
         user_id = update.effective_user.id
-        user = db.get_user(user_id)
+        user = await db.get_user(user_id)
         
         if not user:
             await update.message.reply_text("❌ ইউজার পাওয়া যায়নি। /start দিয়ে শুরু করুন।")
@@ -106,7 +152,8 @@ Google Drive এ আপলোড করতে /login দিয়ে লগই
         package_name = user['package']
         package_limit = PACKAGES[package_name]
         used_limit = user['monthly_used']
-        remaining = package_limit - used_limit
+        reserved = user['monthly_reserved']
+        remaining = package_limit - used_limit - reserved
         
         status_text = f"""
 📊 আপনার স্ট্যাটাস
@@ -115,6 +162,7 @@ Google Drive এ আপলোড করতে /login দিয়ে লগই
 📦 প্যাকেজ: {package_name}
 📈 মাসিক লিমিট: {self.format_size(package_limit)}
 📊 ব্যবহৃত: {self.format_size(used_limit)}
+⏳ চলমান আপলোডে: {self.format_size(reserved)}
 ✅ বাকি: {self.format_size(remaining)}
 
 🔄 রিসেট হবে: প্রতি মাসের ১ তারিখে
@@ -135,7 +183,8 @@ Google Drive এ আপলোড করতে /login দিয়ে লগই
             [InlineKeyboardButton("👥 সব ইউজার দেখুন", callback_data="admin_users")],
             [InlineKeyboardButton("📦 প্যাকেজ পরিবর্তন করুন", callback_data="admin_package")],
             [InlineKeyboardButton("🔄 লিমিট রিসেট করুন", callback_data="admin_reset")],
-            [InlineKeyboardButton("📊 পরিসংখ্যান", callback_data="admin_stats")]
+            [InlineKeyboardButton("📊 পরিসংখ্যান", callback_data="admin_stats")],
+            [InlineKeyboardButton("⚙️ আপলোড Queue", callback_data="admin_jobs")]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
         
@@ -150,17 +199,23 @@ Google Drive এ আপলোড করতে /login দিয়ে লগই
         url = update.message.text.strip()
         
         # Check if this is an OAuth callback URL
-        if 'localhost:8080' in url and 'code=' in url:
+        if self.is_oauth_redirect(url):
             await self.handle_oauth_callback(update, context, url)
             return
         
+        # Several links in one message are handled as a batch
+        urls = self.extract_urls(url)
+        if len(urls) > 1:
+            await self.handle_batch(update, urls)
+            return
+        
         # Validate URL
         if not self.is_valid_url(url):
             await update.message.reply_text("❌ অবৈধ লিংক। একটি সঠিক Direct Download Link দিন।")
             return
         
         # Check user exists
-        user = db.get_user(user_id)
+        user = await db.get_user(user_id)
         if not user:
             await update.message.reply_text("❌ ইউজার পাওয়া যায়নি। /start দিয়ে শুরু করুন।")
             return
@@ -175,8 +230,8 @@ Google Drive এ আপলোড করতে /login দিয়ে লগই
             
             # Check monthly limit
             package_limit = PACKAGES[user['package']]
-            if user['monthly_used'] + file_size > package_limit:
-                remaining = package_limit - user['monthly_used']
+            if user['monthly_used'] + user['monthly_reserved'] + file_size > package_limit:
+                remaining = package_limit - user['monthly_used'] - user['monthly_reserved']
                 await status_msg.edit_text(
                     f"❌ মাসিক লিমিট শেষ!\n\n"
                     f"📊 বাকি: {self.format_size(remaining)}\n"
@@ -185,6 +240,9 @@ Google Drive এ আপলোড করতে /login দিয়ে লগই
                 )
                 return
             
+            # Store the link as a pending job so the choice survives restarts
+            job_id = await db.add_job(user_id, update.effective_chat.id, url, file_name, file_size, file_info['etag'])
+            
             # Show file info and options
             size_gb = file_size / (1024**3)
             
@@ -201,32 +259,118 @@ Google Drive এ আপলোড করতে /login দিয়ে লগই
             
             if size_gb < 2:
                 # Under 2GB - Show both options
-                keyboard.append([InlineKeyboardButton("📤 Telegram এ আপলোড করুন", callback_data=f"upload_tg_{user_id}")])
-                keyboard.append([InlineKeyboardButton("☁️ Google Drive এ আপলোড করুন", callback_data=f"upload_gd_{user_id}")])
+                keyboard.append([InlineKeyboardButton("📤 Telegram এ আপলোড করুন", callback_data=f"upload_tg_{job_id}")])
+                keyboard.append([InlineKeyboardButton("☁️ Google Drive এ আপলোড করুন", callback_data=f"upload_gd_{job_id}")])
             else:
                 # Over 2GB - Only Google Drive
-                keyboard.append([InlineKeyboardButton("☁️ Google Drive এ আপলোড করুন", callback_data=f"upload_gd_{user_id}")])
+                keyboard.append([InlineKeyboardButton("☁️ Google Drive এ আপলোড করুন", callback_data=f"upload_gd_{job_id}")])
                 file_info_text += "\n⚠️ ফাইল ২GB এর বেশি, শুধুমাত্র Google Drive এ আপলোড করা যাবে।"
             
             keyboard.append([InlineKeyboardButton("❌ বাতিল করুন", callback_data="cancel")])
             reply_markup = InlineKeyboardMarkup(keyboard)
             
-            # Store URL in context
-            context.user_data['pending_url'] = url
-            context.user_data['file_info'] = file_info
-            
             await status_msg.edit_text(file_info_text, reply_markup=reply_markup)
             
         except Exception as e:
             logger.error(f"Error getting file info: {e}")
             await status_msg.edit_text(f"❌ ফাইল ইনফরমেশন পেতে সমস্যা হয়েছে:\n{str(e)}")
     
+    async def handle_link_file(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Handle a .txt file with one or more download links"""
+        document = update.message.document
+        if document.file_size and document.file_size > BATCH_FILE_LIMIT:
+            await update.message.reply_text("❌ ফাইলটি অনেক বড়। শুধু লিংকের তালিকা সহ ছোট .txt ফাইল পাঠান।")
+            return
+        
+        telegram_file = await document.get_file()
+        content = await telegram_file.download_as_bytearray()
+        urls = self.extract_urls(content.decode('utf-8', errors='ignore'))
+        
+        if not urls:
+            await update.message.reply_text("❌ ফাইলে কোনো লিংক পাওয়া যায়নি।")
+            return
+        
+        await self.handle_batch(update, urls)
+    
+    async def handle_batch(self, update: Update, urls):
+        """Probe many links at once and offer to transfer them as one batch"""
+        user_id = update.effective_user.id
+        
+        user = await db.get_user(user_id)
+        if not user:
+            await update.message.reply_text("❌ ইউজার পাওয়া যায়নি। /start দিয়ে শুরু করুন।")
+            return
+        
+        skipped = max(0, len(urls) - BATCH_MAX_LINKS)
+        urls = urls[:BATCH_MAX_LINKS]
+        status_msg = await update.message.reply_text(f"🔍 {len(urls)}টি লিংক চেক করা হচ্ছে...")
+        
+        # Probe all links concurrently, a few at a time, within one time budget
+        results = await self.prober.probe_many(urls, BATCH_PROBE_CONCURRENCY, BATCH_PROBE_BUDGET)
+        files = [(url, info) for url, info in results if info]
+        failed = len(results) - len(files)
+        
+        if not files:
+            await status_msg.edit_text("❌ কোনো লিংক থেকে ফাইল ইনফরমেশন পাওয়া যায়নি।")
+            return
+        
+        # One quota check for the whole batch
+        total_size = sum(info['size'] for _, info in files)
+        package_limit = PACKAGES[user['package']]
+        if user['monthly_used'] + user['monthly_reserved'] + total_size > package_limit:
+            remaining = package_limit - user['monthly_used'] - user['monthly_reserved']
+            await status_msg.edit_text(
+                f"❌ মাসিক লিমিট শেষ!\n\n"
+                f"📊 বাকি: {self.format_size(remaining)}\n"
+                f"📦 মোট সাইজ: {self.format_size(total_size)}\n\n"
+                f"প্রয়োজন: {self.format_size(total_size - remaining)} বেশি"
+            )
+            return
+        
+        batch_id = await db.add_batch_jobs(
+            user_id, update.effective_chat.id,
+            [(url, info['name'], info['size'], info['etag']) for url, info in files]
+        )
+        
+        text = f"📦 ব্যাচ: {len(files)}টি ফাইল\n📊 মোট সাইজ: {self.format_size(total_size)}\n\n"
+        for _, info in files[:20]:
+            text += f"• {info['name']} ({self.format_size(info['size'])})\n"
+        if len(files) > 20:
+            text += f"... এবং আরো {len(files) - 20}টি ফাইল\n"
+        if failed:
+            text += f"\n⚠️ {failed}টি লিংক চেক করা যায়নি, বাদ দেওয়া হয়েছে।"
+        if skipped:
+            text += f"\n⚠️ একবারে সর্বোচ্চ {BATCH_MAX_LINKS}টি লিংক, বাকি {skipped}টি বাদ দেওয়া হয়েছে।"
+        
+        keyboard = []
+        if all(info['size'] < TELEGRAM_FILE_LIMIT for _, info in files):
+            keyboard.append([InlineKeyboardButton("📤 সব Telegram এ আপলোড করুন", callback_data=f"batch_tg_{batch_id}")])
+        else:
+            text += "\n⚠️ কিছু ফাইল ২GB এর বেশি, শুধুমাত্র Google Drive এ আপলোড করা যাবে।"
+        keyboard.append([InlineKeyboardButton("☁️ সব Google Drive এ আপলোড করুন", callback_data=f"batch_gd_{batch_id}")])
+        keyboard.append([InlineKeyboardButton("❌ বাতিল করুন", callback_data="cancel")])
+        
+        await status_msg.edit_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+    
+    def is_oauth_redirect(self, url):
+        """Check whether url is Google's redirect to REDIRECT_URI with an authorization code"""
+        parsed, expected = urlparse(url), urlparse(REDIRECT_URI)
+        return (
+            parsed.netloc == expected.netloc
+            and parsed.path.rstrip('/') == expected.path.rstrip('/')
+            and 'code' in parse_qs(parsed.query)
+        )
+    
     async def handle_oauth_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE, callback_url: str):
-        """Handle Google OAuth callback URL"""
+        """Handle Google OAuth callback URL pasted into the chat"""
         user_id = update.effective_user.id
         
-        # Check if user was awaiting auth
-        if not context.user_data.get('awaiting_gdrive_auth'):
+        query_params = parse_qs(urlparse(callback_url).query)
+        state = query_params.get('state', [''])[0]
+        
+        # The state proves this user started the login with /login
+        login = await db.pop_oauth_state(state, OAUTH_STATE_TTL)
+        if not login or login['user_id'] != user_id:
             await update.message.reply_text(
                 "❌ OAuth callback expected নয়।\n\n"
                 "প্রথমে /login কমান্ড ব্যবহার করুন।"
@@ -236,24 +380,7 @@ Google Drive এ আপলোড করতে /login দিয়ে লগই
         status_msg = await update.message.reply_text("🔄 Google Drive সংযুক্ত করা হচ্ছে...")
         
         try:
-            # Extract authorization code from URL
-            parsed_url = urlparse(callback_url)
-            query_params = parse_qs(parsed_url.query)
-            
-            if 'code' not in query_params:
-                await status_msg.edit_text("❌ Authorization code পাওয়া যায়নি। আবার চেষ্টা করুন।")
-                return
-            
-            auth_code = query_params['code'][0]
-            
-            # Exchange code for credentials
-            token_dict = self.gdrive_uploader.get_credentials_from_code(auth_code)
-            
-            # Save token to database
-            db.update_gdrive_token(user_id, token_dict)
-            
-            # Clear awaiting flag
-            context.user_data['awaiting_gdrive_auth'] = False
+            await self.complete_gdrive_login(login, query_params['code'][0])
             
             await status_msg.edit_text(
                 "✅ সফলভাবে Google Drive সংযুক্ত হয়েছে!\n\n"
@@ -266,7 +393,59 @@ Google Drive এ আপলোড করতে /login দিয়ে লগই
                 f"❌ Google Drive সংযুক্ত করতে সমস্যা হয়েছে:\n{str(e)}\n\n"
                 "আবার /login কমান্ড দিয়ে চেষ্টা করুন।"
             )
-            context.user_data['awaiting_gdrive_auth'] = False
+    
+    async def complete_gdrive_login(self, login, code):
+        """Exchange the authorization code off the event loop and save the user's token"""
+        token_dict = await self.gdrive_uploader.run_sync(
+            self.gdrive_uploader.get_credentials_from_code, code, login['code_verifier']
+        )
+        await db.update_gdrive_token(login['user_id'], token_dict)
+        self.gdrive_uploader.cache.invalidate(login['user_id'])
+    
+    async def handle_oauth_redirect(self, request):
+        """Google redirects the user's browser here after they answer the consent screen"""
+        login = await db.pop_oauth_state(request.query.get('state', ''), OAUTH_STATE_TTL)
+        if not login:
+            return self.oauth_page("❌ লগইন লিংকের মেয়াদ শেষ হয়ে গেছে। Telegram এ আবার /login দিন।", status=400)
+        
+        code = request.query.get('code')
+        if not code:
+            # The user pressed Cancel, Google sends error=access_denied
+            await self.notify(login['chat_id'], "❌ Google Drive লগইন বাতিল করা হয়েছে।")
+            return self.oauth_page("❌ লগইন বাতিল করা হয়েছে।", status=400)
+        
+        try:
+            await self.complete_gdrive_login(login, code)
+        except Exception as e:
+            logger.error(f"OAuth redirect error: {e}")
+            await self.notify(
+                login['chat_id'],
+                f"❌ Google Drive সংযুক্ত করতে সমস্যা হয়েছে:\n{str(e)}\n\nআবার /login কমান্ড দিয়ে চেষ্টা করুন।"
+            )
+            return self.oauth_page("❌ Google Drive সংযুক্ত করা যায়নি। Telegram এ আবার /login দিন।", status=500)
+        
+        await self.notify(
+            login['chat_id'],
+            "✅ সফলভাবে Google Drive সংযুক্ত হয়েছে!\n\n"
+            "এখন আপনি Google Drive এ ফাইল আপলোড করতে পারবেন।"
+        )
+        return self.oauth_page("✅ Google Drive সংযুক্ত হয়েছে। এখন Telegram এ ফিরে যান।")
+    
+    @staticmethod
+    def oauth_page(message, status=200):
+        return web.Response(
+            text=f"<!DOCTYPE html><html><head><meta charset=\"utf-8\"><title>Google Drive</title></head>"
+                 f"<body style=\"font-family: sans-serif; text-align: center; margin-top: 3em\"><h2>{message}</h2></body></html>",
+            content_type='text/html',
+            status=status
+        )
+    
+    async def notify(self, chat_id, text):
+        """Send a message, logging instead of raising if it can't be delivered"""
+        try:
+            await self.application.bot.send_message(chat_id, text)
+        except Exception as e:
+            logger.error(f"Could not send message to {chat_id}: {e}")
     
     async def button_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle button callbacks"""
@@ -280,6 +459,10 @@ Google Drive এ আপলোড করতে /login দিয়ে লগই
             await query.edit_message_text("❌ বাতিল করা হয়েছে।")
             return
         
+        if data == "gdrive_login":
+            await self.send_login_link(query.message, user_id)
+            return
+        
         # Admin callbacks
         if data.startswith("admin_"):
             if user_id not in ADMIN_IDS:
@@ -293,141 +476,566 @@ Google Drive এ আপলোড করতে /login দিয়ে লগই
         if data.startswith("upload_"):
             await self.handle_upload_callback(query, context)
             return
+        
+        if data.startswith("batch_"):
+            await self.handle_batch_callback(query, context)
+            return
+        
+        # Batch cancel callbacks
+        if data.startswith("batchcancel_"):
+            batch_id = int(data.split('_')[1])
+            batch = self.batches.get(batch_id)
+            cancelled = 0
+            for record in await db.get_batch_jobs(batch_id):
+                if record['user_id'] != user_id:
+                    continue
+                result = await self.cancel_job(record)
+                if not result:
+                    continue
+                cancelled += 1
+                if result == 'cancelled' and batch:
+                    batch.set_line(record['id'], "❌ বাতিল করা হয়েছে")
+                    await batch.item_finished(record['id'])
+            if not batch and cancelled:
+                await query.edit_message_text(f"❌ ব্যাচের {cancelled}টি আপলোড বাতিল করা হয়েছে।")
+            if not cancelled:
+                # The query is already answered above; reply so the batch message stays intact
+                await query.message.reply_text("ℹ️ এই ব্যাচের কোনো আপলোড আর চালু নেই।")
+            return
+        
+        # Job cancel callbacks
+        if data.startswith("jobcancel_"):
+            job_id = int(data.split('_')[1])
+            record = await db.get_job(job_id)
+            if record and record['user_id'] == user_id and await self.cancel_job(record):
+                await query.edit_message_text("❌ আপলোড বাতিল করা হয়েছে।")
+            else:
+                await query.edit_message_text("ℹ️ এই আপলোড আর চালু নেই।")
+            return
     
     async def handle_upload_callback(self, query, context):
         """Handle upload button callbacks"""
         user_id = query.from_user.id
         data = query.data
         
-        url = context.user_data.get('pending_url')
-        file_info = context.user_data.get('file_info')
+        job_id = int(data.split('_')[2])
+        record = await db.get_job(job_id)
         
-        if not url or not file_info:
+        if not record or record['user_id'] != user_id or record['state'] != 'pending':
             await query.edit_message_text("❌ ফাইল ইনফরমেশন পাওয়া যায়নি। আবার চেষ্টা করুন।")
             return
         
         if data.startswith("upload_tg_"):
-            await self.upload_to_telegram(query, url, file_info, user_id)
+            destination = 'telegram'
         elif data.startswith("upload_gd_"):
-            await self.upload_to_gdrive(query, url, file_info, user_id)
+            destination = 'gdrive'
+            
+            user = await db.get_user(user_id)
+            if not user['gdrive_token']:
+                await self.prompt_gdrive_login(query)
+                return
+        else:
+            return
+        
+        # Hold the quota now so parallel transfers can't overshoot the package limit together
+        if not await self.reserve_quota(record):
+            user = await db.get_user(user_id)
+            remaining = PACKAGES[user['package']] - user['monthly_used'] - user['monthly_reserved']
+            await query.edit_message_text(
+                f"❌ মাসিক লিমিট শেষ!\n\n"
+                f"📊 বাকি: {self.format_size(max(0, remaining))}\n"
+                f"📁 ফাইল সাইজ: {self.format_size(record['file_size'])}"
+            )
+            return
+        
+        if not self.runs_transfers:
+            # A worker process picks the job up from the database
+            await db.queue_job(job_id, destination)
+            await query.edit_message_text(
+                f"🕒 Queue এ যোগ করা হয়েছে।\n\n"
+                f"📁 {record['file_name']}\n\n"
+                f"আপলোড শুরু হলে জানানো হবে।",
+                reply_markup=self.job_cancel_markup(job_id)
+            )
+            return
+        
+        await db.queue_job(job_id, destination, WORKER_ID, JOB_LEASE_SECONDS)
+        record = await db.get_job(job_id)
+        
+        job, cancel_markup = self.create_transfer_job(record, query.message)
+        position = await self.scheduler.submit(job)
+        if job.state == 'queued':
+            await query.edit_message_text(
+                f"🕒 Queue এ যোগ করা হয়েছে।\n\n"
+                f"📁 {record['file_name']}\n"
+                f"📍 Queue position: {position}",
+                reply_markup=cancel_markup
+            )
     
-    async def upload_to_telegram(self, query, url, file_info, user_id):
-        """Upload file to Telegram using Pyrogram - OPTIMIZED"""
-        await query.edit_message_text("📥 Telegram এ আপলোড শুরু হচ্ছে...")
+    async def handle_batch_callback(self, query, context):
+        """Queue every pending job of a batch for one destination"""
+        user_id = query.from_user.id
+        data = query.data
         
-        try:
-            # Download file
-            progress_msg = await query.message.reply_text("⏳ ডাউনলোড হচ্ছে... 0%")
-            
-            download_start = time.time()
-            file_path = await self.download_file(url, file_info['name'], progress_msg)
-            download_time = time.time() - download_start
-            
-            download_speed = file_info['size'] / download_time if download_time > 0 else 0
-            logger.info(f"Download completed: {self.format_size(download_speed)}/s")
-            
-            # Upload to Telegram using Pyrogram
-            await progress_msg.edit_text("⏳ Telegram এ আপলোড হচ্ছে...")
+        batch_id = int(data.split('_')[2])
+        records = [
+            record for record in await db.get_batch_jobs(batch_id)
+            if record['user_id'] == user_id and record['state'] == 'pending'
+        ]
+        
+        if not records:
+            await query.edit_message_text("❌ ফাইল ইনফরমেশন পাওয়া যায়নি। আবার চেষ্টা করুন।")
+            return
+        
+        if data.startswith("batch_tg_"):
+            destination = 'telegram'
+        elif data.startswith("batch_gd_"):
+            destination = 'gdrive'
             
-            # Start Pyrogram client if not connected
-            if not self.pyrogram_client.is_connected:
-                await self.pyrogram_client.start()
-                logger.info("Pyrogram client connected for upload")
+            user = await db.get_user(user_id)
+            if not user['gdrive_token']:
+                await self.prompt_gdrive_login(query)
+                return
+        else:
+            return
+        
+        # Files that no longer fit in the quota are left out of the batch
+        reserved = [record for record in records if await self.reserve_quota(record)]
+        if not reserved:
+            await query.edit_message_text("❌ মাসিক লিমিট শেষ! এই ব্যাচের কোনো ফাইল আপলোড করা যাবে না।")
+            return
+        if len(reserved) < len(records):
+            await query.message.reply_text(
+                f"⚠️ মাসিক লিমিটের কারণে {len(records) - len(reserved)}টি ফাইল বাদ দেওয়া হয়েছে।"
+            )
+        records = reserved
+        
+        cancel_markup = InlineKeyboardMarkup([
+            [InlineKeyboardButton("❌ ব্যাচ বাতিল করুন", callback_data=f"batchcancel_{batch_id}")]
+        ])
+        
+        if not self.runs_transfers:
+            # Worker processes pick the jobs up and report on each one separately
+            for record in records:
+                await db.queue_job(record['id'], destination)
+            await query.edit_message_text(
+                f"🕒 {len(records)}টি ফাইল Queue এ যোগ করা হয়েছে।\n\nপ্রতিটি আপলোড শুরু হলে জানানো হবে।",
+                reply_markup=cancel_markup
+            )
+            return
+        
+        batch = BatchProgress(
+            self.progress, query.message, self.render_batch,
+            [(record['id'], record['file_name']) for record in records], cancel_markup
+        )
+        self.batches[batch_id] = batch
+        
+        # Jobs run in order; each hands off its slot once downloaded so the next one overlaps
+        for record in records:
+            await db.queue_job(record['id'], destination, WORKER_ID, JOB_LEASE_SECONDS)
+            job, _ = self.create_transfer_job(await db.get_job(record['id']), None, batch)
+            await self.scheduler.submit(job)
+            batch.set_line(record['id'], f"🕒 Queue position: {self.scheduler.position(job)}")
+    
+    def render_batch(self, batch):
+        """Text of the single progress message of a batch"""
+        finished = len(batch.items) - len(batch.unfinished)
+        text = f"📦 ব্যাচ আপলোড: {finished}/{len(batch.items)} সম্পন্ন\n\n"
+        for job_id, name in batch.items:
+            line = batch.lines.get(job_id, "🕒 অপেক্ষমাণ").replace('\n\n', '\n').replace('\n', ' | ')
+            if len(line) > 160:
+                line = line[:157] + '...'
+            text += f"• {name}\n   {line}\n"
+        
+        # Telegram messages are limited to 4096 characters
+        if len(text) > 4000:
+            text = text[:3997] + '...'
+        return text
+    
+    def create_transfer_job(self, record, status_msg, batch=None):
+        """Wrap a persisted job record into a schedulable TransferJob
+        
+        Jobs of a batch report to their line in the batch message instead of
+        status_msg and have no cancel button of their own.
+        """
+        if record['destination'] == 'telegram':
+            upload = self.upload_to_telegram
+        else:
+            upload = self.upload_to_gdrive
+        
+        if batch:
+            status_msg = batch.item(record['id'])
+            cancel_markup = None
+        else:
+            cancel_markup = self.job_cancel_markup(record['id'])
+        
+        async def run(job):
+            try:
+                await upload(status_msg, await db.get_job(record['id']), reply_markup=cancel_markup)
+            except asyncio.CancelledError:
+                # On shutdown the job stays unfinished so it resumes on next start
+                if not self.scheduler.stopping:
+                    metrics.transfers.inc(destination=record['destination'], result='cancelled')
+                    await self.discard_job(await db.get_job(record['id']))
+                    await status_msg.reply_text(f"❌ আপলোড বাতিল করা হয়েছে: {record['file_name']}")
+                raise
+            finally:
+                if batch and not self.scheduler.stopping:
+                    await batch.item_finished(record['id'])
+                    if not batch.unfinished:
+                        self.batches.pop(record['batch_id'], None)
+        
+        job = TransferJob(record['user_id'], record['destination'], run, name=record['file_name'], job_id=record['id'])
+        return job, cancel_markup
+    
+    @property
+    def runs_transfers(self):
+        """Whether this process runs transfers, ingress processes only queue them"""
+        return self.role != 'ingress'
+    
+    def job_cancel_markup(self, job_id):
+        return InlineKeyboardMarkup([
+            [InlineKeyboardButton("❌ আপলোড বাতিল করুন", callback_data=f"jobcancel_{job_id}")]
+        ])
+    
+    async def cancel_job(self, record):
+        """Cancel a job wherever it runs
+        
+        Returns 'cancelled' if the job never started and is cancelled now,
+        'stopping' if its transfer is being stopped (it cleans up itself), or
+        None if the job is not unfinished.
+        """
+        job = self.scheduler.get_job(record['id'])
+        if job:
+            was_queued = job.state == 'queued'
+            if not await self.scheduler.cancel(job.id):
+                return None
+            if was_queued:
+                await self.discard_job(record)
+                return 'cancelled'
+            return 'stopping'
+        
+        # Not in this process: cancel it in the database or ask its worker to
+        result = await db.request_cancel(record['id'])
+        if result == 'cancelled':
+            await self.discard_job(record)
+            return 'cancelled'
+        return 'stopping' if result else None
+    
+    async def discard_job(self, record):
+        """Mark a job cancelled and drop its partial download and upload session"""
+        await db.update_job(record['id'], state='cancelled')
+        await db.release_quota(record['id'])
+        
+        if record['download_path'] and os.path.exists(record['download_path']):
+            os.remove(record['download_path'])
+        await self.storage.release(record['id'])
+        
+        if record['upload_session_uri']:
+            user = await db.get_user(record['user_id'])
+            try:
+                await self.gdrive_uploader.cancel_upload(
+                    record['upload_session_uri'], user['gdrive_token'], record['user_id']
+                )
+            except Exception as e:
+                logger.debug(f"Could not abort upload session: {e}")
+    
+    async def resume_jobs(self):
+        """Re-queue transfers that were interrupted by a restart"""
+        await db.delete_stale_jobs()
+        await db.evict_dedup_entries(DEDUP_TTL_DAYS)
+        
+        released = await db.sweep_quota_reservations()
+        if released:
+            logger.info(f"Released {released} leftover quota reservations")
+        
+        if not self.runs_transfers:
+            return
+        
+        # Partial downloads of jobs that won't resume are orphans; files of
+        # jobs other workers run are kept too
+        unfinished = await db.get_unfinished_jobs()
+        self.storage.sweep(keep=[record['download_path'] for record in unfinished])
+        
+        # Our own jobs from the last run plus any whose worker went away
+        for record in await db.claim_jobs(WORKER_ID, JOB_LEASE_SECONDS, include_own=True):
+            await self.start_claimed_job(record)
+    
+    async def start_claimed_job(self, record):
+        """Tell the user and queue a job this process has just claimed"""
+        if record['resumed']:
+            text = f"🔄 Bot রিস্টার্ট হয়েছে, আপলোড আবার শুরু হচ্ছে:\n📁 {record['file_name']}"
+        else:
+            text = f"🕒 আপলোড শুরু হচ্ছে:\n📁 {record['file_name']}"
+        
+        try:
+            status_msg = await self.application.bot.send_message(
+                record['chat_id'], text, reply_markup=self.job_cancel_markup(record['id'])
+            )
+        except Exception as e:
+            logger.error(f"Could not notify user {record['user_id']} about job {record['id']}: {e}")
+            await db.update_job(record['id'], state='failed', error=str(e))
+            await db.release_quota(record['id'])
+            return
+        
+        await db.update_job(record['id'], state='queued')
+        job, _ = self.create_transfer_job(record, status_msg)
+        await self.scheduler.submit(job)
+        logger.info(f"Started job {record['id']} ({record['file_name']})")
+    
+    async def lease_loop(self):
+        """Claim queued jobs from the database and keep the leases on ours
+        
+        Ingress processes leave jobs unclaimed; a worker whose lease runs out
+        (crashed or stopped) loses its jobs to the next worker that polls.
+        """
+        last_renew = 0
+        while True:
+            try:
+                local = [job.id for job in self.scheduler.running_jobs() + self.scheduler.queued_jobs()]
+                
+                if time.monotonic() - last_renew >= JOB_LEASE_RENEW:
+                    last_renew = time.monotonic()
+                    for job_id in await db.renew_leases(WORKER_ID, local, JOB_LEASE_SECONDS):
+                        record = await db.get_job(job_id)
+                        if await self.cancel_job(record) == 'cancelled':
+                            await self.application.bot.send_message(
+                                record['chat_id'], f"❌ আপলোড বাতিল করা হয়েছে: {record['file_name']}"
+                            )
+                
+                # Only take as many jobs as there are idle workers, the rest stay for other processes
+                free = self.scheduler.workers - len(local)
+                if free > 0:
+                    for record in await db.claim_jobs(WORKER_ID, JOB_LEASE_SECONDS, limit=free):
+                        await self.start_claimed_job(record)
+            except Exception as e:
+                logger.error(f"Job lease error: {e}")
             
-            # Upload with progress callback
-            last_progress = [0]
-            last_time = [time.time()]
+            await asyncio.sleep(JOB_POLL_INTERVAL)
+    
+    async def reserve_quota(self, record):
+        """Hold the job's file size against the user's package limit, False if it doesn't fit"""
+        user = await db.get_user(record['user_id'])
+        return await db.reserve_quota(
+            record['user_id'], record['id'], record['file_size'], PACKAGES[user['package']], QUOTA_RESERVATION_TTL
+        )
+    
+    async def prompt_gdrive_login(self, query):
+        """Tell the user to connect Google Drive first"""
+        keyboard = [[InlineKeyboardButton("🔗 Login করুন", callback_data="gdrive_login")]]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        await query.edit_message_text(
+            "❌ Google Drive সংযুক্ত নয়।\n\nপ্রথমে /login দিয়ে লগইন করুন।",
+            reply_markup=reply_markup
+        )
+    
+    async def upload_to_telegram(self, status_msg, record, reply_markup=None):
+        """Upload file to Telegram using Pyrogram - OPTIMIZED"""
+        user_id = record['user_id']
+        file_info = {'name': record['file_name'], 'size': record['file_size']}
+        
+        await status_msg.edit_text("📥 Telegram এ আপলোড শুরু হচ্ছে...", reply_markup=reply_markup)
+        
+        try:
+            # Re-send a file already uploaded for the same link
+            if await self.send_cached_to_telegram(record):
+                await db.record_upload(user_id, file_info['name'], file_info['size'], 'telegram', record['id'])
+                await db.update_job(record['id'], state='done')
+                metrics.transfers.inc(destination='telegram', result='cached')
+                await status_msg.reply_text("✅ সফলভাবে Telegram এ পাঠানো হয়েছে! (আগের আপলোড থেকে)")
+                return
             
-            async def progress_callback(current, total):
-                percent = (current / total) * 100
-                current_time = time.time()
-                time_elapsed = current_time - last_time[0]
+            if TELEGRAM_STREAM_UPLOAD and self.telegram_uploader.can_stream(file_info['size']):
+                # Pipe the download straight into Telegram without touching disk
+                progress_msg = await status_msg.reply_text("⏳ Telegram এ স্ট্রিম হচ্ছে... 0%")
                 
-                # Update every 10% or every 2 seconds
-                if (int(percent) - last_progress[0] >= 10) or (time_elapsed >= 2):
-                    last_progress[0] = int(percent)
-                    last_time[0] = current_time
-                    
-                    # Calculate upload speed
-                    speed = current / (current_time - download_start - download_time) if (current_time - download_start - download_time) > 0 else 0
+                upload_start = time.time()
+                message = await self.stream_to_telegram(record, progress_msg)
+                upload_time = time.time() - upload_start
+                self.record_transfer('stream', 'telegram', file_info['size'], upload_time)
+                
+                upload_speed = file_info['size'] / upload_time if upload_time > 0 else 0
+                logger.info(f"Stream upload completed: {self.format_size(upload_speed)}/s")
+                speed_text = f"⚡ Speed: {self.format_size(upload_speed)}/s"
+            else:
+                # Download file
+                progress_msg = await status_msg.reply_text("⏳ ডাউনলোড হচ্ছে... 0%")
+                
+                download_start = time.time()
+                file_path = await self.download_file(record, progress_msg)
+                download_time = time.time() - download_start
+                self.record_transfer('download', 'telegram', file_info['size'], download_time)
+                await self.scheduler.handoff(record['id'])
+                
+                download_speed = file_info['size'] / download_time if download_time > 0 else 0
+                logger.info(f"Download completed: {self.format_size(download_speed)}/s")
+                
+                # Upload to Telegram using Pyrogram
+                await db.update_job(record['id'], state='uploading')
+                await progress_msg.edit_text("⏳ Telegram এ আপলোড হচ্ছে...")
+                
+                # Start Pyrogram client if not connected
+                if not self.pyrogram_client.is_connected:
+                    await self.pyrogram_client.start()
+                    logger.info("Pyrogram client connected for upload")
+                
+                # Send document with optimized settings
+                upload_start = time.time()
+                async with self.progress.tracking(progress_msg, self.progress_renderer("⏳ Telegram এ আপলোড হচ্ছে...")) as progress:
+                    async def progress_callback(current, total):
+                        progress.update(current, total)
                     
-                    try:
-                        await progress_msg.edit_text(
-                            f"⏳ Telegram এ আপলোড হচ্ছে... {int(percent)}%\n"
-                            f"📊 {self.format_size(current)} / {self.format_size(total)}\n"
-                            f"⚡ Speed: {self.format_size(speed)}/s"
-                        )
-                    except Exception as e:
-                        logger.debug(f"Progress update error: {e}")
-            
-            # Send document with optimized settings
-            upload_start = time.time()
-            await self.pyrogram_client.send_document(
-                chat_id=user_id,
-                document=file_path,
-                caption=f"📁 {file_info['name']}\n📊 Size: {self.format_size(file_info['size'])}",
-                progress=progress_callback,
-                file_name=file_info['name']
-            )
-            
-            upload_time = time.time() - upload_start
-            upload_speed = file_info['size'] / upload_time if upload_time > 0 else 0
+                    message = await self.pyrogram_client.send_document(
+                        chat_id=user_id,
+                        document=file_path,
+                        caption=f"📁 {file_info['name']}\n📊 Size: {self.format_size(file_info['size'])}",
+                        progress=progress_callback,
+                        file_name=file_info['name']
+                    )
+                
+                upload_time = time.time() - upload_start
+                self.record_transfer('upload', 'telegram', file_info['size'], upload_time)
+                upload_speed = file_info['size'] / upload_time if upload_time > 0 else 0
+                
+                logger.info(f"Upload completed: {self.format_size(upload_speed)}/s")
+                
+                speed_text = (
+                    f"📥 Download Speed: {self.format_size(download_speed)}/s\n"
+                    f"📤 Upload Speed: {self.format_size(upload_speed)}/s"
+                )
             
-            logger.info(f"Upload completed: {self.format_size(upload_speed)}/s")
+            if message and message.document:
+                await self.remember_upload(record, 'telegram', message.document.file_id)
             
             # Update user usage
-            db.update_monthly_usage(user_id, file_info['size'])
-            db.add_upload_record(user_id, file_info['name'], file_info['size'], 'telegram')
+            await db.record_upload(user_id, file_info['name'], file_info['size'], 'telegram', record['id'])
+            await db.update_job(record['id'], state='done')
+            metrics.transfers.inc(destination='telegram', result='done')
             
-            await progress_msg.edit_text(
-                f"✅ সফলভাবে Telegram এ আপলোড হয়েছে!\n\n"
-                f"📥 Download Speed: {self.format_size(download_speed)}/s\n"
-                f"📤 Upload Speed: {self.format_size(upload_speed)}/s"
-            )
+            await progress_msg.edit_text(f"✅ সফলভাবে Telegram এ আপলোড হয়েছে!\n\n{speed_text}")
             
             # Delete temporary file
-            if os.path.exists(file_path):
-                os.remove(file_path)
+            await self.release_download(record['id'])
             
         except Exception as e:
             logger.error(f"Telegram upload error: {e}")
-            await query.message.reply_text(f"❌ আপলোড ব্যর্থ হয়েছে:\n{str(e)}")
-        finally:
-            pass
+            metrics.transfers.inc(destination='telegram', result='failed')
+            await db.update_job(record['id'], state='failed', error=str(e))
+            await db.release_quota(record['id'])
+            await self.release_download(record['id'])
+            await status_msg.reply_text(f"❌ আপলোড ব্যর্থ হয়েছে:\n{str(e)}")
+    
+    async def release_download(self, job_id):
+        """Delete a job's downloaded file and give back its reserved disk space"""
+        job = await db.get_job(job_id)
+        if job and job['download_path'] and os.path.exists(job['download_path']):
+            os.remove(job['download_path'])
+        await self.storage.release(job_id)
+    
+    def record_transfer(self, stage, destination, size, seconds):
+        """Count a finished download/upload stage in the transfer metrics"""
+        metrics.transfer_bytes.inc(size, stage=stage, destination=destination)
+        if size and seconds > 0:
+            metrics.transfer_speed.observe(size / seconds, stage=stage, destination=destination)
+    
+    async def stream_to_telegram(self, record, progress_msg):
+        """Stream a file from URL directly into a Telegram document upload
+        
+        Not resumable: a restarted job streams the file again from the start.
+        """
+        await db.update_job(record['id'], state='uploading')
+        await self.initialize_pyrogram()
+        
+        session = await self.http.get_session()
+        renderer = self.progress_renderer("⏳ Telegram এ স্ট্রিম হচ্ছে...")
+        async with session.get(url=self.prober.resolved(record['url'])) as response, self.progress.tracking(progress_msg, renderer) as progress:
+            response.raise_for_status()
+            total_size = int(response.headers.get('Content-Length', 0)) or record['file_size']
+            
+            await db.update_job(
+                record['id'],
+                etag=response.headers.get('ETag'),
+                last_modified=response.headers.get('Last-Modified')
+            )
+            
+            return await self.telegram_uploader.send_stream(
+                record['user_id'],
+                response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE),
+                total_size,
+                record['file_name'],
+                caption=f"📁 {record['file_name']}\n📊 Size: {self.format_size(total_size)}",
+                progress=self.upload_progress_callback(progress)
+            )
     
-    async def upload_to_gdrive(self, query, url, file_info, user_id):
+    async def upload_to_gdrive(self, status_msg, record, reply_markup=None):
         """Upload file to Google Drive"""
-        user = db.get_user(user_id)
+        user_id = record['user_id']
+        file_info = {'name': record['file_name'], 'size': record['file_size']}
+        user = await db.get_user(user_id)
         
         if not user['gdrive_token']:
-            keyboard = [[InlineKeyboardButton("🔗 Login করুন", callback_data="gdrive_login")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text(
-                "❌ Google Drive সংযুক্ত নয়।\n\nপ্রথমে /login দিয়ে লগইন করুন।",
-                reply_markup=reply_markup
-            )
+            await db.update_job(record['id'], state='failed', error='Google Drive not connected')
+            metrics.transfers.inc(destination='gdrive', result='failed')
+            await db.release_quota(record['id'])
+            await status_msg.edit_text("❌ Google Drive সংযুক্ত নয়।\n\nপ্রথমে /login দিয়ে লগইন করুন।")
             return
         
-        await query.edit_message_text("☁️ Google Drive এ আপলোড শুরু হচ্ছে...")
+        await status_msg.edit_text("☁️ Google Drive এ আপলোড শুরু হচ্ছে...", reply_markup=reply_markup)
+        
+        async def save_session(session_uri):
+            await db.update_job(record['id'], upload_session_uri=session_uri)
         
         try:
-            progress_msg = await query.message.reply_text("⏳ ডাউনলোড হচ্ছে... 0%")
+            # Copy a file already uploaded for the same link
+            result = await self.copy_cached_to_gdrive(record, user['gdrive_token'])
+            if result:
+                await db.record_upload(user_id, file_info['name'], file_info['size'], 'gdrive', record['id'])
+                await db.update_job(record['id'], state='done')
+                metrics.transfers.inc(destination='gdrive', result='cached')
+                await status_msg.reply_text(
+                    f"✅ সফলভাবে Google Drive এ আপলোড হয়েছে! (আগের আপলোড থেকে কপি)\n\n"
+                    f"🔗 লিংক: {result['webViewLink']}"
+                )
+                return
             
-            # Download file
-            file_path = await self.download_file(url, file_info['name'], progress_msg)
+            progress_msg = await status_msg.reply_text("⏳ ডাউনলোড হচ্ছে... 0%")
             
-            # Upload to Google Drive
-            await progress_msg.edit_text("⏳ Google Drive এ আপলোড হচ্ছে...")
+            if GDRIVE_STREAM_UPLOAD:
+                # Pipe the download straight into Drive without touching disk
+                stream_start = time.time()
+                result = await self.stream_to_gdrive(record, user['gdrive_token'], progress_msg, save_session)
+                self.record_transfer('stream', 'gdrive', file_info['size'], time.time() - stream_start)
+            else:
+                # Download file
+                download_start = time.time()
+                file_path = await self.download_file(record, progress_msg)
+                self.record_transfer('download', 'gdrive', file_info['size'], time.time() - download_start)
+                await self.scheduler.handoff(record['id'])
+                
+                # Upload to Google Drive
+                await db.update_job(record['id'], state='uploading')
+                await progress_msg.edit_text("⏳ Google Drive এ আপলোড হচ্ছে...")
+                
+                session_uri = (await db.get_job(record['id']))['upload_session_uri']
+                upload_start = time.time()
+                async with self.progress.tracking(progress_msg, self.progress_renderer("⏳ Google Drive এ আপলোড হচ্ছে...")) as progress:
+                    result = await self.gdrive_uploader.upload_file(
+                        file_path,
+                        file_info['name'],
+                        user['gdrive_token'],
+                        progress=self.upload_progress_callback(progress, record['id']),
+                        user_id=user_id,
+                        session_uri=session_uri,
+                        on_session=save_session
+                    )
+                self.record_transfer('upload', 'gdrive', file_info['size'], time.time() - upload_start)
             
-            result = await self.gdrive_uploader.upload_file(
-                file_path,
-                file_info['name'],
-                user['gdrive_token']
-            )
+            await self.remember_upload(record, 'gdrive', result['id'])
             
             # Update user usage
-            db.update_monthly_usage(user_id, file_info['size'])
-            db.add_upload_record(user_id, file_info['name'], file_info['size'], 'gdrive')
+            await db.record_upload(user_id, file_info['name'], file_info['size'], 'gdrive', record['id'])
+            await db.update_job(record['id'], state='done')
+            metrics.transfers.inc(destination='gdrive', result='done')
             
             await progress_msg.edit_text(
                 f"✅ সফলভাবে Google Drive এ আপলোড হয়েছে!\n\n"
@@ -435,29 +1043,239 @@ Google Drive এ আপলোড করতে /login দিয়ে লগই
             )
             
             # Delete temporary file
-            if os.path.exists(file_path):
-                os.remove(file_path)
+            await self.release_download(record['id'])
             
         except Exception as e:
             logger.error(f"Google Drive upload error: {e}")
-            await query.message.reply_text(f"❌ আপলোড ব্যর্থ হয়েছে:\n{str(e)}")
+            metrics.transfers.inc(destination='gdrive', result='failed')
+            await db.update_job(record['id'], state='failed', error=str(e))
+            await db.release_quota(record['id'])
+            await self.release_download(record['id'])
+            await status_msg.reply_text(f"❌ আপলোড ব্যর্থ হয়েছে:\n{str(e)}")
+    
+    def extract_urls(self, text):
+        """Find the http(s) links in text, in order and without duplicates"""
+        urls = []
+        for match in re.findall(r'https?://\S+', text):
+            url = match.rstrip('.,;:!?)]}>\'"')
+            if url not in urls and self.is_valid_url(url):
+                urls.append(url)
+        return urls
+
+    def normalize_url(self, url):
+        """Normalize a URL for the dedup cache key
+        
+        Lowercases scheme and host, drops default ports and the fragment, and
+        sorts query parameters so equivalent links share one entry.
+        """
+        parsed = urlparse(url)
+        scheme = parsed.scheme.lower()
+        netloc = parsed.hostname or ''
+        if parsed.port and (scheme, parsed.port) not in (('http', 80), ('https', 443)):
+            netloc += f":{parsed.port}"
+        query = urlencode(sorted(parse_qsl(parsed.query, keep_blank_values=True)))
+        return urlunparse((scheme, netloc, parsed.path or '/', '', query, ''))
+    
+    async def find_cached_upload(self, record, destination):
+        """Look up a previous upload of the job's URL that still matches the source
+        
+        An entry is only used when the size matches and, if both sides have one,
+        the ETag too; a mismatch means the file behind the link changed, so the
+        entry is dropped. Drive copies need read access under the drive.file
+        scope, so Drive entries are kept per user.
+        """
+        if not DEDUP_ENABLED:
+            return None
+        
+        url_key = self.normalize_url(record['url'])
+        owner_id = record['user_id'] if destination == 'gdrive' else 0
+        entry = await db.get_dedup_entry(url_key, destination, owner_id)
+        
+        if entry:
+            size_ok = record['file_size'] > 0 and entry['file_size'] == record['file_size']
+            etag_ok = not (entry['etag'] and record['etag']) or entry['etag'] == record['etag']
+            if not (size_ok and etag_ok):
+                await db.delete_dedup_entry(url_key, destination, owner_id)
+                entry = None
+        
+        if entry is None:
+            await db.count_dedup_miss()
+        return entry
+    
+    async def remember_upload(self, record, destination, file_ref):
+        """Store a finished upload in the dedup cache"""
+        if not DEDUP_ENABLED or not record['file_size']:
+            return
+        
+        # The download may have picked up validators the link check didn't have
+        job = await db.get_job(record['id'])
+        owner_id = record['user_id'] if destination == 'gdrive' else 0
+        await db.save_dedup_entry(
+            self.normalize_url(record['url']), destination, file_ref,
+            record['file_size'], job['etag'], owner_id, DEDUP_MAX_ENTRIES
+        )
+    
+    async def send_cached_to_telegram(self, record):
+        """Re-send a cached Telegram file_id, returns True if it was sent"""
+        entry = await self.find_cached_upload(record, 'telegram')
+        if not entry:
+            return False
+        
+        try:
+            await self.initialize_pyrogram()
+            await self.pyrogram_client.send_document(
+                chat_id=record['user_id'],
+                document=entry['file_ref'],
+                caption=f"📁 {record['file_name']}\n📊 Size: {self.format_size(record['file_size'])}"
+            )
+        except Exception as e:
+            # file_id no longer valid, fall back to a full transfer
+            logger.warning(f"Cached Telegram file for job {record['id']} failed: {e}")
+            await db.delete_dedup_entry(entry['url_key'], 'telegram', 0)
+            return False
+        
+        await db.use_dedup_entry(entry['url_key'], 'telegram', 0)
+        logger.info(f"Job {record['id']} served from dedup cache (telegram)")
+        return True
+    
+    async def copy_cached_to_gdrive(self, record, token_dict):
+        """Copy a cached Drive file server-side, returns the new file or None"""
+        entry = await self.find_cached_upload(record, 'gdrive')
+        if not entry:
+            return None
+        
+        try:
+            result = await self.gdrive_uploader.copy_file(
+                entry['file_ref'], record['file_name'], token_dict, record['user_id']
+            )
+        except Exception as e:
+            # Source file was deleted or is no longer readable
+            logger.warning(f"Cached Drive file for job {record['id']} failed: {e}")
+            await db.delete_dedup_entry(entry['url_key'], 'gdrive', entry['owner_id'])
+            return None
+        
+        await db.use_dedup_entry(entry['url_key'], 'gdrive', entry['owner_id'])
+        logger.info(f"Job {record['id']} served from dedup cache (gdrive)")
+        return result
+    
+    def progress_renderer(self, label):
+        """Build a render function for the progress service"""
+        def render(progress):
+            text = label
+            if progress.total:
+                text += f" {int(progress.percent)}%"
+            text += (
+                f"\n📊 {self.format_size(progress.done)} / {self.format_size(progress.total)}\n"
+                f"⚡ Speed: {self.format_size(progress.speed)}/s"
+            )
+            if progress.eta is not None:
+                text += f"\n⏱ বাকি সময়: {self.format_duration(progress.eta)}"
+            
+            # Show per-connection progress for segmented downloads
+            segments = progress.extra.get('segments')
+            if segments and len(segments) > 1:
+                text += f"\n\n🔀 {len(segments)} connections:\n"
+                for segment in segments:
+                    percent = int(segment.downloaded / segment.size * 100)
+                    text += f"#{segment.index + 1} {self.progress_bar(percent)} {percent}%\n"
+            return text
+        
+        return render
+    
+    def upload_progress_callback(self, progress, job_id=None):
+        """Build an upload progress callback that publishes to progress"""
+        async def progress_callback(uploaded, total_size):
+            # Checkpoint committed bytes for resuming after a restart
+            if job_id:
+                await db.update_job(job_id, uploaded_bytes=uploaded)
+            progress.update(uploaded, total_size or 0)
+        
+        return progress_callback
+    
+    async def stream_to_gdrive(self, record, token_dict, progress_msg, on_session=None):
+        """Stream a file from URL directly into a Google Drive resumable upload
+        
+        An upload session left by an interrupted job is continued by requesting
+        the source from the committed offset, as long as the source is unchanged.
+        """
+        user_id = record['user_id']
+        
+        await db.update_job(record['id'], state='uploading')
+        
+        session_uri, offset = record['upload_session_uri'], 0
+        if session_uri:
+            offset, result = await self.gdrive_uploader.resume_upload(session_uri, token_dict, user_id=user_id)
+            if result is not None:
+                return result
+            if offset is None:
+                session_uri, offset = None, 0
+        
+        headers = {}
+        if offset:
+            headers['Range'] = f'bytes={offset}-'
+            if record['etag'] or record['last_modified']:
+                headers['If-Range'] = record['etag'] or record['last_modified']
+        
+        session = await self.http.get_session()
+        renderer = self.progress_renderer("☁️ Google Drive এ স্ট্রিম হচ্ছে...")
+        async with session.get(url=self.prober.resolved(record['url']), headers=headers) as response, self.progress.tracking(progress_msg, renderer) as progress:
+            response.raise_for_status()
+            
+            if offset and response.status != 206:
+                # Source changed or ignores ranges, start a fresh upload
+                logger.info(f"Job {record['id']}: source can't be resumed, restarting upload")
+                session_uri, offset = None, 0
+            
+            if response.status == 206:
+                # "bytes N-M/*" or no Content-Range at all: keep the size known from the probe
+                total = response.headers.get('Content-Range', '').split('/')[-1]
+                total_size = int(total) if total.isdigit() else record['file_size'] or None
+            else:
+                total_size = int(response.headers.get('Content-Length', 0)) or None
+            
+            await db.update_job(
+                record['id'],
+                etag=response.headers.get('ETag'),
+                last_modified=response.headers.get('Last-Modified')
+            )
+            
+            chunks = buffered(
+                response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE),
+                GDRIVE_STREAM_BUFFER
+            )
+            
+            return await self.gdrive_uploader.upload_stream(
+                chunks,
+                record['file_name'],
+                token_dict,
+                total_size=total_size,
+                progress=self.upload_progress_callback(progress, record['id']),
+                user_id=user_id,
+                session_uri=session_uri,
+                offset=offset,
+                on_session=on_session
+            )
     
     async def handle_admin_callback(self, query, context):
         """Handle admin panel callbacks"""
         data = query.data
         
         if data == "admin_users":
-            users = db.get_all_users()
-            text = "👥 সব ইউজার:\n\n"
-            for user in users[:20]:
-                text += f"• {user['name']} (ID: {user['user_id']})\n"
-                text += f"  📦 {user['package']} | 📊 {self.format_size(user['monthly_used'])}\n\n"
-            if len(users) > 20:
-                text += f"\n... এবং আরো {len(users) - 20} জন ইউজার"
-            await query.edit_message_text(text)
+            await self.show_users_page(query)
+        
+        elif data.startswith("admin_users_"):
+            # admin_users_<n|p>_<created_at>|<user_id>
+            _, _, direction, key = data.split('_', 3)
+            created_at, user_id = key.rsplit('|', 1)
+            await self.show_users_page(
+                query,
+                (created_at, int(user_id)),
+                'next' if direction == 'n' else 'prev'
+            )
         
         elif data == "admin_stats":
-            stats = db.get_statistics()
+            stats = await db.get_statistics()
+            cache_stats = self.gdrive_uploader.get_cache_stats()
             text = f"""
 📊 পরিসংখ্যান
 
@@ -465,6 +1283,38 @@ Google Drive এ আপলোড করতে /login দিয়ে লগই
 📤 মোট আপলোড: {stats['total_uploads']}
 💾 মোট ডাটা: {self.format_size(stats['total_data'])}
 """
+            labels = {'telegram': '📱 Telegram', 'gdrive': '☁️ Google Drive'}
+            for destination, totals in stats['destinations'].items():
+                label = labels.get(destination, destination)
+                text += f"{label}: {totals['count']}টি, {self.format_size(totals['bytes'])}\n"
+            
+            if stats['daily']:
+                text += "\n📅 গত ৭ দিন:\n"
+                for day, count, size in stats['daily']:
+                    text += f"• {day}: {count}টি, {self.format_size(size)}\n"
+            
+            text += f"\n☁️ Drive cache: {cache_stats['hits']} hit / {cache_stats['misses']} miss, {cache_stats['refreshes']} refresh\n"
+            
+            lookups = stats['dedup_hits'] + stats['dedup_misses']
+            hit_rate = stats['dedup_hits'] / lookups * 100 if lookups else 0
+            text += f"♻️ Dedup: {stats['dedup_hits']} hit / {stats['dedup_misses']} miss ({hit_rate:.0f}%)\n"
+            
+            lag = self.lag_monitor.get_stats()
+            text += f"🕒 Loop lag: avg {lag['avg'] * 1000:.0f} ms, max {lag['recent_max'] * 1000:.0f} ms\n"
+            text += self.metrics_summary()
+            await query.edit_message_text(text)
+        
+        elif data == "admin_jobs":
+            running = self.scheduler.running_jobs()
+            queued = self.scheduler.queued_jobs()
+            text = f"⚙️ আপলোড Queue\n\n▶️ চলছে: {len(running)} | 🕒 অপেক্ষমাণ: {len(queued)}\n\n"
+            for job in running[:10]:
+                elapsed = int(time.time() - job.started_at)
+                text += f"▶️ #{job.id} {job.name} ({job.destination}) - User {job.user_id}, {elapsed}s\n"
+            for job in queued[:10]:
+                text += f"🕒 #{job.id} {job.name} ({job.destination}) - User {job.user_id}, position {self.scheduler.position(job)}\n"
+            if len(queued) > 10:
+                text += f"\n... এবং আরো {len(queued) - 10}টি জব"
             await query.edit_message_text(text)
         
         elif data == "admin_reset":
@@ -479,115 +1329,133 @@ Google Drive এ আপলোড করতে /login দিয়ে লগই
             )
         
         elif data == "admin_reset_confirm":
-            db.reset_monthly_usage()
+            await db.reset_monthly_usage()
             await query.edit_message_text("✅ সব ইউজারের মাসিক লিমিট রিসেট হয়ে গেছে!")
     
-    async def get_file_info(self, url):
-        """Get file information from URL"""
-        import ssl
+    def metrics_summary(self):
+        """Compact view of this process' metrics for the admin stats panel"""
+        text = "\n📈 Metrics (এই প্রসেস):\n"
         
-        # Create SSL context that doesn't verify certificates (for Termux compatibility)
-        ssl_context = ssl.create_default_context()
-        ssl_context.check_hostname = False
-        ssl_context.verify_mode = ssl.CERT_NONE
+        labels = {'telegram': '📱 Telegram', 'gdrive': '☁️ Google Drive'}
+        stages = {'download': '⬇️', 'upload': '⬆️', 'stream': '🔀'}
+        for destination, label in labels.items():
+            parts = []
+            for stage, icon in stages.items():
+                median = metrics.transfer_speed.quantile(0.5, stage=stage, destination=destination)
+                if median is not None:
+                    parts.append(f"{icon} {self.format_size(median)}/s")
+            done = metrics.transfers.get(destination=destination, result='done')
+            failed = metrics.transfers.get(destination=destination, result='failed')
+            if parts or done or failed:
+                text += f"{label}: {' '.join(parts) or '-'} (✅ {done} / ❌ {failed})\n"
         
-        connector = aiohttp.TCPConnector(ssl=ssl_context)
+        latencies = [
+            ('🔎 Probe', metrics.probe_latency.quantile(0.95)),
+            ('☁️ Drive API', metrics.gdrive_latency.quantile(0.95)),
+            ('🗄 DB', metrics.db_latency.quantile(0.95)),
+            ('🕒 Loop lag', metrics.loop_lag.quantile(0.95))
+        ]
+        latencies = [f"{name} {value * 1000:.0f} ms" for name, value in latencies if value is not None]
+        if latencies:
+            text += "p95: " + ", ".join(latencies) + "\n"
+        text += f"⚙️ Queue: {metrics.jobs_queued.get()} অপেক্ষমাণ, {metrics.jobs_running.get()} চলছে\n"
+        return text
+    
+    async def show_users_page(self, query, cursor_key=None, direction='next'):
+        """Show one page of the admin user list with next/prev buttons"""
+        page = await db.get_users_page(cursor_key, direction, limit=20)
+        users = page['users']
         
-        async with aiohttp.ClientSession(connector=connector) as session:
-            try:
-                async with session.head(url, allow_redirects=True, timeout=aiohttp.ClientTimeout(total=30)) as response:
-                    size = int(response.headers.get('Content-Length', 0))
-                    
-                    if size == 0:
-                        # Try GET request for first few bytes
-                        async with session.get(url, headers={'Range': 'bytes=0-1'}) as get_response:
-                            content_range = get_response.headers.get('Content-Range', '')
-                            if content_range:
-                                size = int(content_range.split('/')[-1])
-                    
-                    # Get filename from URL or Content-Disposition
-                    filename = None
-                    if 'Content-Disposition' in response.headers:
-                        content_disp = response.headers['Content-Disposition']
-                        if 'filename=' in content_disp:
-                            filename = content_disp.split('filename=')[1].strip('"')
-                    
-                    if not filename:
-                        filename = os.path.basename(urlparse(url).path) or 'downloaded_file'
-                    
-                    return {
-                        'name': filename,
-                        'size': size
-                    }
-            except ssl.SSLError as e:
-                logger.error(f"SSL Error: {e}")
-                raise Exception("SSL সমস্যা। Termux packages update করুন: pkg update && pkg upgrade")
-            except Exception as e:
-                logger.error(f"Error getting file info: {e}")
-                raise
+        text = f"👥 সব ইউজার (মোট {await db.count_users()} জন):\n\n"
+        for user in users:
+            text += f"• {user['name']} (ID: {user['user_id']})\n"
+            text += f"  📦 {user['package']} | 📊 {self.format_size(user['monthly_used'])}\n\n"
+        
+        buttons = []
+        if users and page['has_prev']:
+            first = users[0]
+            buttons.append(InlineKeyboardButton(
+                "⬅️ আগের পাতা", callback_data=f"admin_users_p_{first['created_at']}|{first['user_id']}"
+            ))
+        if users and page['has_next']:
+            last = users[-1]
+            buttons.append(InlineKeyboardButton(
+                "পরের পাতা ➡️", callback_data=f"admin_users_n_{last['created_at']}|{last['user_id']}"
+            ))
+        
+        reply_markup = InlineKeyboardMarkup([buttons]) if buttons else None
+        await query.edit_message_text(text, reply_markup=reply_markup)
     
-    async def download_file(self, url, filename, progress_msg):
-        """Download file from URL with progress - OPTIMIZED for high speed"""
+    async def get_file_info(self, url):
+        """Get file information from URL (cached for a few minutes)"""
         import ssl
         
-        download_path = f"downloads/{filename}"
-        os.makedirs("downloads", exist_ok=True)
-        
-        # Create SSL context for Termux compatibility
-        ssl_context = ssl.create_default_context()
-        ssl_context.check_hostname = False
-        ssl_context.verify_mode = ssl.CERT_NONE
-        
-        # Optimized connector settings for high-speed downloads
-        connector = aiohttp.TCPConnector(
-            ssl=ssl_context,
-            limit=100,
-            limit_per_host=10,
-            ttl_dns_cache=300,
-            force_close=False,
-            enable_cleanup_closed=True
-        )
+        try:
+            return await self.prober.probe(url)
+        except ssl.SSLError as e:
+            logger.error(f"SSL Error: {e}")
+            raise Exception("SSL সমস্যা। Termux packages update করুন: pkg update && pkg upgrade (অথবা .env এ SOURCE_VERIFY_SSL=False দিন)")
+        except Exception as e:
+            logger.error(f"Error getting file info: {e}")
+            raise
+    
+    async def download_file(self, record, progress_msg):
+        """Download a job's file from URL with progress - OPTIMIZED for high speed
         
-        last_time = time.time()
+        Segment offsets and validators are checkpointed to the job record so an
+        interrupted download continues where it stopped.
+        """
+        async def wait_for_space():
+            await progress_msg.edit_text("💾 ডিস্কে জায়গা খালি হওয়ার অপেক্ষায়...")
         
-        # Use larger timeout for high-speed connections
-        timeout = aiohttp.ClientTimeout(
-            total=None,
-            connect=30,
-            sock_read=60
+        # Unique per-job path with the file's size reserved on disk
+        download_path = await self.storage.reserve(
+            record['id'], record['file_size'], record['file_name'], record['download_path'], wait_for_space
         )
         
-        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
-            async with session.get(url) as response:
-                total_size = int(response.headers.get('Content-Length', 0))
-                downloaded = 0
-                
-                # Use 10MB chunks for faster download (instead of 1MB)
-                chunk_size = 10 * 1024 * 1024
-                
-                with open(download_path, 'wb') as f:
-                    async for chunk in response.content.iter_chunked(chunk_size):
-                        f.write(chunk)
-                        downloaded += len(chunk)
-                        
-                        # Update progress every 3 seconds
-                        current_time = time.time()
-                        if total_size > 0:
-                            progress = (downloaded / total_size) * 100
-                            time_elapsed = current_time - last_time
-                            
-                            # Calculate download speed
-                            if time_elapsed >= 3:
-                                speed = downloaded / time_elapsed if time_elapsed > 0 else 0
-                                try:
-                                    await progress_msg.edit_text(
-                                        f"⏳ ডাউনলোড হচ্ছে... {int(progress)}%\n"
-                                        f"📊 {self.format_size(downloaded)} / {self.format_size(total_size)}\n"
-                                        f"⚡ Speed: {self.format_size(speed)}/s"
-                                    )
-                                    last_time = current_time
-                                except Exception as e:
-                                    logger.debug(f"Progress update error: {e}")
+        state = {
+            'size': record['file_size'],
+            'etag': record['etag'],
+            'last_modified': record['last_modified'],
+            'segments': json.loads(record['segments']) if record['segments'] else None
+        }
+        await db.update_job(record['id'], state='downloading', download_path=download_path)
+        
+        last_checkpoint = [time.time()]
+        
+        async def progress_callback(downloaded, total_size, segments):
+            progress.update(downloaded, total_size, segments=segments)
+            
+            # Checkpoint segment offsets every 3 seconds for resuming after a restart
+            current_time = time.time()
+            if not state['segments'] or current_time - last_checkpoint[0] < 3:
+                return
+            last_checkpoint[0] = current_time
+            
+            state['segments'] = [[s.start, s.end, s.downloaded] for s in segments]
+            await db.update_job(
+                record['id'],
+                downloaded_bytes=downloaded,
+                segments=json.dumps(state['segments']),
+                etag=state['etag'],
+                last_modified=state['last_modified']
+            )
+        
+        # A fresh probe from the file info step saves resolving redirects and probing again
+        info = self.prober.cached(record['url'])
+        url = info['url'] if info else record['url']
+        
+        session = await self.http.get_session()
+        async with self.progress.tracking(progress_msg, self.progress_renderer("⏳ ডাউনলোড হচ্ছে...")) as progress:
+            await self.downloader.download(session, url, download_path, progress_callback, state, info)
+        
+        await db.update_job(
+            record['id'],
+            downloaded_bytes=state['size'],
+            segments=json.dumps(state['segments']) if state['segments'] else None,
+            etag=state['etag'],
+            last_modified=state['last_modified']
+        )
         
         return download_path
     
@@ -599,6 +1467,22 @@ Google Drive এ আপলোড করতে /login দিয়ে লগই
         except:
             return False
     
+    def progress_bar(self, percent, width=10):
+        """Render a text progress bar"""
+        filled = int(width * percent / 100)
+        return '▰' * filled + '▱' * (width - filled)
+    
+    def format_duration(self, seconds):
+        """Format seconds as h/m/s"""
+        seconds = int(seconds)
+        hours, seconds = divmod(seconds, 3600)
+        minutes, seconds = divmod(seconds, 60)
+        if hours:
+            return f"{hours}h {minutes}m"
+        if minutes:
+            return f"{minutes}m {seconds}s"
+        return f"{seconds}s"
+    
     def format_size(self, size_bytes):
         """Format bytes to human readable size"""
         for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
@@ -612,7 +1496,7 @@ Google Drive এ আপলোড করতে /login দিয়ে লগই
         user_id = update.effective_user.id
         
         # Check if user already has token
-        user = db.get_user(user_id)
+        user = await db.get_user(user_id)
         if user and user['gdrive_token']:
             await update.message.reply_text(
                 "✅ আপনি ইতিমধ্যে Google Drive এ লগইন করা আছেন!\n\n"
@@ -620,12 +1504,31 @@ Google Drive এ আপলোড করতে /login দিয়ে লগই
             )
             return
         
-        auth_url = self.gdrive_uploader.get_auth_url(user_id)
+        await self.send_login_link(update.message, user_id)
+    
+    async def send_login_link(self, message, user_id):
+        """Start a Google login for user_id and reply to message with the link"""
+        # A random state ties Google's redirect to this user and can be used once
+        state = secrets.token_urlsafe(24)
+        auth_url, code_verifier = self.gdrive_uploader.get_auth_url(state)
+        await db.save_oauth_state(state, user_id, message.chat_id, code_verifier)
         
         keyboard = [[InlineKeyboardButton("🔗 Google এ লগইন করুন", url=auth_url)]]
         reply_markup = InlineKeyboardMarkup(keyboard)
         
-        await update.message.reply_text(
+        if OAUTH_CALLBACK:
+            await message.reply_text(
+                "☁️ Google Drive এক্সেস দিতে নিচের পদক্ষেপ অনুসরণ করুন:\n\n"
+                "১. নিচের বাটন ক্লিক করুন\n"
+                "২. Google account select করুন\n"
+                "৩. 'Continue' ক্লিক করুন (যদি unsafe warning দেখেন)\n"
+                "৪. 'Allow' করুন\n\n"
+                f"✅ লগইন শেষ হলে bot নিজেই আপনাকে জানিয়ে দেবে। লিংকটি {OAUTH_STATE_TTL} মিনিট কাজ করবে।",
+                reply_markup=reply_markup
+            )
+            return
+        
+        await message.reply_text(
             "☁️ Google Drive এক্সেস দিতে নিচের পদক্ষেপ অনুসরণ করুন:\n\n"
             "১. নিচের বাটন ক্লিক করুন\n"
             "২. Google account select করুন\n"
@@ -634,17 +1537,15 @@ Google Drive এ আপলোড করতে /login দিয়ে লগই
             "৫. Redirect হওয়ার পর URL টি সম্পূর্ণ কপি করুন\n"
             "৬. এই bot এ URL টি পাঠান\n\n"
             "📝 URL দেখতে এরকম হবে:\n"
-            "http://localhost:8080/?state=...&code=...",
+            f"{REDIRECT_URI}?state=...&code=...",
             reply_markup=reply_markup
         )
-        
-        # Mark user as waiting for auth code
-        context.user_data['awaiting_gdrive_auth'] = True
     
     async def logout_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Google Drive logout command"""
         user_id = update.effective_user.id
-        db.update_gdrive_token(user_id, None)
+        await db.update_gdrive_token(user_id, None)
+        self.gdrive_uploader.cache.invalidate(user_id)
         await update.message.reply_text("✅ Google Drive থেকে লগআউট হয়েছে।")
     
     async def initialize_pyrogram(self):
@@ -653,8 +1554,98 @@ Google Drive এ আপলোড করতে /login দিয়ে লগই
             await self.pyrogram_client.start()
             logger.info("Pyrogram client initialized!")
     
-    def run(self):
-        """Run the bot"""
+    async def startup(self, application):
+        """Start background services once the event loop is running"""
+        self.application = application
+        if self.web.has_routes:
+            await self.web.start()
+        if METRICS_PORT:
+            try:
+                await self.metrics_web.start()
+            except OSError as e:
+                logger.warning(f"Metrics endpoint not started: {e}")
+        if self.runs_transfers:
+            self.scheduler.start()
+        self.progress.start()
+        self.lag_monitor.start()
+        await self.resume_jobs()
+        if self.runs_transfers:
+            self.lease_task = asyncio.ensure_future(self.lease_loop())
+    
+    async def shutdown(self, application):
+        """Release shared clients when the application stops"""
+        await self.web.stop()
+        await self.metrics_web.stop()
+        if self.lease_task:
+            self.lease_task.cancel()
+            await asyncio.gather(self.lease_task, return_exceptions=True)
+        await self.scheduler.stop()
+        await self.progress.stop()
+        await self.lag_monitor.stop()
+        await self.http.close()
+        await self.drive_http.close()
+        await self.telegram_uploader.pool.stop()
+        db.close()
+        
+        # Cleanup Pyrogram client on shutdown
+        if self.pyrogram_client.is_connected:
+            await self.pyrogram_client.stop()
+            logger.info("Pyrogram client stopped!")
+    
+    async def handle_webhook(self, request):
+        """Receive one update from Telegram and hand it to the application"""
+        secret = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if WEBHOOK_SECRET and not hmac.compare_digest(secret, WEBHOOK_SECRET):
+            return web.Response(status=403)
+        
+        try:
+            update = Update.de_json(await request.json(), self.application.bot)
+        except ValueError:
+            return web.Response(status=400)
+        
+        # Answer right away, handlers run from the update queue
+        await self.application.update_queue.put(update)
+        return web.Response()
+    
+    async def handle_metrics(self, request):
+        """Expose the process metrics in the Prometheus text format"""
+        return web.Response(text=metrics.registry.render(), content_type='text/plain', charset='utf-8')
+    
+    async def serve(self, application):
+        """Run without polling: behind the webhook server, or as a transfer worker"""
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop.set)
+            except NotImplementedError:
+                pass
+        
+        await application.initialize()
+        await self.startup(application)
+        await application.start()
+        try:
+            if self.role != 'worker':
+                await application.bot.set_webhook(
+                    url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+                    secret_token=WEBHOOK_SECRET or None,
+                    allowed_updates=Update.ALL_TYPES,
+                    drop_pending_updates=True,
+                    max_connections=WEBHOOK_MAX_CONNECTIONS
+                )
+                logger.info(f"Webhook set to {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}")
+            await stop.wait()
+        finally:
+            await self.web.stop()
+            await application.stop()
+            await self.shutdown(application)
+            await application.shutdown()
+    
+    def build_application(self, polling, base_url=None):
+        """Create the Application with every handler, and the HTTP routes it needs
+        
+        base_url points the bot at another Bot API server than Telegram's.
+        """
         # Create custom request with longer timeout
         request = HTTPXRequest(
             connection_pool_size=8,
@@ -664,10 +1655,24 @@ Google Drive এ আপলোড করতে /login দিয়ে লগই
             pool_timeout=30.0
         )
         
-        application = Application.builder()\
+        builder = Application.builder()\
             .token(self.bot_token)\
             .request(request)\
-            .build()
+            .concurrent_updates(UPDATE_CONCURRENCY)\
+            .post_init(self.startup)\
+            .post_shutdown(self.shutdown)
+        if not polling:
+            builder = builder.updater(None)
+        if base_url:
+            builder = builder.base_url(base_url.rstrip('/') + '/bot')
+        application = builder.build()
+        
+        # HTTP endpoints, served from startup() when there are any
+        if self.role != 'worker':
+            if not polling:
+                self.web.add_route('POST', WEBHOOK_PATH, self.handle_webhook)
+            if OAUTH_CALLBACK:
+                self.web.add_route('GET', urlparse(REDIRECT_URI).path or '/', self.handle_oauth_redirect)
         
         # Command handlers
         application.add_handler(CommandHandler("start", self.start))
@@ -679,28 +1684,35 @@ Google Drive এ আপলোড করতে /login দিয়ে লগই
         
         # Message handlers
         application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_link))
+        application.add_handler(MessageHandler(filters.Document.FileExtension("txt"), self.handle_link_file))
         
         # Callback handlers
         application.add_handler(CallbackQueryHandler(self.button_callback))
+        return application
+    
+    def run(self):
+        """Run the bot"""
+        # Workers receive no updates, and webhook updates come in through self.web
+        polling = self.role != 'worker' and not USE_WEBHOOK
+        application = self.build_application(polling)
         
         # Start bot
-        logger.info("Bot started!")
+        logger.info(f"Bot started! (role: {self.role}, worker: {WORKER_ID})")
         
         try:
-            application.run_polling(
-                allowed_updates=Update.ALL_TYPES,
-                drop_pending_updates=True
-            )
+            if polling:
+                application.run_polling(
+                    allowed_updates=Update.ALL_TYPES,
+                    drop_pending_updates=True
+                )
+            else:
+                # Not asyncio.run(): the Pyrogram client is bound to the loop it was
+                # created on and starts its upload workers there
+                asyncio.get_event_loop().run_until_complete(self.serve(application))
         except KeyboardInterrupt:
             logger.info("Bot stopped by user")
         except Exception as e:
             logger.error(f"Bot error: {e}")
-        finally:
-            # Cleanup Pyrogram client on shutdown
-            if self.pyrogram_client.is_connected:
-                loop = asyncio.get_event_loop()
-                loop.run_until_complete(self.pyrogram_client.stop())
-                logger.info("Pyrogram client stopped!")
 
 if __name__ == '__main__':
     bot = FileUploadBot()
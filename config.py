@@ -1,4 +1,5 @@
 import os
+import socket
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -23,15 +24,102 @@ TELEGRAM_FILE_LIMIT = 2 * 1024 * 1024 * 1024
 # Download chunk size (1 MB)
 DOWNLOAD_CHUNK_SIZE = 1024 * 1024
 
+# Parallel ranged downloads
+DOWNLOAD_CONNECTIONS = int(os.getenv('DOWNLOAD_CONNECTIONS', 8))
+MIN_SEGMENT_SIZE = 8 * 1024 * 1024       # Don't split files into ranges smaller than 8 MB
+SEGMENT_RETRIES = 3
+
+# Shared HTTP connection pool
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', 100))         # Max open connections overall
+# Max open connections per host, by default room for two full-width downloads from the same server
+HTTP_POOL_PER_HOST = int(os.getenv('HTTP_POOL_PER_HOST', 2 * DOWNLOAD_CONNECTIONS))
+HTTP_DNS_TTL = 300                        # Seconds to cache DNS lookups
+HTTP_KEEPALIVE_TIMEOUT = 60               # Seconds to keep idle connections open
+# Check certificates of download links; set False only where the CA bundle is missing (Termux).
+# Google Drive requests always verify.
+SOURCE_VERIFY_SSL = os.getenv('SOURCE_VERIFY_SSL', 'True').lower() == 'true'
+
+# Link probing
+PROBE_CACHE_TTL = 300                     # Seconds link metadata and redirect targets are reused
+PROBE_CACHE_SIZE = 1000                   # Links kept in the probe cache
+PROBE_TIMEOUT = 15                        # Seconds to wait for a link to answer
+BATCH_PROBE_BUDGET = 60                   # Seconds to check all links of a batch
+
+# Disk writes for downloads run on a thread pool, off the event loop
+DOWNLOAD_WRITERS = int(os.getenv('DOWNLOAD_WRITERS', 4))     # Writer threads shared by all downloads
+DOWNLOAD_WRITE_QUEUE = 8                  # Max chunks waiting to be written per file
+DOWNLOAD_DROP_CACHE = os.getenv('DOWNLOAD_DROP_CACHE', 'False').lower() == 'true'   # Keep big downloads out of the page cache
+
+# Google Drive streaming upload (download and upload overlap, nothing is written to disk)
+GDRIVE_STREAM_UPLOAD = os.getenv('GDRIVE_STREAM_UPLOAD', 'True').lower() == 'true'
+GDRIVE_CHUNK_SIZE = 32 * 256 * 1024      # 8 MB, must be a multiple of 256 KB
+GDRIVE_STREAM_BUFFER = 16                 # Max download chunks buffered between download and upload
+GDRIVE_WORKERS = int(os.getenv('GDRIVE_WORKERS', 4))   # Threads for blocking Drive API calls
+GDRIVE_SERVICE_CACHE_SIZE = 256          # Users whose Drive credentials are kept in memory
+GDRIVE_SERVICE_CACHE_TTL = 3600           # Seconds before cached credentials are rebuilt from the database
+GDRIVE_UPLOAD_URL = os.getenv('GDRIVE_UPLOAD_URL', 'https://www.googleapis.com/upload/drive/v3/files')
+
+# Telegram streaming upload (parts go to Telegram as they download, nothing is written to disk)
+TELEGRAM_STREAM_UPLOAD = os.getenv('TELEGRAM_STREAM_UPLOAD', 'True').lower() == 'true'
+TELEGRAM_UPLOAD_WORKERS = int(os.getenv('TELEGRAM_UPLOAD_WORKERS', 4))   # Parts in flight per file
+TELEGRAM_UPLOAD_SESSIONS = int(os.getenv('TELEGRAM_UPLOAD_SESSIONS', 4)) # Media connections shared by all uploads
+TELEGRAM_SESSION_INFLIGHT = 4             # Max parts in flight per media connection
+TELEGRAM_STREAM_BUFFER = 8                # Max 512 KB parts read ahead of the uploaders
+
+# Transfer job queue
+TRANSFER_WORKERS = int(os.getenv('TRANSFER_WORKERS', 4))       # Max transfers running at once
+MAX_JOBS_PER_USER = int(os.getenv('MAX_JOBS_PER_USER', 1))     # Max transfers running per user
+MAX_JOBS_PER_DESTINATION = {
+    'telegram': int(os.getenv('MAX_TELEGRAM_JOBS', 2)),
+    'gdrive': int(os.getenv('MAX_GDRIVE_JOBS', 3))
+}
+
+# Quota reservations held by queued and running transfers
+QUOTA_RESERVATION_TTL = 24                # Hours before a leftover reservation is released
+
+# Dedup cache (re-send finished uploads for repeat links instead of transferring again)
+DEDUP_ENABLED = os.getenv('DEDUP_ENABLED', 'True').lower() == 'true'
+DEDUP_TTL_DAYS = int(os.getenv('DEDUP_TTL_DAYS', 30))          # Drop entries unused for this long
+DEDUP_MAX_ENTRIES = int(os.getenv('DEDUP_MAX_ENTRIES', 10000))  # Least recently used entries are evicted past this
+
+# Batch links (several links in one message or a .txt file)
+BATCH_MAX_LINKS = int(os.getenv('BATCH_MAX_LINKS', 50))   # Links accepted at once, the rest are skipped
+BATCH_PROBE_CONCURRENCY = 8               # Links checked at once
+BATCH_FILE_LIMIT = 1024 * 1024            # Largest .txt link file read
+
+# Progress message updates
+PROGRESS_INTERVAL = 3                     # Min seconds between edits of one progress message
+PROGRESS_CHAT_RATE = 1                    # Max progress edits per second in one chat
+PROGRESS_GLOBAL_RATE = int(os.getenv('PROGRESS_GLOBAL_RATE', 20))   # Max progress edits per second overall
+PROGRESS_SPEED_ALPHA = 0.3                # Smoothing factor for the speed/ETA moving average
+
+# Event loop lag monitor
+LOOP_LAG_INTERVAL = 0.5                   # Seconds between lag samples
+LOOP_LAG_WARN = 0.2                       # Log a warning when the loop was blocked longer than this
+
+# Prometheus metrics, served at /metrics on METRICS_HOST:METRICS_PORT (port 0 disables)
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', 9108))
+
 # Temporary download directory
 DOWNLOAD_DIR = 'downloads'
 
+# Optional fast scratch directory tried before DOWNLOAD_DIR (e.g. an SSD or tmpfs mount)
+DOWNLOAD_SCRATCH_DIR = os.getenv('DOWNLOAD_SCRATCH_DIR', '')
+
+# Disk space always left free when reserving space for downloads (MB in .env)
+STORAGE_HEADROOM = int(os.getenv('STORAGE_HEADROOM_MB', 512)) * 1024 * 1024
+
 # Database name
 DATABASE_NAME = 'bot_database.db'
 
 # Google Drive settings
 GOOGLE_CLIENT_SECRETS_FILE = os.getenv('GOOGLE_CLIENT_SECRETS_FILE', 'credentials.json')
 REDIRECT_URI = os.getenv('REDIRECT_URI', 'http://localhost:8080/')
+# Receive Google's redirect on the bot's own web server (REDIRECT_URI must point at it)
+# instead of users pasting the redirect URL into the chat
+OAUTH_CALLBACK = os.getenv('OAUTH_CALLBACK', 'False').lower() == 'true'
+OAUTH_STATE_TTL = 10                      # Minutes a /login link stays valid
 
 # Bot token
 BOT_TOKEN = os.getenv('BOT_TOKEN')
@@ -40,3 +128,18 @@ BOT_TOKEN = os.getenv('BOT_TOKEN')
 USE_WEBHOOK = os.getenv('USE_WEBHOOK', 'False').lower() == 'true'
 WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
 PORT = int(os.getenv('PORT', 8443))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')        # Checked against Telegram's secret token header
+WEBHOOK_MAX_CONNECTIONS = 40              # Parallel webhook requests Telegram may open
+WEB_HOST = os.getenv('WEB_HOST', '0.0.0.0')
+UPDATE_CONCURRENCY = int(os.getenv('UPDATE_CONCURRENCY', 32))   # Updates handled at once
+
+# Process role: 'all' does everything in one process, 'ingress' only receives
+# updates and queues jobs, 'worker' only runs queued transfers. Processes share
+# jobs through the database; each worker leases the jobs it runs. All processes
+# must run on one host, SQLite in WAL mode can't be shared over a network filesystem.
+BOT_ROLE = os.getenv('BOT_ROLE', 'all').lower()
+WORKER_ID = os.getenv('WORKER_ID', '') or f"{socket.gethostname()}-{BOT_ROLE}"
+JOB_LEASE_SECONDS = 60                    # A job whose worker stops renewing is taken over after this
+JOB_LEASE_RENEW = 15                      # Seconds between lease renewals
+JOB_POLL_INTERVAL = 2                     # Seconds between checks for new queued jobs
@@ -1,18 +1,49 @@
 import sqlite3
-from datetime import datetime
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 import json
+import metrics
 
 class Database:
     def __init__(self, db_name='bot_database.db'):
         self.db_name = db_name
+        
+        # One reused connection per thread (event loop, Drive executor, ...)
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+        
         self.create_tables()
     
     def get_connection(self):
-        """Get database connection"""
-        conn = sqlite3.connect(self.db_name)
-        conn.row_factory = sqlite3.Row
+        """Get this thread's database connection, opening it on first use"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # cached_statements keeps prepared statements around between calls
+            conn = sqlite3.connect(self.db_name, timeout=30, check_same_thread=False, cached_statements=256)
+            conn.row_factory = sqlite3.Row
+            
+            # WAL lets readers run alongside a writer; NORMAL is durable enough with WAL
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA temp_store=MEMORY')
+            
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
         return conn
     
+    def close(self):
+        """Close every pooled connection"""
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+        self._local = threading.local()
+    
     def create_tables(self):
         """Create necessary database tables"""
         conn = self.get_connection()
@@ -27,10 +58,23 @@ class Database:
                 monthly_used INTEGER DEFAULT 0,
                 gdrive_token TEXT,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                last_reset TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                last_reset TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                usage_period TEXT,
+                monthly_reserved INTEGER DEFAULT 0
             )
         ''')
         
+        # monthly_used only counts for the billing period in usage_period (YYYY-MM);
+        # older databases get the column added and filled from last_reset
+        columns = [row['name'] for row in cursor.execute('PRAGMA table_info(users)')]
+        if 'usage_period' not in columns:
+            cursor.execute('ALTER TABLE users ADD COLUMN usage_period TEXT')
+            cursor.execute("UPDATE users SET usage_period = strftime('%Y-%m', last_reset)")
+        
+        # Bytes held by running transfers, the sum of the user's quota_reservations
+        if 'monthly_reserved' not in columns:
+            cursor.execute('ALTER TABLE users ADD COLUMN monthly_reserved INTEGER DEFAULT 0')
+        
         # Upload history table
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS uploads (
@@ -44,8 +88,163 @@ class Database:
             )
         ''')
         
+        # Transfer jobs table (survives restarts so transfers can resume)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                chat_id INTEGER,
+                url TEXT NOT NULL,
+                file_name TEXT,
+                file_size INTEGER DEFAULT 0,
+                destination TEXT,
+                state TEXT DEFAULT 'pending',
+                download_path TEXT,
+                downloaded_bytes INTEGER DEFAULT 0,
+                segments TEXT,
+                etag TEXT,
+                last_modified TEXT,
+                upload_session_uri TEXT,
+                uploaded_bytes INTEGER DEFAULT 0,
+                error TEXT,
+                batch_id INTEGER,
+                worker_id TEXT,
+                lease_until TIMESTAMP,
+                cancel_requested INTEGER DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users (user_id)
+            )
+        ''')
+        
+        # Jobs submitted together share batch_id (the id of the batch's first job)
+        columns = [row['name'] for row in cursor.execute('PRAGMA table_info(jobs)')]
+        if 'batch_id' not in columns:
+            cursor.execute('ALTER TABLE jobs ADD COLUMN batch_id INTEGER')
+        
+        # Worker processes lease the jobs they run, see claim_jobs
+        if 'worker_id' not in columns:
+            cursor.execute('ALTER TABLE jobs ADD COLUMN worker_id TEXT')
+            cursor.execute('ALTER TABLE jobs ADD COLUMN lease_until TIMESTAMP')
+            cursor.execute('ALTER TABLE jobs ADD COLUMN cancel_requested INTEGER DEFAULT 0')
+        
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_jobs_state ON jobs (state)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_jobs_batch ON jobs (batch_id)')
+        
+        # Indexes for per-user history and keyset paging of the user list
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_uploads_user_time ON uploads (user_id, uploaded_at)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_created ON users (created_at, user_id)')
+        
+        # Running totals for the stats panel, kept in step with users/uploads.
+        # scope is 'total' (key users/uploads), 'day' (key YYYY-MM-DD) or 'destination' (key upload_type)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS stats_counters (
+                scope TEXT NOT NULL,
+                key TEXT NOT NULL,
+                count INTEGER DEFAULT 0,
+                bytes INTEGER DEFAULT 0,
+                PRIMARY KEY (scope, key)
+            )
+        ''')
+        
+        # Finished uploads that can be re-sent for a repeat URL. owner_id is 0 for
+        # Telegram file_ids (usable in any chat) and the uploader for Drive files
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS dedup_cache (
+                url_key TEXT NOT NULL,
+                destination TEXT NOT NULL,
+                owner_id INTEGER DEFAULT 0,
+                file_ref TEXT NOT NULL,
+                file_size INTEGER,
+                etag TEXT,
+                hits INTEGER DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                last_used_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (url_key, destination, owner_id)
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_dedup_used ON dedup_cache (last_used_at)')
+        
+        # Quota held for each queued or running transfer until it finishes
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS quota_reservations (
+                job_id INTEGER PRIMARY KEY,
+                user_id INTEGER NOT NULL,
+                bytes INTEGER NOT NULL,
+                expires_at TIMESTAMP NOT NULL
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_reservations_user ON quota_reservations (user_id, expires_at)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_reservations_expiry ON quota_reservations (expires_at)')
+        
+        # Pending Google logins, state is the random OAuth state sent to Google
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS oauth_states (
+                state TEXT PRIMARY KEY,
+                user_id INTEGER NOT NULL,
+                chat_id INTEGER NOT NULL,
+                code_verifier TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        cursor.execute('SELECT 1 FROM stats_counters LIMIT 1')
+        if cursor.fetchone() is None:
+            self.backfill_counters(cursor)
+        
         conn.commit()
-        conn.close()
+    
+    @staticmethod
+    def backfill_counters(cursor):
+        """Build stats_counters from existing users and uploads (one-time migration)"""
+        cursor.execute('''
+            INSERT INTO stats_counters (scope, key, count, bytes)
+            SELECT 'total', 'users', COUNT(*), 0 FROM users
+        ''')
+        cursor.execute('''
+            INSERT INTO stats_counters (scope, key, count, bytes)
+            SELECT 'total', 'uploads', COUNT(*), COALESCE(SUM(file_size), 0) FROM uploads
+        ''')
+        cursor.execute('''
+            INSERT INTO stats_counters (scope, key, count, bytes)
+            SELECT 'day', date(uploaded_at), COUNT(*), COALESCE(SUM(file_size), 0)
+            FROM uploads GROUP BY date(uploaded_at)
+        ''')
+        cursor.execute('''
+            INSERT INTO stats_counters (scope, key, count, bytes)
+            SELECT 'destination', upload_type, COUNT(*), COALESCE(SUM(file_size), 0)
+            FROM uploads WHERE upload_type IS NOT NULL GROUP BY upload_type
+        ''')
+    
+    @staticmethod
+    def current_period():
+        """Billing period key for the current month"""
+        return datetime.now().strftime('%Y-%m')
+    
+    def _with_current_usage(self, row, period=None):
+        """Convert a user row to a dict, zeroing usage left over from an older period"""
+        user = dict(row)
+        if user['usage_period'] != (period or self.current_period()):
+            user['monthly_used'] = 0
+        return user
+    
+    BUMP_COUNTER_SQL = '''
+        INSERT INTO stats_counters (scope, key, count, bytes)
+        VALUES (?, ?, 1, ?)
+        ON CONFLICT (scope, key) DO UPDATE SET
+            count = count + 1,
+            bytes = bytes + excluded.bytes
+    '''
+    
+    def _count_upload(self, cursor, file_size, upload_type):
+        """Add one upload to the total, daily and per-destination counters"""
+        file_size = file_size or 0
+        cursor.execute(self.BUMP_COUNTER_SQL, ('total', 'uploads', file_size))
+        # Same UTC day as the CURRENT_TIMESTAMP in uploads.uploaded_at
+        day = datetime.now(timezone.utc).strftime('%Y-%m-%d')
+        cursor.execute(self.BUMP_COUNTER_SQL, ('day', day, file_size))
+        if upload_type:
+            cursor.execute(self.BUMP_COUNTER_SQL, ('destination', upload_type, file_size))
     
     def add_user(self, user_id, name, package='free'):
         """Add new user to database"""
@@ -54,16 +253,16 @@ class Database:
         
         try:
             cursor.execute('''
-                INSERT INTO users (user_id, name, package)
-                VALUES (?, ?, ?)
-            ''', (user_id, name, package))
+                INSERT INTO users (user_id, name, package, usage_period)
+                VALUES (?, ?, ?, ?)
+            ''', (user_id, name, package, self.current_period()))
+            cursor.execute(self.BUMP_COUNTER_SQL, ('total', 'users', 0))
             conn.commit()
             return True
         except sqlite3.IntegrityError:
             # User already exists
+            conn.rollback()
             return False
-        finally:
-            conn.close()
     
     def get_user(self, user_id):
         """Get user information"""
@@ -72,10 +271,9 @@ class Database:
         
         cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
         row = cursor.fetchone()
-        conn.close()
         
         if row:
-            return dict(row)
+            return self._with_current_usage(row)
         return None
     
     def get_all_users(self):
@@ -85,9 +283,61 @@ class Database:
         
         cursor.execute('SELECT * FROM users ORDER BY created_at DESC')
         rows = cursor.fetchall()
-        conn.close()
         
-        return [dict(row) for row in rows]
+        period = self.current_period()
+        return [self._with_current_usage(row, period) for row in rows]
+    
+    def get_users_page(self, cursor_key=None, direction='next', limit=20):
+        """Get one page of users, newest first, using keyset pagination
+        
+        cursor_key is the (created_at, user_id) of the last row of the previous
+        page (direction='next') or the first row of the following page
+        (direction='prev'). Returns a dict with users, has_next and has_prev.
+        """
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        if cursor_key is None:
+            cursor.execute('''
+                SELECT * FROM users
+                ORDER BY created_at DESC, user_id DESC
+                LIMIT ?
+            ''', (limit + 1,))
+        elif direction == 'next':
+            cursor.execute('''
+                SELECT * FROM users
+                WHERE (created_at, user_id) < (?, ?)
+                ORDER BY created_at DESC, user_id DESC
+                LIMIT ?
+            ''', (*cursor_key, limit + 1))
+        else:
+            cursor.execute('''
+                SELECT * FROM users
+                WHERE (created_at, user_id) > (?, ?)
+                ORDER BY created_at ASC, user_id ASC
+                LIMIT ?
+            ''', (*cursor_key, limit + 1))
+        
+        rows = cursor.fetchall()
+        more = len(rows) > limit
+        rows = rows[:limit]
+        
+        period = self.current_period()
+        users = [self._with_current_usage(row, period) for row in rows]
+        
+        if direction == 'prev' and cursor_key is not None:
+            users.reverse()
+            return {'users': users, 'has_next': True, 'has_prev': more}
+        return {'users': users, 'has_next': more, 'has_prev': cursor_key is not None}
+    
+    def count_users(self):
+        """Get number of users from the running counter"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute("SELECT count FROM stats_counters WHERE scope = 'total' AND key = 'users'")
+        row = cursor.fetchone()
+        return row['count'] if row else 0
     
     def update_package(self, user_id, package):
         """Update user package"""
@@ -101,42 +351,45 @@ class Database:
         ''', (package, user_id))
         
         conn.commit()
-        conn.close()
+    
+    # Adds to monthly_used, starting from zero when the stored period is over
+    ADD_USAGE_SQL = '''
+        UPDATE users 
+        SET monthly_used = CASE WHEN usage_period = ? THEN monthly_used ELSE 0 END + ?,
+            usage_period = ?
+        WHERE user_id = ?
+    '''
     
     def update_monthly_usage(self, user_id, size):
         """Update user's monthly usage"""
         conn = self.get_connection()
         cursor = conn.cursor()
         
-        cursor.execute('''
-            UPDATE users 
-            SET monthly_used = monthly_used + ?
-            WHERE user_id = ?
-        ''', (size, user_id))
+        period = self.current_period()
+        cursor.execute(self.ADD_USAGE_SQL, (period, size, period, user_id))
         
         conn.commit()
-        conn.close()
     
     def reset_monthly_usage(self, user_id=None):
         """Reset monthly usage for user(s)"""
         conn = self.get_connection()
         cursor = conn.cursor()
         
+        period = self.current_period()
         if user_id:
             cursor.execute('''
                 UPDATE users 
-                SET monthly_used = 0, last_reset = CURRENT_TIMESTAMP
+                SET monthly_used = 0, usage_period = ?, last_reset = CURRENT_TIMESTAMP
                 WHERE user_id = ?
-            ''', (user_id,))
+            ''', (period, user_id))
         else:
             # Reset all users
             cursor.execute('''
                 UPDATE users 
-                SET monthly_used = 0, last_reset = CURRENT_TIMESTAMP
-            ''')
+                SET monthly_used = 0, usage_period = ?, last_reset = CURRENT_TIMESTAMP
+            ''', (period,))
         
         conn.commit()
-        conn.close()
     
     def update_gdrive_token(self, user_id, token):
         """Update Google Drive token"""
@@ -153,7 +406,6 @@ class Database:
         ''', (token_str, user_id))
         
         conn.commit()
-        conn.close()
     
     def add_upload_record(self, user_id, file_name, file_size, upload_type):
         """Add upload record to history"""
@@ -164,9 +416,138 @@ class Database:
             INSERT INTO uploads (user_id, file_name, file_size, upload_type)
             VALUES (?, ?, ?, ?)
         ''', (user_id, file_name, file_size, upload_type))
+        self._count_upload(cursor, file_size, upload_type)
         
         conn.commit()
-        conn.close()
+    
+    def record_upload(self, user_id, file_name, file_size, upload_type, job_id=None):
+        """Count a finished upload against the user's quota and add it to history in one transaction
+        
+        The quota reservation of job_id, if any, is turned into usage in the same transaction.
+        """
+        conn = self.get_connection()
+        
+        period = self.current_period()
+        with conn:
+            # Lock before reading the reservation, so a concurrent release can't take it off twice
+            conn.execute('BEGIN IMMEDIATE')
+            if job_id is not None:
+                self._release_reservation(conn, job_id)
+            conn.execute(self.ADD_USAGE_SQL, (period, file_size, period, user_id))
+            
+            cursor = conn.execute('''
+                INSERT INTO uploads (user_id, file_name, file_size, upload_type)
+                VALUES (?, ?, ?, ?)
+            ''', (user_id, file_name, file_size, upload_type))
+            self._count_upload(cursor, file_size, upload_type)
+    
+    # Quota reservations
+    def reserve_quota(self, user_id, job_id, size, limit, ttl_hours=24):
+        """Hold size bytes of the user's quota for a transfer, returns False if over limit
+        
+        The limit check and the increment are one conditional UPDATE, so
+        concurrent reservations can never add up past the limit. Reserving
+        again for the same job is a no-op that returns True.
+        """
+        conn = self.get_connection()
+        
+        period = self.current_period()
+        with conn:
+            # Take the write lock up front so the whole check runs against a stable ledger
+            conn.execute('BEGIN IMMEDIATE')
+            self._release_expired(conn, user_id)
+            if conn.execute('SELECT 1 FROM quota_reservations WHERE job_id = ?', (job_id,)).fetchone():
+                return True
+            
+            cursor = conn.execute('''
+                UPDATE users
+                SET monthly_reserved = monthly_reserved + ?
+                WHERE user_id = ?
+                AND CASE WHEN usage_period = ? THEN monthly_used ELSE 0 END + monthly_reserved + ? <= ?
+            ''', (size, user_id, period, size, limit))
+            if cursor.rowcount == 0:
+                return False
+            
+            conn.execute('''
+                INSERT INTO quota_reservations (job_id, user_id, bytes, expires_at)
+                VALUES (?, ?, ?, datetime('now', ?))
+            ''', (job_id, user_id, size, f'+{ttl_hours} hours'))
+        return True
+    
+    def release_quota(self, job_id):
+        """Give back the quota held for a failed or cancelled transfer"""
+        conn = self.get_connection()
+        
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            self._release_reservation(conn, job_id)
+    
+    def sweep_quota_reservations(self):
+        """Release expired reservations and those of jobs that are no longer running"""
+        conn = self.get_connection()
+        
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            expired = self._release_expired(conn)
+            rows = conn.execute('''
+                SELECT r.job_id FROM quota_reservations r
+                LEFT JOIN jobs j ON j.id = r.job_id
+                WHERE j.id IS NULL OR j.state NOT IN ('queued', 'downloading', 'uploading')
+            ''').fetchall()
+            for row in rows:
+                self._release_reservation(conn, row['job_id'])
+        return expired + len(rows)
+    
+    @staticmethod
+    def _release_reservation(conn, job_id):
+        """Delete a job's reservation and take its bytes off monthly_reserved"""
+        row = conn.execute('SELECT user_id, bytes FROM quota_reservations WHERE job_id = ?', (job_id,)).fetchone()
+        if row:
+            conn.execute('DELETE FROM quota_reservations WHERE job_id = ?', (job_id,))
+            conn.execute(
+                'UPDATE users SET monthly_reserved = MAX(0, monthly_reserved - ?) WHERE user_id = ?',
+                (row['bytes'], row['user_id'])
+            )
+    
+    @classmethod
+    def _release_expired(cls, conn, user_id=None):
+        """Release reservations past expires_at, only user_id's if given"""
+        if user_id is None:
+            rows = conn.execute(
+                "SELECT job_id FROM quota_reservations WHERE expires_at < datetime('now')"
+            ).fetchall()
+        else:
+            rows = conn.execute(
+                "SELECT job_id FROM quota_reservations WHERE user_id = ? AND expires_at < datetime('now')",
+                (user_id,)
+            ).fetchall()
+        for row in rows:
+            cls._release_reservation(conn, row['job_id'])
+        return len(rows)
+    
+    # OAuth login states
+    def save_oauth_state(self, state, user_id, chat_id, code_verifier=None):
+        """Remember a started Google login, dropping the user's older ones"""
+        conn = self.get_connection()
+        
+        with conn:
+            conn.execute('DELETE FROM oauth_states WHERE user_id = ?', (user_id,))
+            conn.execute('''
+                INSERT INTO oauth_states (state, user_id, chat_id, code_verifier)
+                VALUES (?, ?, ?, ?)
+            ''', (state, user_id, chat_id, code_verifier))
+    
+    def pop_oauth_state(self, state, max_age_minutes=10):
+        """Take a login state (usable once), returns None if unknown or expired"""
+        conn = self.get_connection()
+        
+        with conn:
+            conn.execute("DELETE FROM oauth_states WHERE created_at < datetime('now', ?)", (f'-{max_age_minutes} minutes',))
+            row = conn.execute('SELECT * FROM oauth_states WHERE state = ?', (state,)).fetchone()
+            if row:
+                conn.execute('DELETE FROM oauth_states WHERE state = ?', (state,))
+        
+        return dict(row) if row else None
     
     def get_user_uploads(self, user_id, limit=10):
         """Get user's upload history"""
@@ -181,51 +562,390 @@ class Database:
         ''', (user_id, limit))
         
         rows = cursor.fetchall()
-        conn.close()
         
         return [dict(row) for row in rows]
     
-    def get_statistics(self):
-        """Get overall statistics"""
+    def get_statistics(self, days=7):
+        """Get overall statistics from the running counters
+        
+        Returns totals, per-destination totals, dedup cache hits/misses and the
+        last `days` days of throughput as (date, count, bytes) tuples, newest first.
+        """
         conn = self.get_connection()
         cursor = conn.cursor()
         
-        # Total users
-        cursor.execute('SELECT COUNT(*) as count FROM users')
-        total_users = cursor.fetchone()['count']
+        cursor.execute("SELECT key, count, bytes FROM stats_counters WHERE scope = 'total'")
+        totals = {row['key']: row for row in cursor.fetchall()}
         
-        # Total uploads
-        cursor.execute('SELECT COUNT(*) as count FROM uploads')
-        total_uploads = cursor.fetchone()['count']
+        cursor.execute("SELECT key, count, bytes FROM stats_counters WHERE scope = 'destination'")
+        destinations = {row['key']: {'count': row['count'], 'bytes': row['bytes']} for row in cursor.fetchall()}
         
-        # Total data uploaded
-        cursor.execute('SELECT SUM(file_size) as total FROM uploads')
-        result = cursor.fetchone()
-        total_data = result['total'] if result['total'] else 0
+        cursor.execute('''
+            SELECT key, count, bytes FROM stats_counters
+            WHERE scope = 'day' AND key > date('now', ?)
+            ORDER BY key DESC
+        ''', (f'-{days} days',))
+        daily = [(row['key'], row['count'], row['bytes']) for row in cursor.fetchall()]
         
-        conn.close()
+        cursor.execute("SELECT key, count FROM stats_counters WHERE scope = 'dedup'")
+        dedup = {row['key']: row['count'] for row in cursor.fetchall()}
         
+        uploads = totals.get('uploads')
         return {
-            'total_users': total_users,
-            'total_uploads': total_uploads,
-            'total_data': total_data
+            'total_users': totals['users']['count'] if 'users' in totals else 0,
+            'total_uploads': uploads['count'] if uploads else 0,
+            'total_data': uploads['bytes'] if uploads else 0,
+            'destinations': destinations,
+            'daily': daily,
+            'dedup_hits': dedup.get('hit', 0),
+            'dedup_misses': dedup.get('miss', 0)
         }
     
     def check_and_reset_monthly(self):
-        """Check if month has changed and reset usage"""
+        """Zero out usage stored for past billing periods
+        
+        Not required for correctness - usage from an older period already reads
+        as zero - but keeps the stored numbers tidy. Runs as one set-based UPDATE.
+        """
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            UPDATE users 
+            SET monthly_used = 0, usage_period = ?, last_reset = CURRENT_TIMESTAMP
+            WHERE usage_period IS NOT ?
+        ''', (self.current_period(), self.current_period()))
+        
+        conn.commit()
+    
+    # Columns update_job is allowed to change
+    JOB_FIELDS = {
+        'destination', 'state', 'download_path', 'downloaded_bytes', 'segments', 'etag',
+        'last_modified', 'upload_session_uri', 'uploaded_bytes', 'error', 'file_size'
+    }
+    
+    def add_job(self, user_id, chat_id, url, file_name, file_size, etag=None):
+        """Record a submitted link as a pending job, returns the job id"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            INSERT INTO jobs (user_id, chat_id, url, file_name, file_size, etag)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (user_id, chat_id, url, file_name, file_size, etag))
+        
+        job_id = cursor.lastrowid
+        conn.commit()
+        
+        return job_id
+    
+    def add_batch_jobs(self, user_id, chat_id, files):
+        """Record several links as pending jobs of one batch, returns the batch id
+        
+        files is a list of (url, file_name, file_size, etag) tuples.
+        """
+        conn = self.get_connection()
+        
+        with conn:
+            batch_id = None
+            for url, file_name, file_size, etag in files:
+                cursor = conn.execute('''
+                    INSERT INTO jobs (user_id, chat_id, url, file_name, file_size, etag, batch_id)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', (user_id, chat_id, url, file_name, file_size, etag, batch_id))
+                
+                if batch_id is None:
+                    batch_id = cursor.lastrowid
+                    conn.execute('UPDATE jobs SET batch_id = ? WHERE id = ?', (batch_id, batch_id))
+        
+        return batch_id
+    
+    def get_batch_jobs(self, batch_id):
+        """Get all jobs of a batch in submission order"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute('SELECT * FROM jobs WHERE batch_id = ? ORDER BY id', (batch_id,))
+        rows = cursor.fetchall()
+        
+        return [dict(row) for row in rows]
+    
+    def get_job(self, job_id):
+        """Get job information"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute('SELECT * FROM jobs WHERE id = ?', (job_id,))
+        row = cursor.fetchone()
+        
+        if row:
+            return dict(row)
+        return None
+    
+    def update_job(self, job_id, **fields):
+        """Update job progress/state fields"""
+        unknown = set(fields) - self.JOB_FIELDS
+        if unknown:
+            raise ValueError(f"Unknown job fields: {', '.join(sorted(unknown))}")
+        
+        assignments = ', '.join(f'{name} = ?' for name in fields)
+        
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute(f'''
+            UPDATE jobs
+            SET {assignments}, updated_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        ''', (*fields.values(), job_id))
+        
+        conn.commit()
+    
+    def get_unfinished_jobs(self):
+        """Get jobs that were queued or in progress, oldest first"""
         conn = self.get_connection()
         cursor = conn.cursor()
         
         cursor.execute('''
-            SELECT user_id, last_reset FROM users
+            SELECT * FROM jobs
+            WHERE state IN ('queued', 'downloading', 'uploading')
+            ORDER BY id
         ''')
         
-        users = cursor.fetchall()
-        current_month = datetime.now().month
+        rows = cursor.fetchall()
+        
+        return [dict(row) for row in rows]
+    
+    # Job leases (several processes running transfers from one database)
+    def queue_job(self, job_id, destination, worker_id=None, lease_seconds=0):
+        """Mark a pending job queued for destination
+        
+        worker_id leases the job to the process that will run it right away;
+        without it the job waits for any worker's claim_jobs.
+        """
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            UPDATE jobs
+            SET destination = ?, state = 'queued', worker_id = ?, cancel_requested = 0,
+                lease_until = CASE WHEN ? IS NULL THEN NULL ELSE datetime('now', ?) END,
+                updated_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        ''', (destination, worker_id, worker_id, f'+{lease_seconds} seconds', job_id))
+        
+        conn.commit()
+    
+    def claim_jobs(self, worker_id, lease_seconds, limit=None, include_own=False):
+        """Lease unfinished jobs to worker_id, returns the claimed job records
+        
+        A job can be claimed when it has no worker or its lease ran out.
+        include_own also claims jobs already leased to worker_id, which is only
+        right at startup when they are left over from the worker's last run.
+        Each record's resumed is True when the job had a worker before.
+        """
+        conn = self.get_connection()
         
-        for user in users:
-            last_reset = datetime.fromisoformat(user['last_reset'])
-            if last_reset.month != current_month:
-                self.reset_monthly_usage(user['user_id'])
+        owner = "worker_id IS NULL OR lease_until < datetime('now')"
+        params = []
+        if include_own:
+            owner += " OR worker_id = ?"
+            params.append(worker_id)
+        conditions = ["state IN ('queued', 'downloading', 'uploading')", f"({owner})"]
         
-        conn.close()
\ No newline at end of file
+        query = f"SELECT id, worker_id FROM jobs WHERE {' AND '.join(conditions)} ORDER BY id"
+        if limit is not None:
+            query += ' LIMIT ?'
+            params.append(limit)
+        
+        with conn:
+            # Select and update under one write lock so two workers never claim the same job
+            conn.execute('BEGIN IMMEDIATE')
+            previous = {row['id']: row['worker_id'] for row in conn.execute(query, params)}
+            if not previous:
+                return []
+            ids = list(previous)
+            
+            placeholders = ', '.join('?' * len(ids))
+            conn.execute(f'''
+                UPDATE jobs
+                SET worker_id = ?, lease_until = datetime('now', ?), updated_at = CURRENT_TIMESTAMP
+                WHERE id IN ({placeholders})
+            ''', (worker_id, f'+{lease_seconds} seconds', *ids))
+            rows = conn.execute(f'SELECT * FROM jobs WHERE id IN ({placeholders}) ORDER BY id', ids).fetchall()
+        
+        return [dict(row, resumed=previous[row['id']] is not None) for row in rows]
+    
+    def renew_leases(self, worker_id, job_ids, lease_seconds):
+        """Extend worker_id's leases on job_ids, returns the ids of those asked to cancel"""
+        if not job_ids:
+            return []
+        conn = self.get_connection()
+        
+        placeholders = ', '.join('?' * len(job_ids))
+        with conn:
+            conn.execute(f'''
+                UPDATE jobs SET lease_until = datetime('now', ?)
+                WHERE worker_id = ? AND id IN ({placeholders})
+            ''', (f'+{lease_seconds} seconds', worker_id, *job_ids))
+            rows = conn.execute(f'''
+                SELECT id FROM jobs WHERE cancel_requested = 1 AND worker_id = ? AND id IN ({placeholders})
+            ''', (worker_id, *job_ids)).fetchall()
+        
+        return [row['id'] for row in rows]
+    
+    def request_cancel(self, job_id):
+        """Cancel a job owned by any process
+        
+        Returns 'cancelled' if the job was still waiting for a worker and is now
+        cancelled, 'requested' if its worker will cancel it on its next lease
+        renewal, or None if the job is not unfinished.
+        """
+        conn = self.get_connection()
+        
+        with conn:
+            cursor = conn.execute('''
+                UPDATE jobs SET state = 'cancelled', updated_at = CURRENT_TIMESTAMP
+                WHERE id = ? AND state = 'queued'
+                AND (worker_id IS NULL OR lease_until < datetime('now'))
+            ''', (job_id,))
+            if cursor.rowcount:
+                return 'cancelled'
+            
+            cursor = conn.execute('''
+                UPDATE jobs SET cancel_requested = 1
+                WHERE id = ? AND state IN ('queued', 'downloading', 'uploading')
+            ''', (job_id,))
+            if cursor.rowcount:
+                return 'requested'
+        return None
+    
+    def delete_stale_jobs(self, days=7):
+        """Delete finished jobs and never-started pending jobs older than days"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            DELETE FROM jobs
+            WHERE state IN ('pending', 'done', 'failed', 'cancelled')
+            AND updated_at < datetime('now', ?)
+        ''', (f'-{days} days',))
+        
+        conn.commit()
+    
+    # Dedup cache methods
+    def get_dedup_entry(self, url_key, destination, owner_id=0):
+        """Get a cached upload for a normalized URL"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT * FROM dedup_cache
+            WHERE url_key = ? AND destination = ? AND owner_id = ?
+        ''', (url_key, destination, owner_id))
+        row = cursor.fetchone()
+        
+        return dict(row) if row else None
+    
+    def save_dedup_entry(self, url_key, destination, file_ref, file_size, etag=None, owner_id=0, max_entries=10000):
+        """Remember a finished upload, evicting the least recently used entries past max_entries"""
+        conn = self.get_connection()
+        
+        with conn:
+            conn.execute('''
+                INSERT OR REPLACE INTO dedup_cache (url_key, destination, owner_id, file_ref, file_size, etag)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (url_key, destination, owner_id, file_ref, file_size, etag))
+            
+            conn.execute('''
+                DELETE FROM dedup_cache WHERE rowid IN (
+                    SELECT rowid FROM dedup_cache
+                    ORDER BY last_used_at DESC
+                    LIMIT -1 OFFSET ?
+                )
+            ''', (max_entries,))
+    
+    def use_dedup_entry(self, url_key, destination, owner_id=0):
+        """Mark a cached upload as served and count the hit"""
+        conn = self.get_connection()
+        
+        with conn:
+            conn.execute('''
+                UPDATE dedup_cache
+                SET hits = hits + 1, last_used_at = CURRENT_TIMESTAMP
+                WHERE url_key = ? AND destination = ? AND owner_id = ?
+            ''', (url_key, destination, owner_id))
+            conn.execute(self.BUMP_COUNTER_SQL, ('dedup', 'hit', 0))
+    
+    def count_dedup_miss(self):
+        """Count a lookup that had to do a full transfer"""
+        conn = self.get_connection()
+        
+        with conn:
+            conn.execute(self.BUMP_COUNTER_SQL, ('dedup', 'miss', 0))
+    
+    def delete_dedup_entry(self, url_key, destination, owner_id=0):
+        """Invalidate a cached upload"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            DELETE FROM dedup_cache
+            WHERE url_key = ? AND destination = ? AND owner_id = ?
+        ''', (url_key, destination, owner_id))
+        
+        conn.commit()
+    
+    def evict_dedup_entries(self, days=30):
+        """Delete cached uploads not used for days"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            DELETE FROM dedup_cache
+            WHERE last_used_at < datetime('now', ?)
+        ''', (f'-{days} days',))
+        
+        conn.commit()
+
+
+class AsyncDatabase:
+    """Awaitable wrapper around Database that keeps SQLite off the event loop
+    
+    Every Database method is available as a coroutine with the same arguments.
+    Writes are queued to a single writer thread so they never fight each other
+    for the write lock; reads run on a small reader pool and, thanks to WAL,
+    aren't blocked by a write in flight.
+    """
+    
+    READ_METHODS = {
+        'get_user', 'get_all_users', 'get_users_page', 'count_users', 'get_user_uploads',
+        'get_statistics', 'get_job', 'get_batch_jobs', 'get_unfinished_jobs', 'get_dedup_entry'
+    }
+    
+    def __init__(self, database, readers=4):
+        self.sync = database
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer')
+        self.readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix='db-reader')
+    
+    def __getattr__(self, name):
+        method = getattr(self.sync, name)
+        executor = self.readers if name in self.READ_METHODS else self.writer
+        
+        def timed(*args, **kwargs):
+            with metrics.db_latency.time(method=name):
+                return method(*args, **kwargs)
+        
+        async def call(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(executor, functools.partial(timed, *args, **kwargs))
+        
+        call.__name__ = name
+        call.__doc__ = method.__doc__
+        return call
+    
+    def close(self):
+        """Finish queued writes and close all connections"""
+        self.writer.shutdown(wait=True)
+        self.readers.shutdown(wait=True)
+        self.sync.close()
@@ -0,0 +1,373 @@
+import os
+import asyncio
+import logging
+import threading
+import contextlib
+import aiohttp
+from concurrent.futures import ThreadPoolExecutor
+from config import (
+    DOWNLOAD_CHUNK_SIZE, DOWNLOAD_CONNECTIONS, MIN_SEGMENT_SIZE, SEGMENT_RETRIES,
+    DOWNLOAD_WRITERS, DOWNLOAD_WRITE_QUEUE, DOWNLOAD_DROP_CACHE
+)
+
+logger = logging.getLogger(__name__)
+
+
+class Segment:
+    """A byte range of the target file fetched over its own connection"""
+
+    def __init__(self, index, start, end, downloaded=0):
+        self.index = index
+        self.start = start
+        self.end = end          # Inclusive
+        self.downloaded = downloaded    # Contiguous bytes from start that are on disk
+        self.written = {}               # Offset -> length of writes that finished out of order
+
+    def wrote(self, offset, length):
+        """Record a finished write, advancing downloaded over the written prefix"""
+        self.written[offset] = length
+        while self.start + self.downloaded in self.written:
+            self.downloaded += self.written.pop(self.start + self.downloaded)
+
+    @property
+    def size(self):
+        return self.end - self.start + 1
+
+    @property
+    def done(self):
+        return self.downloaded >= self.size
+
+
+class FileWriter:
+    """Write chunks of one file on a thread pool instead of the event loop
+
+    write() returns as soon as the chunk is queued and only waits while
+    max_pending chunks are in flight, so a slow disk slows the download down
+    instead of stalling every other coroutine. With drop_cache, written data is
+    flushed and dropped from the page cache every DROP_CACHE_BYTES.
+    """
+
+    DROP_CACHE_BYTES = 64 * 1024 * 1024
+
+    def __init__(self, fd, executor, max_pending=DOWNLOAD_WRITE_QUEUE, drop_cache=DOWNLOAD_DROP_CACHE):
+        self.fd = fd
+        self.executor = executor
+        self.slots = asyncio.Semaphore(max_pending)
+        self.pending = set()
+        self.error = None
+
+        self.drop_cache = drop_cache and hasattr(os, 'posix_fadvise')
+        self.unflushed = 0
+        self.lock = threading.Lock()
+        # Without pwrite, seek and write of one chunk must not interleave with another thread's
+        self.seek_lock = threading.Lock()
+
+    async def write(self, data, offset, segment=None):
+        """Queue data for writing at offset
+
+        Writer threads can finish in any order; segment.downloaded only grows
+        once every byte before offset is on disk too, so it is safe to resume from.
+        """
+        await self.slots.acquire()
+        if self.error:
+            self.slots.release()
+            raise self.error
+
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self.executor, self.write_sync, data, offset)
+        self.pending.add(future)
+
+        def done(future):
+            self.pending.discard(future)
+            self.slots.release()
+            if future.cancelled():
+                return
+            if future.exception():
+                self.error = self.error or future.exception()
+            elif segment is not None:
+                segment.wrote(offset, len(data))
+
+        future.add_done_callback(done)
+
+    def write_sync(self, data, offset):
+        SegmentedDownloader.write_at(self.fd, data, offset, self.seek_lock)
+        if not self.drop_cache:
+            return
+
+        with self.lock:
+            self.unflushed += len(data)
+            if self.unflushed < self.DROP_CACHE_BYTES:
+                return
+            self.unflushed = 0
+        # Dirty pages can't be dropped, write them out first
+        os.fdatasync(self.fd)
+        os.posix_fadvise(self.fd, 0, 0, os.POSIX_FADV_DONTNEED)
+
+    async def wait(self):
+        """Wait for every queued write"""
+        while self.pending:
+            await asyncio.gather(*self.pending, return_exceptions=True)
+
+    async def flush(self):
+        """Wait for every queued write and raise the first write error"""
+        await self.wait()
+        if self.error:
+            raise self.error
+
+
+class SegmentedDownloader:
+    """Download a file over several parallel HTTP range requests"""
+
+    def __init__(self, connections=DOWNLOAD_CONNECTIONS, min_segment_size=MIN_SEGMENT_SIZE,
+                 chunk_size=DOWNLOAD_CHUNK_SIZE, retries=SEGMENT_RETRIES):
+        self.connections = max(1, connections)
+        self.min_segment_size = min_segment_size
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.executor = ThreadPoolExecutor(max_workers=DOWNLOAD_WRITERS, thread_name_prefix='download-writer')
+
+    async def probe(self, session, url):
+        """Check range support and validators of url
+
+        Returns a dict with ranges (bool), size, etag and last_modified.
+        """
+        async with session.get(url, headers={'Range': 'bytes=0-0'}) as response:
+            info = {
+                'ranges': False,
+                'size': int(response.headers.get('Content-Length', 0)),
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified')
+            }
+            if response.status == 206:
+                total = response.headers.get('Content-Range', '').split('/')[-1]
+                if total.isdigit():
+                    info['ranges'] = True
+                    info['size'] = int(total)
+            return info
+
+    def split(self, total_size):
+        """Split total_size bytes into evenly sized segments"""
+        count = min(self.connections, max(1, total_size // self.min_segment_size))
+        segment_size = total_size // count
+
+        segments = []
+        for index in range(count):
+            start = index * segment_size
+            end = total_size - 1 if index == count - 1 else start + segment_size - 1
+            segments.append(Segment(index, start, end))
+        return segments
+
+    @staticmethod
+    def can_resume(state, info, path):
+        """Check that a saved download state still matches the remote file"""
+        if not state or not state.get('segments') or not os.path.exists(path):
+            return False
+        if not info['ranges'] or state.get('size') != info['size']:
+            return False
+        for validator in ('etag', 'last_modified'):
+            if state.get(validator) and info[validator] and state[validator] != info[validator]:
+                return False
+        return True
+
+    async def download(self, session, url, path, progress=None, state=None, info=None):
+        """Download url to path, using parallel segments when possible
+
+        progress is an optional coroutine called as progress(downloaded, total, segments).
+        state is an optional dict the caller persists to resume after a restart; it
+        holds size, etag, last_modified and segments ([start, end, downloaded] lists).
+        It is filled in when the download starts, segment progress comes through
+        the progress callback. info is an optional fresh probe result of url, it
+        saves probing the link again.
+        """
+        if info is None:
+            try:
+                info = await self.probe(session, url)
+            except aiohttp.ClientError as e:
+                logger.debug(f"Range probe failed, falling back to single stream: {e}")
+                info = {'ranges': False, 'size': 0, 'etag': None, 'last_modified': None}
+
+        if not info['ranges']:
+            if state is not None:
+                state.update(size=info['size'], etag=info['etag'], last_modified=info['last_modified'], segments=None)
+            await self.download_single(session, url, path, progress)
+            return path
+
+        total_size = info['size']
+        if self.can_resume(state, info, path):
+            segments = [Segment(index, *values) for index, values in enumerate(state['segments'])]
+            flags = os.O_WRONLY
+            logger.info(f"Resuming download at {sum(s.downloaded for s in segments)}/{total_size} bytes")
+        else:
+            segments = self.split(total_size)
+            flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+            if state is not None:
+                state.update(
+                    size=total_size,
+                    etag=info['etag'],
+                    last_modified=info['last_modified'],
+                    segments=[[s.start, s.end, 0] for s in segments]
+                )
+
+        logger.info(f"Downloading {total_size} bytes over {len(segments)} connections")
+
+        fd = os.open(path, flags | getattr(os, 'O_BINARY', 0), 0o644)
+        writer = FileWriter(fd, self.executor)
+        try:
+            if flags & os.O_TRUNC:
+                self.preallocate(fd, total_size)
+
+            async def report():
+                if progress:
+                    downloaded = sum(segment.downloaded for segment in segments)
+                    await progress(downloaded, total_size, segments)
+
+            tasks = [
+                asyncio.ensure_future(self.fetch_segment(session, url, writer, segment, report))
+                for segment in segments if not segment.done
+            ]
+            try:
+                await asyncio.gather(*tasks)
+            except BaseException:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                raise
+            await writer.flush()
+        finally:
+            # Never close the fd under a write still running on the pool
+            try:
+                await writer.wait()
+            finally:
+                os.close(fd)
+
+        return path
+
+    async def fetch_segment(self, session, url, writer, segment, report):
+        """Fetch a single segment, resuming from where it stopped on connection errors
+
+        segment.downloaded only counts bytes already on disk, queued counts
+        bytes handed to the writer.
+        """
+        attempt = 0
+        queued = segment.downloaded
+        while queued < segment.size:
+            offset = segment.start + queued
+            headers = {'Range': f'bytes={offset}-{segment.end}'}
+            try:
+                async with session.get(url, headers=headers) as response:
+                    if response.status != 206:
+                        raise Exception(f"Server ignored range request (HTTP {response.status})")
+
+                    async for chunk in response.content.iter_chunked(self.chunk_size):
+                        # Never write past the end of this segment
+                        chunk = chunk[:segment.size - queued]
+                        await writer.write(chunk, segment.start + queued, segment)
+                        queued += len(chunk)
+                        await report()
+                        if queued >= segment.size:
+                            break
+
+                if queued < segment.size:
+                    raise aiohttp.ClientPayloadError("Connection closed before segment completed")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                attempt += 1
+                if attempt > self.retries:
+                    raise
+                logger.warning(f"Segment {segment.index} failed ({e}), retrying {attempt}/{self.retries}")
+                await asyncio.sleep(attempt)
+
+    async def download_single(self, session, url, path, progress=None):
+        """Download url over a single connection"""
+        async with session.get(url) as response:
+            response.raise_for_status()
+            total_size = int(response.headers.get('Content-Length', 0))
+            segment = Segment(0, 0, total_size - 1)
+
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o644)
+            writer = FileWriter(fd, self.executor)
+            try:
+                if total_size > 0:
+                    self.preallocate(fd, total_size)
+
+                queued = 0
+                async for chunk in response.content.iter_chunked(self.chunk_size):
+                    await writer.write(chunk, queued, segment)
+                    queued += len(chunk)
+                    if progress:
+                        await progress(segment.downloaded, total_size, [segment])
+
+                await writer.flush()
+                if progress:
+                    await progress(segment.downloaded, total_size, [segment])
+
+                # Drop preallocated space the body didn't fill
+                os.ftruncate(fd, queued)
+            finally:
+                try:
+                    await writer.wait()
+                finally:
+                    os.close(fd)
+
+    @staticmethod
+    def preallocate(fd, size):
+        """Reserve size bytes for fd so positional writes don't fragment the file"""
+        if hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(fd, 0, size)
+                return
+            except OSError:
+                # Filesystem doesn't support fallocate
+                pass
+        os.ftruncate(fd, size)
+
+    @staticmethod
+    def write_at(fd, data, offset, lock=None):
+        """Write data at offset without moving a shared file position
+
+        Without pwrite (Windows) the shared position is moved, so callers
+        writing the same fd from several threads must pass one lock for it.
+        """
+        view = memoryview(data)
+        if hasattr(os, 'pwrite'):
+            while view:
+                written = os.pwrite(fd, view, offset)
+                view = view[written:]
+                offset += written
+            return
+
+        with lock or contextlib.nullcontext():
+            os.lseek(fd, offset, os.SEEK_SET)
+            while view:
+                written = os.write(fd, view)
+                view = view[written:]
+
+
+async def buffered(source, max_items):
+    """Iterate source through a bounded queue so producer and consumer run concurrently
+
+    At most max_items items are read ahead of the consumer, which keeps memory
+    bounded while letting the producer keep going during slow consumer steps.
+    """
+    queue = asyncio.Queue(maxsize=max_items)
+    done = object()
+
+    async def produce():
+        try:
+            async for item in source:
+                await queue.put(item)
+            await queue.put(done)
+        except Exception as e:
+            await queue.put(e)
+
+    task = asyncio.ensure_future(produce())
+    try:
+        while True:
+            item = await queue.get()
+            if item is done:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
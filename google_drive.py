@@ -1,113 +1,524 @@
 import os
 import pickle
+import asyncio
+import aiohttp
+import httplib2
+import google_auth_httplib2
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import Flow
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
 import json
+import time
+import functools
+import threading
+import contextlib
+from collections import OrderedDict
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+from config import (
+    GDRIVE_CHUNK_SIZE, GDRIVE_UPLOAD_URL, GDRIVE_WORKERS,
+    GDRIVE_SERVICE_CACHE_SIZE, GDRIVE_SERVICE_CACHE_TTL
+)
+
+
+class ResumableUpload:
+    """Google Drive v3 resumable upload session driven over aiohttp"""
+    
+    def __init__(self, session, credentials, upload_url=GDRIVE_UPLOAD_URL, session_uri=None, retries=5,
+                 executor=None, refresh=None):
+        self.session = session
+        self.executor = executor
+        self.refresh = refresh or (lambda creds: creds.refresh(Request()))
+        self.credentials = credentials
+        self.upload_url = upload_url
+        self.session_uri = session_uri
+        self.retries = retries
+        self.offset = 0
+        self.result = None
+    
+    async def request(self, method, url, **kwargs):
+        """Send an authorized request, refreshing the access token once on 401"""
+        headers = kwargs.pop('headers', {})
+        operation = {'POST': 'start', 'DELETE': 'cancel'}.get(method) or ('chunk' if kwargs.get('data') else 'status')
+        
+        for attempt in range(2):
+            headers['Authorization'] = f'Bearer {self.credentials.token}'
+            with metrics.gdrive_latency.time(operation=operation):
+                async with self.session.request(method, url, headers=headers, **kwargs) as response:
+                    body = await response.read()
+            if response.status == 401 and attempt == 0 and self.credentials.refresh_token:
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(self.executor, self.refresh, self.credentials)
+                continue
+            return response.status, response.headers, body
+    
+    async def cancel(self):
+        """Abort the upload session, discarding anything sent so far"""
+        if not self.session_uri or self.result is not None:
+            return
+        try:
+            await self.request('DELETE', self.session_uri)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            pass
+    
+    async def start(self, metadata, mime_type, total_size=None, fields='id, webViewLink, webContentLink'):
+        """Open a new upload session and return its URI"""
+        headers = {
+            'Content-Type': 'application/json; charset=UTF-8',
+            'X-Upload-Content-Type': mime_type
+        }
+        if total_size:
+            headers['X-Upload-Content-Length'] = str(total_size)
+        
+        status, response_headers, body = await self.request(
+            'POST',
+            self.upload_url,
+            params={'uploadType': 'resumable', 'fields': fields},
+            headers=headers,
+            data=json.dumps(metadata)
+        )
+        
+        if status != 200 or 'Location' not in response_headers:
+            raise Exception(f"Could not start upload session (HTTP {status}): {body[:200]!r}")
+        
+        self.session_uri = response_headers['Location']
+        self.offset = 0
+        return self.session_uri
+    
+    @staticmethod
+    def parse_range(range_header):
+        """Return the number of bytes committed according to a Range response header"""
+        if not range_header:
+            return 0
+        return int(range_header.split('-')[-1]) + 1
+    
+    async def query_status(self, total_size=None):
+        """Ask Drive how many bytes of the session it has received"""
+        total = total_size if total_size is not None else '*'
+        status, headers, body = await self.request(
+            'PUT',
+            self.session_uri,
+            headers={'Content-Range': f'bytes */{total}'}
+        )
+        
+        if status in (200, 201):
+            self.result = json.loads(body)
+            return total_size
+        if status == 308:
+            self.offset = self.parse_range(headers.get('Range'))
+            return self.offset
+        if status in (404, 410):
+            # Session expired (they live for about a week)
+            return None
+        raise Exception(f"Upload session status check failed (HTTP {status}): {body[:200]!r}")
+    
+    async def send(self, data, final=False):
+        """Upload data at the current offset
+
+        Non-final chunks must be a multiple of 256 KB. Returns the file resource
+        once the final chunk is accepted, None otherwise.
+        """
+        view = memoryview(data)
+        attempt = 0
+        
+        while True:
+            total = str(self.offset + len(view)) if final else '*'
+            if len(view):
+                content_range = f'bytes {self.offset}-{self.offset + len(view) - 1}/{total}'
+            else:
+                content_range = f'bytes */{total}'
+            
+            try:
+                status, headers, body = await self.request(
+                    'PUT',
+                    self.session_uri,
+                    headers={'Content-Range': content_range},
+                    data=bytes(view)
+                )
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                attempt += 1
+                if attempt > self.retries:
+                    raise
+                await asyncio.sleep(min(2 ** attempt, 30))
+                start = self.offset
+                await self.query_status()
+                if self.result is not None:
+                    return self.result
+                view = view[self.offset - start:]
+                continue
+            
+            if status in (200, 201):
+                self.offset += len(view)
+                self.result = json.loads(body)
+                return self.result
+            
+            if status == 308:
+                # Drive may commit fewer bytes than sent, resend the rest
+                committed = self.parse_range(headers.get('Range'))
+                view = view[committed - self.offset:]
+                self.offset = committed
+                if not len(view) and not final:
+                    return None
+                continue
+            
+            if status in (429, 500, 502, 503, 504):
+                attempt += 1
+                if attempt > self.retries:
+                    raise Exception(f"Drive upload failed after retries (HTTP {status})")
+                await asyncio.sleep(min(2 ** attempt, 30))
+                start = self.offset
+                await self.query_status()
+                if self.result is not None:
+                    return self.result
+                view = view[self.offset - start:]
+                continue
+            
+            raise Exception(f"Drive upload failed (HTTP {status}): {body[:200]!r}")
+
+
+class ServiceCache:
+    """LRU/TTL cache of per-user Drive credentials
+
+    Service objects are not cached: each holds an httplib2.Http, which is not
+    thread-safe, and the Drive executor runs calls on several threads.
+    """
+    
+    def __init__(self, max_size=GDRIVE_SERVICE_CACHE_SIZE, ttl=GDRIVE_SERVICE_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'refreshes': 0, 'evictions': 0}
+    
+    def get(self, user_id, refresh_token):
+        """Return the cached entry for user_id, or None if missing, stale or re-authorized"""
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry and entry['refresh_token'] == refresh_token and time.monotonic() - entry['created'] < self.ttl:
+                self.entries.move_to_end(user_id)
+                self.stats['hits'] += 1
+                return entry
+            if entry:
+                del self.entries[user_id]
+            self.stats['misses'] += 1
+            return None
+    
+    def put(self, user_id, creds):
+        """Store credentials for user_id"""
+        with self.lock:
+            entry = {
+                'refresh_token': creds.refresh_token,
+                'credentials': creds,
+                'created': time.monotonic()
+            }
+            self.entries[user_id] = entry
+            self.entries.move_to_end(user_id)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.stats['evictions'] += 1
+            return entry
+    
+    def invalidate(self, user_id):
+        """Drop cached objects for user_id (e.g. on logout)"""
+        with self.lock:
+            self.entries.pop(user_id, None)
+
 
 class GoogleDriveUploader:
-    def __init__(self):
+    def __init__(self, on_token_refresh=None, http_client=None):
         self.SCOPES = ['https://www.googleapis.com/auth/drive.file']
         self.CLIENT_SECRETS_FILE = os.getenv('GOOGLE_CLIENT_SECRETS_FILE', 'credentials.json')
         self.REDIRECT_URI = os.getenv('REDIRECT_URI', 'http://localhost:8080/')
+        self.UPLOAD_URL = GDRIVE_UPLOAD_URL
+        self.CHUNK_SIZE = GDRIVE_CHUNK_SIZE
+        
+        # Bounded pool for blocking Drive API calls, keeps them off the event loop
+        self.executor = ThreadPoolExecutor(max_workers=GDRIVE_WORKERS, thread_name_prefix='gdrive')
         
-    def get_auth_url(self, user_id):
-        """Generate Google OAuth2 authorization URL"""
+        # Called as on_token_refresh(user_id, token_dict) whenever a token is refreshed
+        self.on_token_refresh = on_token_refresh
+        self.cache = ServiceCache()
+        
+        # Optional shared HTTPClient, a private session is used per upload otherwise
+        self.http_client = http_client
+        self._discovery_doc = None
+        
+    def get_auth_url(self, state):
+        """Generate Google OAuth2 authorization URL
+        
+        Returns (url, code_verifier); the PKCE code_verifier must be passed
+        back to get_credentials_from_code with the code.
+        """
         flow = Flow.from_client_secrets_file(
             self.CLIENT_SECRETS_FILE,
             scopes=self.SCOPES,
-            redirect_uri=self.REDIRECT_URI
+            redirect_uri=self.REDIRECT_URI,
+            autogenerate_code_verifier=True
         )
         
-        authorization_url, state = flow.authorization_url(
+        authorization_url, _ = flow.authorization_url(
             access_type='offline',
             include_granted_scopes='true',
             prompt='consent',
-            state=str(user_id)
+            state=state
         )
         
-        return authorization_url
+        return authorization_url, flow.code_verifier
     
-    def get_credentials_from_code(self, code):
-        """Exchange authorization code for credentials"""
+    def get_credentials_from_code(self, code, code_verifier=None):
+        """Exchange authorization code for credentials (blocking, use run_sync)"""
         flow = Flow.from_client_secrets_file(
             self.CLIENT_SECRETS_FILE,
             scopes=self.SCOPES,
-            redirect_uri=self.REDIRECT_URI
+            redirect_uri=self.REDIRECT_URI,
+            code_verifier=code_verifier
         )
         
         flow.fetch_token(code=code)
-        credentials = flow.credentials
         
+        return self.credentials_to_dict(flow.credentials)
+    
+    @staticmethod
+    def credentials_to_dict(credentials):
+        """Serialize credentials into the dict stored in users.gdrive_token"""
         return {
             'token': credentials.token,
             'refresh_token': credentials.refresh_token,
             'token_uri': credentials.token_uri,
             'client_id': credentials.client_id,
             'client_secret': credentials.client_secret,
-            'scopes': credentials.scopes
+            'scopes': credentials.scopes,
+            'expiry': credentials.expiry.isoformat() if credentials.expiry else None
         }
     
-    def get_service(self, token_dict):
-        """Get Google Drive service instance"""
+    def refresh_credentials(self, creds, user_id=None):
+        """Refresh an access token and persist it so the next call doesn't refresh again"""
+        creds.refresh(Request())
+        with self.cache.lock:
+            self.cache.stats['refreshes'] += 1
+        
+        if user_id is not None and self.on_token_refresh:
+            self.on_token_refresh(user_id, self.credentials_to_dict(creds))
+    
+    def get_credentials(self, token_dict, user_id=None):
+        """Build (and refresh if needed) credentials from a stored token
+
+        With a user_id the credentials are cached and reused across calls.
+        """
         if isinstance(token_dict, str):
             token_dict = json.loads(token_dict)
         
-        creds = Credentials(
-            token=token_dict['token'],
-            refresh_token=token_dict.get('refresh_token'),
-            token_uri=token_dict['token_uri'],
-            client_id=token_dict['client_id'],
-            client_secret=token_dict['client_secret'],
-            scopes=token_dict['scopes']
-        )
+        entry = self.cache.get(user_id, token_dict.get('refresh_token')) if user_id is not None else None
+        if entry:
+            creds = entry['credentials']
+        else:
+            expiry = token_dict.get('expiry')
+            creds = Credentials(
+                token=token_dict['token'],
+                refresh_token=token_dict.get('refresh_token'),
+                token_uri=token_dict['token_uri'],
+                client_id=token_dict['client_id'],
+                client_secret=token_dict['client_secret'],
+                scopes=token_dict['scopes'],
+                # google-auth compares expiry against a naive UTC datetime
+                expiry=datetime.fromisoformat(expiry).replace(tzinfo=None) if expiry else None
+            )
+            if user_id is not None:
+                self.cache.put(user_id, creds)
         
         # Refresh token if expired
         if creds.expired and creds.refresh_token:
-            creds.refresh(Request())
+            self.refresh_credentials(creds, user_id)
+        
+        return creds
+    
+    @property
+    def discovery_doc(self):
+        """Parsed Drive v3 discovery document bundled with googleapiclient, no network fetch"""
+        if self._discovery_doc is None:
+            self._discovery_doc = json.loads(get_static_doc('drive', 'v3'))
+        return self._discovery_doc
+    
+    def get_service(self, token_dict, user_id=None):
+        """Build a Google Drive service for one call, on cached credentials for user_id
+
+        Every service gets its own Http, so services are never shared between
+        executor threads. With the parsed discovery document this is cheap.
+        """
+        creds = self.get_credentials(token_dict, user_id)
+        http = google_auth_httplib2.AuthorizedHttp(creds, http=httplib2.Http())
+        return build_from_document(self.discovery_doc, http=http)
+    
+    def get_cache_stats(self):
+        """Return credentials cache counters (hits, misses, refreshes, evictions, size)"""
+        return dict(self.cache.stats, size=len(self.cache.entries))
+    
+    async def run_sync(self, func, *args, **kwargs):
+        """Run a blocking googleapiclient/google-auth call on the Drive executor"""
+        loop = asyncio.get_running_loop()
+        operation = getattr(func, '__name__', 'call')
         
-        service = build('drive', 'v3', credentials=creds)
-        return service
+        def timed():
+            with metrics.gdrive_latency.time(operation=operation):
+                return func(*args, **kwargs)
+        
+        return await loop.run_in_executor(self.executor, timed)
+    
+    @contextlib.asynccontextmanager
+    async def upload_session(self):
+        """Yield an aiohttp session for upload requests"""
+        if self.http_client is not None:
+            yield await self.http_client.get_session()
+            return
+        
+        timeout = aiohttp.ClientTimeout(total=None, connect=30, sock_read=300)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            yield session
+    
+    def new_upload(self, session, creds, user_id=None, session_uri=None):
+        """Create a ResumableUpload that refreshes (and persists) tokens for user_id"""
+        return ResumableUpload(
+            session, creds, self.UPLOAD_URL,
+            session_uri=session_uri,
+            executor=self.executor,
+            refresh=functools.partial(self.refresh_credentials, user_id=user_id)
+        )
     
-    async def upload_file(self, file_path, file_name, token_dict):
-        """Upload file to Google Drive"""
+    async def resume_upload(self, session_uri, token_dict, total_size=None, user_id=None):
+        """Find out how far an earlier upload session got
+
+        Returns (offset, file). file is set if the upload had already finished;
+        offset is None if the session expired and the upload must start over.
+        """
         try:
-            service = self.get_service(token_dict)
+            creds = await self.run_sync(self.get_credentials, token_dict, user_id)
+            async with self.upload_session() as session:
+                upload = self.new_upload(session, creds, user_id, session_uri)
+                offset = await upload.query_status(total_size)
             
-            file_metadata = {
-                'name': file_name,
-                'mimeType': self.get_mime_type(file_name)
-            }
+            if upload.result is not None:
+                await self.finish_upload(upload.result, token_dict, user_id)
+            return offset, upload.result
             
-            media = MediaFileUpload(
-                file_path,
-                mimetype=self.get_mime_type(file_name),
-                resumable=True
-            )
+        except Exception as e:
+            raise Exception(f"Google Drive upload failed: {str(e)}")
+    
+    async def cancel_upload(self, session_uri, token_dict, user_id=None):
+        """Abort an upload session, discarding anything sent so far"""
+        creds = await self.run_sync(self.get_credentials, token_dict, user_id)
+        async with self.upload_session() as session:
+            await self.new_upload(session, creds, user_id, session_uri).cancel()
+    
+    async def upload_file(self, file_path, file_name, token_dict, progress=None, user_id=None,
+                          session_uri=None, on_session=None):
+        """Upload file to Google Drive
+
+        The file is sent in CHUNK_SIZE pieces over a resumable session; disk reads
+        and token refreshes run on the Drive executor so the event loop is never
+        blocked. Passing the session_uri of an interrupted upload continues it.
+        progress is an optional coroutine called as progress(uploaded, total_size).
+        """
+        total_size = os.path.getsize(file_path)
+        
+        offset = 0
+        if session_uri:
+            offset, file = await self.resume_upload(session_uri, token_dict, total_size, user_id)
+            if file is not None:
+                return file
+            if offset is None:
+                session_uri, offset = None, 0
+        
+        async def read_chunks():
+            with open(file_path, 'rb') as f:
+                f.seek(offset)
+                while True:
+                    data = await self.run_sync(f.read, self.CHUNK_SIZE)
+                    if not data:
+                        break
+                    yield data
+        
+        return await self.upload_stream(
+            read_chunks(), file_name, token_dict, total_size, progress, user_id,
+            session_uri=session_uri, offset=offset, on_session=on_session
+        )
+    
+    async def upload_stream(self, chunks, file_name, token_dict, total_size=None, progress=None, user_id=None,
+                            session_uri=None, offset=0, on_session=None):
+        """Upload an async iterator of bytes to Google Drive as it arrives
+
+        Data is sent in CHUNK_SIZE pieces over a resumable session, so at most one
+        chunk is held in memory here. progress is an optional coroutine called as
+        progress(uploaded, total_size).
+        
+        To continue an interrupted upload pass its session_uri and the offset
+        returned by resume_upload; chunks must then start at that offset.
+        on_session is an optional coroutine called with the URI of a new session
+        so the caller can persist it.
+        """
+        try:
+            creds = await self.run_sync(self.get_credentials, token_dict, user_id)
+            mime_type = self.get_mime_type(file_name)
             
-            file = service.files().create(
-                body=file_metadata,
-                media_body=media,
-                fields='id, webViewLink, webContentLink'
-            ).execute()
+            async with self.upload_session() as session:
+                upload = self.new_upload(session, creds, user_id, session_uri)
+                if session_uri:
+                    upload.offset = offset
+                else:
+                    await upload.start({'name': file_name, 'mimeType': mime_type}, mime_type, total_size)
+                    if on_session:
+                        await on_session(upload.session_uri)
+                
+                buffer = bytearray()
+                async for data in chunks:
+                    buffer += data
+                    while len(buffer) >= self.CHUNK_SIZE:
+                        await upload.send(buffer[:self.CHUNK_SIZE])
+                        del buffer[:self.CHUNK_SIZE]
+                        if progress:
+                            await progress(upload.offset, total_size)
+                
+                file = await upload.send(buffer, final=True)
+                if progress:
+                    await progress(upload.offset, total_size)
             
-            # Make file shareable
-            permission = {
-                'type': 'anyone',
-                'role': 'reader'
-            }
-            service.permissions().create(
-                fileId=file['id'],
-                body=permission
-            ).execute()
+            await self.finish_upload(file, token_dict, user_id)
             
             return file
             
         except Exception as e:
             raise Exception(f"Google Drive upload failed: {str(e)}")
     
+    async def finish_upload(self, file, token_dict, user_id=None):
+        """Make an uploaded file shareable"""
+        service = await self.run_sync(self.get_service, token_dict, user_id)
+        await self.run_sync(self.make_public, service, file['id'])
+    
+    async def copy_file(self, file_id, file_name, token_dict, user_id=None):
+        """Copy an existing Drive file server-side and make the copy shareable"""
+        service = await self.run_sync(self.get_service, token_dict, user_id)
+        request = service.files().copy(
+            fileId=file_id,
+            body={'name': file_name},
+            fields='id, webViewLink, webContentLink'
+        )
+        file = await self.run_sync(request.execute)
+        await self.run_sync(self.make_public, service, file['id'])
+        return file
+    
+    def make_public(self, service, file_id):
+        """Make file shareable with anyone who has the link"""
+        permission = {
+            'type': 'anyone',
+            'role': 'reader'
+        }
+        service.permissions().create(
+            fileId=file_id,
+            body=permission
+        ).execute()
+    
     def get_mime_type(self, filename):
         """Get MIME type based on file extension"""
         extension = filename.split('.')[-1].lower()
@@ -137,10 +548,10 @@ class GoogleDriveUploader:
         
         return mime_types.get(extension, 'application/octet-stream')
     
-    def list_files(self, token_dict, page_size=10):
+    def list_files(self, token_dict, page_size=10, user_id=None):
         """List files from Google Drive"""
         try:
-            service = self.get_service(token_dict)
+            service = self.get_service(token_dict, user_id)
             
             results = service.files().list(
                 pageSize=page_size,
@@ -152,10 +563,10 @@ class GoogleDriveUploader:
         except Exception as e:
             raise Exception(f"Failed to list files: {str(e)}")
     
-    def delete_file(self, token_dict, file_id):
+    def delete_file(self, token_dict, file_id, user_id=None):
         """Delete file from Google Drive"""
         try:
-            service = self.get_service(token_dict)
+            service = self.get_service(token_dict, user_id)
             service.files().delete(fileId=file_id).execute()
             return True
         except Exception as e:
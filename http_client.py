@@ -0,0 +1,61 @@
+import ssl
+import logging
+import aiohttp
+from config import HTTP_POOL_SIZE, HTTP_POOL_PER_HOST, HTTP_DNS_TTL, HTTP_KEEPALIVE_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+
+class HTTPClient:
+    """Application-wide aiohttp session with one shared connection pool
+
+    Reusing a single session keeps DNS results, keep-alive connections and the
+    SSL context alive between the probe of a link and the download that follows.
+    Certificates are verified unless verify_ssl is False.
+    """
+    
+    def __init__(self, pool_size=HTTP_POOL_SIZE, per_host=HTTP_POOL_PER_HOST, dns_ttl=HTTP_DNS_TTL,
+                 keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT, verify_ssl=True):
+        self.pool_size = pool_size
+        self.per_host = per_host
+        self.dns_ttl = dns_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self._session = None
+        
+        self.ssl_context = ssl.create_default_context()
+        if not verify_ssl:
+            # Skip certificate checks (for Termux without a CA bundle), never for requests carrying tokens
+            self.ssl_context.check_hostname = False
+            self.ssl_context.verify_mode = ssl.CERT_NONE
+    
+    async def get_session(self):
+        """Return the shared session, creating it on first use"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                ssl=self.ssl_context,
+                limit=self.pool_size,
+                limit_per_host=self.per_host,
+                ttl_dns_cache=self.dns_ttl,
+                keepalive_timeout=self.keepalive_timeout,
+                force_close=False,
+                enable_cleanup_closed=True
+            )
+            
+            # Use larger timeout for high-speed connections
+            timeout = aiohttp.ClientTimeout(
+                total=None,
+                connect=30,
+                sock_read=60
+            )
+            
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+            logger.info(f"HTTP client started (pool={self.pool_size}, per_host={self.per_host})")
+        
+        return self._session
+    
+    async def close(self):
+        """Close the session and all pooled connections"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+            logger.info("HTTP client closed")
+        self._session = None
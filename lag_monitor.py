@@ -0,0 +1,56 @@
+import asyncio
+import logging
+from collections import deque
+import metrics
+from config import LOOP_LAG_INTERVAL, LOOP_LAG_WARN
+
+logger = logging.getLogger(__name__)
+
+
+class LoopLagMonitor:
+    """Measure how late the event loop wakes a sleeping timer
+
+    Any lag means some call blocked the loop (disk I/O, CPU work, a sync
+    library call) and every other coroutine waited for it.
+    """
+
+    def __init__(self, interval=LOOP_LAG_INTERVAL, warn_after=LOOP_LAG_WARN, window=120):
+        self.interval = interval
+        self.warn_after = warn_after
+        self.samples = deque(maxlen=window)
+        self.max_lag = 0.0
+        self.task = None
+
+    def start(self):
+        """Start sampling, must be called from a running event loop"""
+        self.task = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        """Stop sampling"""
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - start - self.interval)
+
+            self.samples.append(lag)
+            metrics.loop_lag.observe(lag)
+            self.max_lag = max(self.max_lag, lag)
+            if lag > self.warn_after:
+                logger.warning(f"Event loop was blocked for {lag * 1000:.0f} ms")
+
+    def get_stats(self):
+        """Average and max lag in seconds over the recent window, plus the all-time max"""
+        if not self.samples:
+            return {'avg': 0.0, 'recent_max': 0.0, 'max': self.max_lag}
+        return {
+            'avg': sum(self.samples) / len(self.samples),
+            'recent_max': max(self.samples),
+            'max': self.max_lag
+        }
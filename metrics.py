@@ -0,0 +1,201 @@
+import time
+import bisect
+import threading
+import contextlib
+
+# Byte/second buckets for transfer speeds, 128 KB/s to 1 GB/s in steps of sqrt(2)
+SPEED_BUCKETS = tuple(round(128 * 1024 * 2 ** (i / 2)) for i in range(27))
+# Second buckets for request and query latencies, 0.1 ms to 60 s
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _label_text(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(f'{name}="{str(value)}"' for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+class Metric:
+    """Base for metrics with optional labels, safe to update from any thread"""
+
+    kind = None
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        registry.register(self)
+
+    def key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name} needs labels {', '.join(self.labels)}")
+        return tuple(str(labels[name]).replace('"', '') for name in self.labels)
+
+    def header(self):
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+
+
+class Counter(Metric):
+    """Monotonically increasing total"""
+
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labels=()):
+        super().__init__(name, help_text, labels)
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self.values.get(self.key(labels), 0)
+
+    def collect(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        return self.header() + [f'{self.name}{_label_text(self.labels, key)} {value}' for key, value in values]
+
+
+class Gauge(Metric):
+    """Current value, either set directly or read from func when collected"""
+
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, func=None):
+        super().__init__(name, help_text)
+        self.func = func
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def get(self):
+        return self.func() if self.func else self.value
+
+    def collect(self):
+        try:
+            value = self.get()
+        except Exception:
+            return []
+        return self.header() + [f'{self.name} {value}']
+
+
+class Histogram(Metric):
+    """Distribution of observed values in cumulative buckets"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS, labels=()):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+        self.series = {}                # label values -> [bucket counts..., +Inf count, sum]
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Observe the duration of the block in seconds"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def merged(self, **labels):
+        """Bucket counts and sum over all series matching the given labels"""
+        wanted = {self.labels.index(name): str(value) for name, value in labels.items()}
+        counts = [0] * (len(self.buckets) + 2)
+        with self.lock:
+            for key, series in self.series.items():
+                if all(key[index] == value for index, value in wanted.items()):
+                    counts = [a + b for a, b in zip(counts, series)]
+        return counts
+
+    def count(self, **labels):
+        return sum(self.merged(**labels)[:-1])
+
+    def quantile(self, q, **labels):
+        """Estimate the q quantile like Prometheus' histogram_quantile, None if empty"""
+        counts = self.merged(**labels)[:-1]
+        total = sum(counts)
+        if not total:
+            return None
+
+        rank = q * total
+        seen = 0
+        for index, count in enumerate(counts):
+            if seen + count >= rank and count:
+                if index == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[index - 1] if index else 0
+                upper = self.buckets[index]
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+    def collect(self):
+        with self.lock:
+            series = sorted((key, list(values)) for key, values in self.series.items())
+        lines = self.header()
+        for key, values in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), values[:-1]):
+                cumulative += count
+                labels = _label_text(self.labels + ('le',), key + (bound,))
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _label_text(self.labels, key)
+            lines.append(f'{self.name}_sum{labels} {values[-1]}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+class Registry:
+    """All metrics of the process, rendered in the Prometheus text format"""
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.collect())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+# Transfers
+transfers = Counter('bot_transfers_total', 'Finished transfer jobs', ('destination', 'result'))
+transfer_bytes = Counter('bot_transfer_bytes_total', 'Bytes moved', ('stage', 'destination'))
+transfer_speed = Histogram(
+    'bot_transfer_speed_bytes', 'Average speed of each download/upload in bytes per second',
+    SPEED_BUCKETS, ('stage', 'destination')
+)
+
+# Link probing
+probe_latency = Histogram('bot_probe_seconds', 'Time to first response when probing a link')
+probes = Counter('bot_probes_total', 'Link lookups: cache hit, new probe, shared probe, error', ('result',))
+
+# Google Drive and database
+gdrive_latency = Histogram('bot_gdrive_request_seconds', 'Google Drive call latency: upload requests and blocking client calls', labels=('operation',))
+db_latency = Histogram('bot_db_query_seconds', 'Database call latency on its worker thread', labels=('method',))
+
+# Scheduler and event loop, gauges are wired to their sources by the bot
+loop_lag = Histogram('bot_event_loop_lag_seconds', 'How late the event loop woke a sleeping timer')
+jobs_queued = Gauge('bot_jobs_queued', 'Transfer jobs waiting for a worker')
+jobs_running = Gauge('bot_jobs_running', 'Transfer jobs running, including handed-off uploads')
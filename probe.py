@@ -0,0 +1,226 @@
+import os
+import re
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from urllib.parse import urlparse, unquote
+import aiohttp
+import metrics
+from config import PROBE_CACHE_TTL, PROBE_CACHE_SIZE, PROBE_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+# One disposition parameter: name, then a token or a quoted string with \-escapes
+_PARAM = re.compile(r';\s*([^\s=;]+)\s*=\s*("(?:[^"\\]|\\.)*"|[^;]*)')
+
+
+def parse_content_disposition(value):
+    """Get the file name from a Content-Disposition header (RFC 6266), or None
+
+    filename* (RFC 5987, e.g. UTF-8''na%C3%AFve.zip) wins over filename.
+    Semicolons and escaped quotes inside quoted values are handled.
+    """
+    if not value:
+        return None
+
+    params = {}
+    for name, raw in _PARAM.findall(';' + value.split(';', 1)[1] if ';' in value else ''):
+        raw = raw.strip()
+        if raw.startswith('"'):
+            raw = re.sub(r'\\(.)', r'\1', raw[1:-1])
+        params.setdefault(name.lower(), raw)
+
+    extended = params.get('filename*')
+    if extended and extended.count("'") >= 2:
+        charset, _, encoded = extended.split("'", 2)
+        try:
+            name = unquote(encoded, encoding=charset or 'utf-8', errors='strict')
+            return safe_file_name(name)
+        except (LookupError, UnicodeDecodeError):
+            logger.debug(f"Bad filename* in Content-Disposition: {extended}")
+
+    name = params.get('filename')
+    if name:
+        # Servers often send raw UTF-8 that aiohttp decoded as latin-1
+        try:
+            name = name.encode('latin-1').decode('utf-8')
+        except (UnicodeEncodeError, UnicodeDecodeError):
+            pass
+        return safe_file_name(name)
+    return None
+
+
+def safe_file_name(name):
+    """Strip directories and control characters from a server supplied name"""
+    name = os.path.basename(name.replace('\\', '/'))
+    name = re.sub(r'[\x00-\x1f\x7f]', '', name).strip()
+    return name if name not in ('', '.', '..') else None
+
+
+class LinkProber:
+    """Look up size, name and validators of download links, with a TTL cache
+
+    A HEAD and a one-byte range GET are sent at once and whatever answered
+    within the timeout is merged, so servers that reject HEAD or ignore ranges
+    still resolve in one round trip. Redirects are followed once here and the
+    final URL is remembered, so the download that follows goes straight to it.
+    Concurrent probes of the same link share one request.
+    """
+
+    def __init__(self, http, ttl=PROBE_CACHE_TTL, max_entries=PROBE_CACHE_SIZE, timeout=PROBE_TIMEOUT):
+        self.http = http
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self.cache = OrderedDict()          # url -> (expires, info), least recently used first
+        self.pending = {}                   # url -> future of a probe in flight
+
+    def cached(self, url):
+        """Fresh cached info for url, or None"""
+        entry = self.cache.get(url)
+        if entry is None:
+            return None
+        expires, info = entry
+        if expires < time.monotonic():
+            del self.cache[url]
+            return None
+        self.cache.move_to_end(url)
+        return info
+
+    def resolved(self, url):
+        """Final URL of url after redirects if still cached, else url itself"""
+        info = self.cached(url)
+        return info['url'] if info else url
+
+    async def probe(self, url):
+        """Return info for url: url (resolved), name, size, etag, last_modified, ranges"""
+        info = self.cached(url)
+        if info is not None:
+            metrics.probes.inc(result='hit')
+            return info
+
+        future = self.pending.get(url)
+        if future is None:
+            future = self.pending[url] = asyncio.ensure_future(self.fetch(url))
+            future.add_done_callback(lambda _: self.fetched(url, future))
+            metrics.probes.inc(result='miss')
+        else:
+            metrics.probes.inc(result='shared')
+        info = await asyncio.shield(future)
+
+        self.cache[url] = (time.monotonic() + self.ttl, info)
+        self.cache.move_to_end(url)
+        while len(self.cache) > self.max_entries:
+            self.cache.popitem(last=False)
+        return info
+
+    def fetched(self, url, future):
+        # The fetch is shielded and may outlive every waiter, so retrieve its error here
+        self.pending.pop(url, None)
+        if not future.cancelled() and future.exception():
+            metrics.probes.inc(result='error')
+
+    async def probe_many(self, urls, concurrency=8, budget=None):
+        """Probe urls a few at a time, returns [(url, info or None)] in order
+
+        Links that fail, or are still unanswered when budget seconds are up,
+        get None.
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def probe_one(url):
+            async with semaphore:
+                try:
+                    return await self.probe(url)
+                except Exception as e:
+                    logger.info(f"Probe failed for {url}: {e}")
+                    return None
+
+        tasks = [asyncio.ensure_future(probe_one(url)) for url in urls]
+        if tasks:
+            await asyncio.wait(tasks, timeout=budget)
+        results = []
+        for url, task in zip(urls, tasks):
+            if task.done():
+                results.append((url, task.result()))
+            else:
+                task.cancel()
+                results.append((url, None))
+        return results
+
+    async def fetch(self, url):
+        session = await self.http.get_session()
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+
+        async def head():
+            async with session.head(url, allow_redirects=True, timeout=timeout) as response:
+                return response.status, str(response.url), response.headers
+
+        async def range_get():
+            # A server that ignores Range sends the whole body; it's never read
+            async with session.get(url, headers={'Range': 'bytes=0-0'}, timeout=timeout) as response:
+                return response.status, str(response.url), response.headers
+
+        started = time.perf_counter()
+        tasks = {'head': asyncio.ensure_future(head()), 'get': asyncio.ensure_future(range_get())}
+        try:
+            pending = set(tasks.values())
+            while pending:
+                done, pending = await asyncio.wait(pending, timeout=self.timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    break
+                if len(done) + len(pending) == len(tasks):
+                    # First answer of either request
+                    metrics.probe_latency.observe(time.perf_counter() - started)
+                # A 206 answer already has everything HEAD could add
+                get = tasks['get']
+                if get.done() and not get.exception() and get.result()[0] == 206:
+                    break
+        finally:
+            for task in tasks.values():
+                task.cancel()
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+
+        responses = {}
+        errors = []
+        for kind, task in tasks.items():
+            if task.cancelled():
+                continue
+            if task.exception():
+                errors.append(task.exception())
+            elif task.result()[0] < 400:
+                responses[kind] = task.result()
+            else:
+                errors.append(Exception(f"HTTP {task.result()[0]}"))
+
+        if not responses:
+            if errors:
+                raise errors[-1]
+            raise Exception(f"No response within {self.timeout}s")
+        return self.merge(url, responses.get('head'), responses.get('get'))
+
+    def merge(self, url, head, get):
+        """Combine the HEAD and range GET answers into one info dict"""
+        info = {'url': url, 'name': None, 'size': 0, 'etag': None, 'last_modified': None, 'ranges': False}
+
+        # Prefer the GET: its validators are the ones the downloader compares
+        for response in (head, get):
+            if response is None:
+                continue
+            status, final_url, headers = response
+            info['url'] = final_url
+            info['name'] = parse_content_disposition(headers.get('Content-Disposition')) or info['name']
+            info['etag'] = headers.get('ETag') or info['etag']
+            info['last_modified'] = headers.get('Last-Modified') or info['last_modified']
+            if status == 206:
+                total = headers.get('Content-Range', '').split('/')[-1]
+                if total.isdigit():
+                    info['size'] = int(total)
+                    info['ranges'] = True
+            elif not info['ranges'] and headers.get('Content-Length', '').isdigit():
+                info['size'] = int(headers['Content-Length']) or info['size']
+
+        if not info['name']:
+            info['name'] = safe_file_name(unquote(urlparse(info['url']).path)) or 'downloaded_file'
+        return info
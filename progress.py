@@ -0,0 +1,269 @@
+import time
+import asyncio
+import logging
+import contextlib
+from telegram.error import RetryAfter, BadRequest
+from config import PROGRESS_INTERVAL, PROGRESS_CHAT_RATE, PROGRESS_GLOBAL_RATE, PROGRESS_SPEED_ALPHA
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Allow rate events per second with bursts of up to capacity"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def ready(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens >= 1
+
+    def take(self):
+        self.tokens -= 1
+
+
+class Progress:
+    """Latest numbers for one progress message, published by a transfer loop"""
+
+    def __init__(self, service, message, render, reply_markup=None):
+        self.service = service
+        self.message = message
+        self.render = render            # Called as render(progress), returns the message text
+        self.reply_markup = reply_markup
+        self.done = 0
+        self.total = 0
+        self.extra = {}
+        self.speed = 0.0
+        self.dirty = False
+        self.last_text = None
+        self.last_edit = 0.0
+        self.task = None
+
+        self.started = time.monotonic()
+        self.sample_time = self.started
+        self.sample_done = None
+
+    @property
+    def percent(self):
+        return self.done / self.total * 100 if self.total else 0
+
+    @property
+    def eta(self):
+        """Seconds left at the smoothed speed, None if unknown"""
+        if not self.total or self.speed <= 0:
+            return None
+        return max(0, self.total - self.done) / self.speed
+
+    def update(self, done, total=None, **extra):
+        """Record progress; cheap and never waits for Telegram"""
+        now = time.monotonic()
+        if self.sample_done is None:
+            # Don't count bytes that were already there when a resumed transfer started
+            self.sample_done = done
+        elif now - self.sample_time >= 1:
+            rate = (done - self.sample_done) / (now - self.sample_time)
+            alpha = PROGRESS_SPEED_ALPHA
+            self.speed = rate if self.speed == 0 else alpha * rate + (1 - alpha) * self.speed
+            self.sample_time = now
+            self.sample_done = done
+
+        self.done = done
+        if total is not None:
+            self.total = total
+        self.extra.update(extra)
+        self.dirty = True
+        self.service.wakeup.set()
+
+
+class ProgressService:
+    """Edit progress messages from one background task
+
+    Transfer loops only publish numbers through Progress.update. Edits are
+    coalesced to the latest state per message and sent at most every interval
+    seconds per message, within a per-chat and a global edit budget. Unchanged
+    text is skipped, and a flood-control RetryAfter pauses all edits.
+    Messages marked local (batch item stand-ins) cost no edit budget.
+    """
+
+    TICK = 0.5
+
+    def __init__(self, interval=PROGRESS_INTERVAL, chat_rate=PROGRESS_CHAT_RATE, global_rate=PROGRESS_GLOBAL_RATE):
+        self.interval = interval
+        self.chat_rate = chat_rate
+        self.global_budget = TokenBucket(global_rate, global_rate)
+        self.chat_budgets = {}
+        self.entries = {}               # (chat_id, message_id) -> Progress
+        self.paused_until = 0.0
+        self.wakeup = None
+        self.task = None
+
+    def start(self):
+        """Start the edit loop, must be called from a running event loop"""
+        self.wakeup = asyncio.Event()
+        self.task = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        """Stop the edit loop"""
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    def track(self, message, render, reply_markup=None):
+        """Start tracking progress shown in message, returns a Progress"""
+        progress = Progress(self, message, render, reply_markup)
+        self.entries[(message.chat_id, message.message_id)] = progress
+        return progress
+
+    @contextlib.asynccontextmanager
+    async def tracking(self, message, render):
+        """Track progress shown in message for the duration of the block"""
+        progress = self.track(message, render)
+        try:
+            yield progress
+        finally:
+            await self.close(progress)
+
+    async def close(self, progress):
+        """Stop tracking progress and wait for its in-flight edit
+
+        Call this before editing the message with a final result so a late
+        progress edit can't overwrite it.
+        """
+        self.entries.pop((progress.message.chat_id, progress.message.message_id), None)
+        if progress.task:
+            await asyncio.gather(progress.task, return_exceptions=True)
+
+    async def run(self):
+        while True:
+            if not any(progress.dirty for progress in self.entries.values()):
+                await self.wakeup.wait()
+            self.wakeup.clear()
+
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+
+            # Messages that waited longest go first when the budget is short
+            for progress in sorted(self.entries.values(), key=lambda p: p.last_edit):
+                local = getattr(progress.message, 'local', False)
+                if not progress.dirty or progress.task:
+                    continue
+                if not local:
+                    if now - progress.last_edit < self.interval:
+                        continue
+                    chat_id = progress.message.chat_id
+                    chat_budget = self.chat_budgets.get(chat_id)
+                    if chat_budget is None:
+                        chat_budget = self.chat_budgets[chat_id] = TokenBucket(self.chat_rate, 2)
+                    if not (chat_budget.ready(now) and self.global_budget.ready(now)):
+                        continue
+
+                progress.dirty = False
+                try:
+                    text = progress.render(progress)
+                except Exception as e:
+                    logger.error(f"Progress render error: {e}")
+                    continue
+                if text == progress.last_text:
+                    continue
+
+                if not local:
+                    chat_budget.take()
+                    self.global_budget.take()
+                progress.last_text = text
+                progress.last_edit = now
+                progress.task = asyncio.ensure_future(self.edit(progress, text))
+
+            self.forget_idle_chats()
+            await asyncio.sleep(self.TICK)
+
+    async def edit(self, progress, text):
+        try:
+            await progress.message.edit_text(text, reply_markup=progress.reply_markup)
+        except RetryAfter as e:
+            logger.warning(f"Progress edits paused for {e.retry_after}s by flood control")
+            self.paused_until = time.monotonic() + float(e.retry_after)
+            progress.last_text = None
+            progress.dirty = True
+        except BadRequest as e:
+            if 'not modified' not in str(e).lower():
+                logger.debug(f"Progress update error: {e}")
+        except Exception as e:
+            logger.debug(f"Progress update error: {e}")
+        finally:
+            progress.task = None
+
+    def forget_idle_chats(self):
+        """Drop budgets of chats with no tracked messages"""
+        if len(self.chat_budgets) > len(self.entries):
+            active = {chat_id for chat_id, _ in self.entries}
+            for chat_id in list(self.chat_budgets):
+                if chat_id not in active:
+                    del self.chat_budgets[chat_id]
+
+
+class BatchItemMessage:
+    """Stand-in for the status and progress messages of one job in a batch
+
+    Edits and replies only replace the job's line in the batch message.
+    """
+
+    local = True
+
+    def __init__(self, batch, job_id):
+        self.batch = batch
+        self.job_id = job_id
+        self.chat_id = batch.message.chat_id
+        self.message_id = f"{batch.message.message_id}:{job_id}"
+
+    async def edit_text(self, text, reply_markup=None, **kwargs):
+        self.batch.set_line(self.job_id, text)
+        return self
+
+    async def reply_text(self, text, reply_markup=None, **kwargs):
+        self.batch.set_line(self.job_id, text)
+        return self
+
+
+class BatchProgress:
+    """Show every job of a batch in one message
+
+    items is a list of (job_id, name). render is called as render(batch) and
+    builds the text from batch.items and batch.lines.
+    """
+
+    def __init__(self, service, message, render, items, reply_markup=None):
+        self.service = service
+        self.message = message
+        self.render = render
+        self.items = items
+        self.lines = {}                 # job_id -> latest text of the job
+        self.unfinished = {job_id for job_id, _ in items}
+        self.progress = service.track(message, lambda progress: render(self), reply_markup)
+
+    def item(self, job_id):
+        """Message stand-in for one job"""
+        return BatchItemMessage(self, job_id)
+
+    def set_line(self, job_id, text):
+        self.lines[job_id] = text
+        self.progress.update(len(self.items) - len(self.unfinished), len(self.items))
+
+    async def item_finished(self, job_id):
+        """Mark a job finished, the last one writes the final batch message"""
+        self.unfinished.discard(job_id)
+        if self.unfinished:
+            self.progress.update(len(self.items) - len(self.unfinished), len(self.items))
+            return
+
+        await self.service.close(self.progress)
+        try:
+            await self.message.edit_text(self.render(self))
+        except Exception as e:
+            logger.debug(f"Batch summary update error: {e}")
@@ -0,0 +1,211 @@
+import time
+import asyncio
+import logging
+import itertools
+from collections import OrderedDict, deque, Counter
+from config import TRANSFER_WORKERS, MAX_JOBS_PER_USER, MAX_JOBS_PER_DESTINATION
+
+logger = logging.getLogger(__name__)
+
+_job_ids = itertools.count(1)
+
+
+class TransferJob:
+    """A queued download/upload for one user"""
+
+    def __init__(self, user_id, destination, run, name='', job_id=None):
+        # Persisted jobs reuse their database id
+        self.id = job_id if job_id is not None else next(_job_ids)
+        self.user_id = user_id
+        self.destination = destination      # 'telegram' or 'gdrive'
+        self.run = run                      # Coroutine function called as run(job)
+        self.name = name
+        self.state = 'queued'               # queued, running, done, failed, cancelled
+        self.stage = 'download'             # 'upload' once handed off, see TransferScheduler.handoff
+        self.task = None
+        self.created_at = time.time()
+        self.started_at = None
+
+
+class TransferScheduler:
+    """Run transfer jobs on a pool of async workers
+
+    Jobs are picked round-robin across users so one user with many jobs can't
+    starve the others. A job only starts while its user and its destination are
+    below their concurrency caps; the worker count is the global cap.
+
+    A job that finished downloading can hand off its per-user slot and upload
+    in the background, so a user's next file downloads while the previous one
+    uploads.
+    """
+
+    def __init__(self, workers=TRANSFER_WORKERS, per_user=MAX_JOBS_PER_USER, per_destination=None):
+        self.workers = workers
+        self.per_user = per_user
+        self.per_destination = per_destination or MAX_JOBS_PER_DESTINATION
+
+        self.queues = OrderedDict()         # user_id -> deque of jobs, in round-robin order
+        self.running = {}                   # job_id -> job
+        self.user_running = Counter()
+        self.user_uploading = Counter()     # Handed-off jobs, these don't count against per_user
+        self.destination_running = Counter()
+        self.condition = None
+        self.worker_tasks = []
+        self.stopping = False
+
+    def start(self):
+        """Start the worker tasks, must be called from a running event loop"""
+        self.condition = asyncio.Condition()
+        self.worker_tasks = [asyncio.ensure_future(self.worker(i)) for i in range(self.workers)]
+        logger.info(f"Transfer scheduler started with {self.workers} workers")
+
+    async def stop(self):
+        """Cancel running jobs and stop the workers"""
+        self.stopping = True
+        for job in list(self.running.values()):
+            if job.task:
+                job.task.cancel()
+        for task in self.worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self.worker_tasks, return_exceptions=True)
+        self.worker_tasks = []
+
+    async def submit(self, job):
+        """Queue a job and return its 1-based queue position"""
+        async with self.condition:
+            self.queues.setdefault(job.user_id, deque()).append(job)
+            self.condition.notify_all()
+        return self.position(job)
+
+    def position(self, job):
+        """Number of queued jobs that will start before job, plus one"""
+        if job.state != 'queued' or job.user_id not in self.queues:
+            return 0
+
+        index = self.queues[job.user_id].index(job)
+        ahead = index
+        before = True
+        for user_id, queue in self.queues.items():
+            if user_id == job.user_id:
+                before = False
+                continue
+            # Users earlier in the rotation get one more turn before ours
+            ahead += min(len(queue), index + 1 if before else index)
+        return ahead + 1
+
+    def can_run(self, job):
+        """Check the per-user and per-destination caps"""
+        if self.user_running[job.user_id] >= self.per_user:
+            return False
+        limit = self.per_destination.get(job.destination)
+        return limit is None or self.destination_running[job.destination] < limit
+
+    def pick(self):
+        """Take the next runnable job, rotating the picked user to the back"""
+        for user_id, queue in self.queues.items():
+            for job in queue:
+                if self.can_run(job):
+                    queue.remove(job)
+                    if queue:
+                        self.queues.move_to_end(user_id)
+                    else:
+                        del self.queues[user_id]
+                    return job
+                # Only the head of a user's queue is eligible to keep their order
+                break
+        return None
+
+    async def worker(self, index):
+        """Pull jobs and run them until cancelled"""
+        while True:
+            async with self.condition:
+                job = self.pick()
+                while job is None:
+                    await self.condition.wait()
+                    job = self.pick()
+
+                job.state = 'running'
+                job.started_at = time.time()
+                self.running[job.id] = job
+                self.user_running[job.user_id] += 1
+                self.destination_running[job.destination] += 1
+
+            job.task = asyncio.ensure_future(job.run(job))
+            try:
+                await job.task
+                job.state = 'done'
+            except asyncio.CancelledError:
+                job.state = 'cancelled'
+                if not job.task.cancelled():
+                    # The worker itself is being stopped
+                    raise
+            except Exception as e:
+                job.state = 'failed'
+                logger.error(f"Job {job.id} failed: {e}")
+            finally:
+                async with self.condition:
+                    self.running.pop(job.id, None)
+                    if job.stage == 'upload':
+                        self.user_uploading[job.user_id] -= 1
+                    else:
+                        self.user_running[job.user_id] -= 1
+                    self.destination_running[job.destination] -= 1
+                    self.condition.notify_all()
+
+    async def handoff(self, job_id):
+        """Let a running job's user start their next job while this one uploads
+
+        Only per_user jobs per user can be handed off at once; past that the
+        job simply keeps its slot. The extra worker the next job needs still
+        counts against the global and destination caps.
+        """
+        job = self.running.get(job_id)
+        if job is None or job.stage == 'upload':
+            return
+        if self.user_uploading[job.user_id] >= self.per_user:
+            return
+
+        async with self.condition:
+            job.stage = 'upload'
+            self.user_running[job.user_id] -= 1
+            self.user_uploading[job.user_id] += 1
+            self.condition.notify_all()
+
+    async def cancel(self, job_id, user_id=None):
+        """Cancel a queued or running job, optionally only if owned by user_id"""
+        job = self.get_job(job_id)
+        if job is None or (user_id is not None and job.user_id != user_id):
+            return False
+
+        if job.state == 'running':
+            job.task.cancel()
+            return True
+
+        async with self.condition:
+            queue = self.queues.get(job.user_id)
+            if queue and job in queue:
+                queue.remove(job)
+                if not queue:
+                    del self.queues[job.user_id]
+                job.state = 'cancelled'
+                return True
+        return False
+
+    def get_job(self, job_id):
+        """Find a queued or running job by id"""
+        if job_id in self.running:
+            return self.running[job_id]
+        for queue in self.queues.values():
+            for job in queue:
+                if job.id == job_id:
+                    return job
+        return None
+
+    def queued_jobs(self):
+        """All queued jobs in round-robin start order"""
+        jobs = [job for queue in self.queues.values() for job in queue]
+        return sorted(jobs, key=self.position)
+
+    def running_jobs(self):
+        """All running jobs, oldest first"""
+        return sorted(self.running.values(), key=lambda job: job.started_at)
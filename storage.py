@@ -0,0 +1,143 @@
+import os
+import re
+import shutil
+import asyncio
+import logging
+from config import DOWNLOAD_DIR, DOWNLOAD_SCRATCH_DIR, STORAGE_HEADROOM
+
+logger = logging.getLogger(__name__)
+
+# Names given by path_for, "<job_id>_<file name>"
+JOB_FILE_PATTERN = re.compile(r'^\d+_.+')
+
+
+def allocated_bytes(path):
+    """Disk space a file takes up, 0 if it doesn't exist yet"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return 0
+    blocks = getattr(stat, 'st_blocks', None)
+    return blocks * 512 if blocks is not None else stat.st_size
+
+
+class StorageManager:
+    """Hand out job-scoped download paths and reserve disk space for them
+
+    Directories are tried in order, so a fast scratch directory is used while
+    it has room and downloads spill over to the next one. A job whose file
+    doesn't fit anywhere waits until other jobs release their space.
+    """
+
+    RECHECK_INTERVAL = 5                # Seconds between free-space checks while waiting
+
+    def __init__(self, directories=None, headroom=STORAGE_HEADROOM):
+        if directories is None:
+            directories = [DOWNLOAD_SCRATCH_DIR, DOWNLOAD_DIR] if DOWNLOAD_SCRATCH_DIR else [DOWNLOAD_DIR]
+        self.directories = [os.path.abspath(directory) for directory in directories]
+        self.headroom = headroom
+
+        self.jobs = {}                      # job_id -> (directory, reserved bytes, path, bytes allocated at reservation)
+        self.condition = None
+
+        for directory in self.directories:
+            os.makedirs(directory, exist_ok=True)
+
+    def path_for(self, directory, job_id, file_name):
+        """Unique path for a job's file, so equal file names never collide"""
+        name = os.path.basename(file_name.replace('\\', '/')) or 'downloaded_file'
+        return os.path.join(directory, f"{job_id}_{name}")
+
+    def outstanding(self, directory):
+        """Reserved bytes in directory that the jobs' files don't take up on disk yet
+
+        Preallocated or written space already shows up as used in disk_usage,
+        so only the rest of each reservation is held back.
+        """
+        total = 0
+        for job_directory, needed, path, baseline in self.jobs.values():
+            if job_directory == directory:
+                total += max(0, needed - (allocated_bytes(path) - baseline))
+        return total
+
+    def available(self, directory):
+        """Free bytes in directory not promised to running jobs"""
+        free = shutil.disk_usage(directory).free
+        return free - self.outstanding(directory) - self.headroom
+
+    def try_reserve(self, job_id, size, file_name, current_path=None):
+        """Reserve size bytes for job_id and return its path, or None if nothing fits"""
+        if job_id in self.jobs:
+            directory = self.jobs[job_id][0]
+            return current_path or self.path_for(directory, job_id, file_name)
+
+        if current_path:
+            # A resumed job keeps its partial file, which already holds its preallocated space
+            directory = os.path.dirname(os.path.abspath(current_path))
+            existing = os.path.getsize(current_path) if os.path.exists(current_path) else 0
+            candidates = [(directory, current_path, max(0, size - existing))]
+        else:
+            candidates = [
+                (directory, self.path_for(directory, job_id, file_name), size)
+                for directory in self.directories
+            ]
+
+        for directory, path, needed in candidates:
+            if needed <= self.available(directory):
+                self.jobs[job_id] = (directory, needed, path, allocated_bytes(path))
+                return path
+        return None
+
+    async def reserve(self, job_id, size, file_name, current_path=None, on_wait=None):
+        """Reserve space for a download, waiting for other jobs to free some
+
+        on_wait is an optional coroutine called once if the job has to wait.
+        Raises if the file can't fit even with every other job gone.
+        """
+        if self.condition is None:
+            self.condition = asyncio.Condition()
+
+        directories = [os.path.dirname(os.path.abspath(current_path))] if current_path else self.directories
+        capacity = max(shutil.disk_usage(directory).total - self.headroom for directory in directories)
+        if size > capacity:
+            raise Exception(f"Not enough disk space for {size} bytes")
+
+        async with self.condition:
+            path = self.try_reserve(job_id, size, file_name, current_path)
+            if path is None and on_wait:
+                await on_wait()
+            while path is None:
+                try:
+                    await asyncio.wait_for(self.condition.wait(), self.RECHECK_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                path = self.try_reserve(job_id, size, file_name, current_path)
+        return path
+
+    async def release(self, job_id):
+        """Give back a job's reserved space"""
+        if self.jobs.pop(job_id, None) is None:
+            return
+
+        if self.condition is not None:
+            async with self.condition:
+                self.condition.notify_all()
+
+    def sweep(self, keep=()):
+        """Delete files left in the download directories by jobs that won't resume
+
+        Only job files (named by path_for) are touched, anything else that
+        shares the directory is left alone.
+        """
+        keep = {os.path.abspath(path) for path in keep if path}
+        removed = 0
+        for directory in self.directories:
+            for entry in os.scandir(directory):
+                if entry.is_file() and JOB_FILE_PATTERN.match(entry.name) and entry.path not in keep:
+                    try:
+                        os.remove(entry.path)
+                        removed += 1
+                    except OSError as e:
+                        logger.warning(f"Could not remove orphaned file {entry.path}: {e}")
+        if removed:
+            logger.info(f"Removed {removed} orphaned download files")
@@ -0,0 +1,241 @@
+import math
+import time
+import asyncio
+import logging
+from pyrogram import raw, types, utils
+from pyrogram.errors import FloodWait
+from pyrogram.session import Session
+from config import (
+    TELEGRAM_UPLOAD_WORKERS, TELEGRAM_STREAM_BUFFER, TELEGRAM_UPLOAD_SESSIONS, TELEGRAM_SESSION_INFLIGHT
+)
+
+logger = logging.getLogger(__name__)
+
+
+class MediaSessionPool:
+    """Share a few media sessions between all Telegram part uploads
+
+    Each call goes to the least busy session that isn't waiting out a FloodWait,
+    so parts of one file and uploads of different users spread over all of
+    them. When every session has max_inflight calls running, callers wait,
+    which in turn stops the part readers behind them.
+    """
+
+    def __init__(self, client, size=TELEGRAM_UPLOAD_SESSIONS, max_inflight=TELEGRAM_SESSION_INFLIGHT):
+        self.client = client
+        self.size = max(1, size)
+        self.max_inflight = max(1, max_inflight)
+
+        self.sessions = []
+        self.load = []                      # Calls in flight per session
+        self.paused_until = []              # monotonic time a FloodWait ends, per session
+        self.lock = None
+        self.condition = None
+
+    async def start(self):
+        """Open the sessions on first use, the client must already be connected"""
+        if self.sessions:
+            return
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+            self.condition = asyncio.Condition()
+
+        async with self.lock:
+            if self.sessions:
+                return
+            client = self.client
+            sessions = []
+            for _ in range(self.size):
+                session = Session(
+                    client, await client.storage.dc_id(), await client.storage.auth_key(),
+                    await client.storage.test_mode(), is_media=True
+                )
+                await session.start()
+                sessions.append(session)
+
+            self.load = [0] * len(sessions)
+            self.paused_until = [0] * len(sessions)
+            self.sessions = sessions
+            logger.info(f"Started {len(sessions)} Telegram media sessions")
+
+    async def stop(self):
+        """Close all sessions"""
+        sessions, self.sessions = self.sessions, []
+        for session in sessions:
+            try:
+                await session.stop()
+            except Exception as e:
+                logger.debug(f"Error stopping media session: {e}")
+
+    def pick(self):
+        """Index of the least busy available session, or None"""
+        now = time.monotonic()
+        available = [
+            index for index in range(len(self.sessions))
+            if self.load[index] < self.max_inflight and self.paused_until[index] <= now
+        ]
+        return min(available, key=lambda index: self.load[index]) if available else None
+
+    async def acquire(self):
+        """Wait for a session slot and return its index"""
+        async with self.condition:
+            while True:
+                index = self.pick()
+                if index is not None:
+                    self.load[index] += 1
+                    return index
+
+                # Wake up when a call finishes or the earliest FloodWait ends
+                resume = min(self.paused_until) - time.monotonic()
+                try:
+                    await asyncio.wait_for(self.condition.wait(), resume if resume > 0 else None)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def release(self, index):
+        """Free a session slot taken by acquire"""
+        async with self.condition:
+            self.load[index] -= 1
+            self.condition.notify_all()
+
+    async def invoke(self, query):
+        """Run query on a pooled session, moving to another one during FloodWaits"""
+        await self.start()
+        while True:
+            index = await self.acquire()
+            session = self.sessions[index]
+            try:
+                # sleep_threshold=0 hands every FloodWait back to us instead of
+                # sleeping inside the session while holding a slot
+                return await session.invoke(query, sleep_threshold=0)
+            except FloodWait as e:
+                logger.warning(f"Media session {index} flood wait: {e.value}s")
+                self.paused_until[index] = time.monotonic() + e.value
+            finally:
+                await self.release(index)
+
+
+class StreamingTelegramUploader:
+    """Upload a file to Telegram straight from an async byte stream
+
+    Pyrogram's save_file only accepts paths or file objects it reads
+    synchronously, so the stream is cut into 512 KB parts here and sent with
+    raw upload.saveBigFilePart calls through a MediaSessionPool. Download and
+    upload overlap and nothing is written to disk; at most buffer parts are read
+    ahead and workers parts of one file are in flight at once.
+    """
+
+    PART_SIZE = 512 * 1024
+    MIN_SIZE = 10 * 1024 * 1024         # Telegram only takes big-file parts above 10 MB
+
+    def __init__(self, client, pool=None, workers=TELEGRAM_UPLOAD_WORKERS, buffer=TELEGRAM_STREAM_BUFFER):
+        self.client = client
+        self.pool = pool or MediaSessionPool(client)
+        self.workers = max(1, workers)
+        self.buffer = max(1, buffer)
+
+    def can_stream(self, total_size):
+        """Check whether a file of total_size bytes can take the streaming path"""
+        return total_size and total_size > self.MIN_SIZE
+
+    async def iter_parts(self, chunks):
+        """Re-cut arbitrary chunks into PART_SIZE parts, the last one may be shorter"""
+        buffer = bytearray()
+        async for data in chunks:
+            buffer += data
+            while len(buffer) >= self.PART_SIZE:
+                yield bytes(buffer[:self.PART_SIZE])
+                del buffer[:self.PART_SIZE]
+        if buffer:
+            yield bytes(buffer)
+
+    async def upload(self, chunks, total_size, file_name, progress=None):
+        """Upload chunks as a big file and return its InputFileBig
+
+        total_size must be known up front, Telegram needs the part count with
+        every part. progress is an optional coroutine called as
+        progress(uploaded, total_size).
+        """
+        file_id = self.client.rnd_id()
+        total_parts = math.ceil(total_size / self.PART_SIZE)
+        queue = asyncio.Queue(maxsize=self.buffer)
+        uploaded = 0
+
+        async def worker():
+            nonlocal uploaded
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                part, data = item
+                await self.pool.invoke(raw.functions.upload.SaveBigFilePart(
+                    file_id=file_id,
+                    file_part=part,
+                    file_total_parts=total_parts,
+                    bytes=data
+                ))
+                uploaded += len(data)
+                if progress:
+                    await progress(uploaded, total_size)
+
+        workers = [asyncio.ensure_future(worker()) for _ in range(self.workers)]
+
+        async def put(item):
+            # Workers only exit early on errors, don't wait on a full queue forever
+            put_task = asyncio.ensure_future(queue.put(item))
+            await asyncio.wait([put_task, *workers], return_when=asyncio.FIRST_COMPLETED)
+            if not put_task.done():
+                put_task.cancel()
+                for task in workers:
+                    if task.done():
+                        task.result()
+
+        try:
+            part = 0
+            received = 0
+            async for data in self.iter_parts(chunks):
+                received += len(data)
+                if received > total_size:
+                    raise Exception(f"Source sent more than the expected {total_size} bytes")
+                await put((part, data))
+                part += 1
+
+            if received != total_size:
+                raise Exception(f"Source ended after {received} of {total_size} bytes")
+
+            for _ in workers:
+                await put(None)
+            await asyncio.gather(*workers)
+        except BaseException:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            raise
+
+        return raw.types.InputFileBig(id=file_id, parts=total_parts, name=file_name)
+
+    async def send_stream(self, chat_id, chunks, total_size, file_name, caption='', progress=None):
+        """Upload chunks and send them to chat_id as a document, returns the Message"""
+        file = await self.upload(chunks, total_size, file_name, progress)
+
+        media = raw.types.InputMediaUploadedDocument(
+            mime_type=self.client.guess_mime_type(file_name) or 'application/octet-stream',
+            file=file,
+            attributes=[raw.types.DocumentAttributeFilename(file_name=file_name)]
+        )
+        r = await self.client.invoke(raw.functions.messages.SendMedia(
+            peer=await self.client.resolve_peer(chat_id),
+            media=media,
+            random_id=self.client.rnd_id(),
+            **await utils.parse_text_entities(self.client, caption, None, None)
+        ))
+
+        # Same parsing as Client.send_document
+        for update in r.updates:
+            if isinstance(update, (raw.types.UpdateNewMessage, raw.types.UpdateNewChannelMessage)):
+                return await types.Message._parse(
+                    self.client, update.message,
+                    {user.id: user for user in r.users},
+                    {chat.id: chat for chat in r.chats}
+                )
+        return None
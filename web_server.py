@@ -0,0 +1,42 @@
+import logging
+from aiohttp import web
+from config import WEB_HOST, PORT
+
+logger = logging.getLogger(__name__)
+
+
+class WebServer:
+    """Embedded aiohttp server for the Telegram webhook and other HTTP endpoints
+
+    Routes are added before start(); the server runs on the bot's event loop,
+    so handlers can hand work straight to the application.
+    """
+
+    MAX_BODY_SIZE = 1024 * 1024         # Telegram updates are a few KB
+
+    def __init__(self, host=WEB_HOST, port=PORT):
+        self.host = host
+        self.port = port
+        self.app = web.Application(client_max_size=self.MAX_BODY_SIZE)
+        self.runner = None
+
+    def add_route(self, method, path, handler):
+        self.app.router.add_route(method, path, handler)
+
+    @property
+    def has_routes(self):
+        return len(self.app.router.routes()) > 0
+
+    async def start(self):
+        """Start listening on host:port"""
+        self.runner = web.AppRunner(self.app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+        logger.info(f"Web server listening on {self.host}:{self.port}")
+
+    async def stop(self):
+        """Stop accepting requests and close open connections"""
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None